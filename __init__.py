@@ -4,6 +4,11 @@ from fastapi import APIRouter
 from loguru import logger
 
 from .crud import db
+from .proxy import start_http_client, stop_http_client
+from .rates import refresh_exchange_rates
+from .reaper import run_reaper
+from .routing import run_message_bus
+from .status import devicetimer_status_router
 from .tasks import wait_for_paid_invoices
 from .views import devicetimer_generic_router
 from .views_api import devicetimer_api_router
@@ -23,6 +28,7 @@ devicetimer_ext: APIRouter = APIRouter(prefix="/devicetimer", tags=["devicetimer
 devicetimer_ext.include_router(devicetimer_generic_router)
 devicetimer_ext.include_router(devicetimer_api_router)
 devicetimer_ext.include_router(devicetimer_lnurl_router)
+devicetimer_ext.include_router(devicetimer_status_router)
 devicetimer_ext.include_router(devicetimer_websocket_router)
 
 
@@ -32,13 +38,27 @@ def devicetimer_stop():
             task.cancel()
         except Exception as ex:
             logger.warning(ex)
+    try:
+        asyncio.get_running_loop().create_task(stop_http_client())
+    except Exception as ex:
+        logger.warning(ex)
 
 
 def devicetimer_start():
     from lnbits.tasks import create_permanent_unique_task
 
+    start_http_client()
+
     task = create_permanent_unique_task("ext_devicetimer", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    rates_task = create_permanent_unique_task(
+        "ext_devicetimer_rates", refresh_exchange_rates
+    )
+    scheduled_tasks.append(rates_task)
+    bus_task = create_permanent_unique_task("ext_devicetimer_bus", run_message_bus)
+    scheduled_tasks.append(bus_task)
+    reaper_task = create_permanent_unique_task("ext_devicetimer_reaper", run_reaper)
+    scheduled_tasks.append(reaper_task)
 
 
 __all__ = [
@@ -0,0 +1,107 @@
+"""
+In-memory admission state for get_payment_allowed.
+
+Each (device, switch) pair keeps a ring buffer of the unix times of its most
+recent 'used' payments. The buffer is seeded lazily from the database and
+kept current by on_invoice_paid, so the OPEN/WAIT/CLOSED decision normally
+needs no database round trip.
+
+Payments made through other workers arrive as "used" events on the message
+bus, see routing.py. In case one is missed, or no bus is configured, states
+expire and are re-seeded from the database after ADMISSION_STATE_TTL seconds
+or the device's timeout, whichever is shorter, so a WAIT window is never
+judged from a state older than the window itself. Set ADMISSION_STATE_TTL to
+0 to always read the database.
+"""
+
+from collections import deque
+from typing import Optional
+
+from .cache import TTLCache
+from .models import PaymentAllowed
+from .settings import ADMISSION_CACHE_SIZE, ADMISSION_STATE_TTL
+
+# payments are counted against maxperday over this window
+DAY_SECONDS = 86400
+
+
+class AdmissionState:
+    """Recent 'used' payment times of one switch, oldest first"""
+
+    __slots__ = ("used",)
+
+    def __init__(self, epochs: list[int], size: int):
+        self.used: deque[int] = deque(sorted(epochs), maxlen=size)
+
+    @property
+    def size(self) -> int:
+        return self.used.maxlen or 0
+
+    def record(self, epoch: int) -> None:
+        if self.used and epoch < self.used[-1]:
+            epochs = sorted([*self.used, epoch])
+            self.used = deque(epochs, maxlen=self.size)
+        else:
+            self.used.append(epoch)
+
+    def decide(self, now: float, maxperday: int, timeout: int) -> PaymentAllowed:
+        if maxperday > 0:
+            since = now - DAY_SECONDS
+            count = 0
+            for epoch in reversed(self.used):
+                if epoch <= since:
+                    break
+                count += 1
+            if count >= maxperday:
+                return PaymentAllowed.CLOSED
+
+        if self.used and now - self.used[-1] < timeout:
+            return PaymentAllowed.WAIT
+
+        return PaymentAllowed.OPEN
+
+
+_states: TTLCache[tuple[str, str], AdmissionState] = TTLCache(
+    maxsize=ADMISSION_CACHE_SIZE, ttl=ADMISSION_STATE_TTL
+)
+
+
+def buffer_size(maxperday: Optional[int]) -> int:
+    """Number of payments needed to decide for a given maxperday"""
+    return max(maxperday or 0, 1)
+
+
+def get_state(device_id: str, switch_id: str, size: int) -> Optional[AdmissionState]:
+    """Return the cached state, or None when it has to be seeded again."""
+    state = _states.get((device_id, switch_id))
+    if state and state.size != size:
+        # maxperday changed since the state was seeded
+        _states.pop((device_id, switch_id))
+        return None
+    return state
+
+
+def state_ttl(timeout: int) -> float:
+    """Seconds a seeded state may be used for a device with this timeout"""
+    if timeout > 0:
+        return min(ADMISSION_STATE_TTL, timeout)
+    return ADMISSION_STATE_TTL
+
+
+def seed_state(
+    device_id: str, switch_id: str, epochs: list[int], size: int, timeout: int = 0
+) -> AdmissionState:
+    state = AdmissionState(epochs, size)
+    _states.set((device_id, switch_id), state, ttl=state_ttl(timeout))
+    return state
+
+
+def record_used(device_id: str, switch_id: str, epoch: int) -> None:
+    """Register a paid trigger; unseeded states pick it up from the database."""
+    state = _states.peek((device_id, switch_id))
+    if state:
+        state.record(epoch)
+
+
+def get_admission_stats() -> dict:
+    return _states.stats()
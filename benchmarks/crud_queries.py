@@ -0,0 +1,90 @@
+"""
+Database statements per scan-to-invoice flow.
+
+Runs the crud calls of one LNURL scan (lnurl_params) and its callback
+(lnurl_callback) against SQLite, once with VERIFY_WRITES, which re-reads
+every written row like crud.py used to, and once building the returned
+models from the writes:
+
+    python benchmarks/crud_queries.py [--flows 500]
+"""
+
+import argparse
+import asyncio
+from time import perf_counter
+
+from harness import FakeRequest, QueryCounter, load_extension, migrate
+
+
+async def scan_to_invoice(device_id: str, switch_id: str) -> None:
+    from devicetimer import crud
+    from devicetimer.tokens import issue_token, parse_token
+
+    # lnurl_params
+    device = await crud.get_device(device_id)
+    assert device
+    switch = device.switches[0]
+    await crud.get_payment_allowed(device, switch)
+    token = parse_token(issue_token(device.id, device.key, switch_id, 1000))
+    assert token
+    # lnurl_callback
+    device = await crud.get_device(token.device_id)
+    assert device and token.is_valid(device.key)
+    payment = await crud.reserve_payment(
+        device_id=device.id,
+        switch_id=switch_id,
+        payload="21-2100",
+        sats=token.msat,
+        payment_id=token.payment_id,
+    )
+    assert payment
+    await crud.update_payment(
+        payment_id=payment.id, payhash=f"hash-{payment.id}", status="invoiced"
+    )
+
+
+async def run(flows: int, verify: bool) -> tuple[float, float]:
+    from devicetimer import crud
+
+    crud.VERIFY_WRITES = verify
+    device = await crud.create_device(
+        crud.CreateLnurldevice(
+            title="Bench",
+            wallet="bench-wallet",
+            currency="sat",
+            available_start="00:00",
+            available_stop="23:59",
+            timeout=0,
+            timezone="UTC",
+            switches=[
+                {"amount": 1, "gpio_pin": 21, "gpio_duration": 2100, "label": "a"}
+            ],
+        ),
+        FakeRequest(),
+    )
+    switch_id = device.switches[0].id
+
+    with QueryCounter() as counter:
+        start = perf_counter()
+        for _ in range(flows):
+            await scan_to_invoice(device.id, switch_id)
+        elapsed = perf_counter() - start
+    return counter.count / flows, elapsed / flows * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--flows", type=int, default=500)
+    args = parser.parse_args()
+
+    load_extension()
+    await migrate()
+
+    print(f"{'mode':<22}{'queries/flow':>14}{'ms/flow':>10}")
+    for label, verify in (("read-after-write", True), ("built from writes", False)):
+        queries, ms = await run(args.flows, verify)
+        print(f"{label:<22}{queries:>14.1f}{ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+"""
+Cost of decoding database rows into devices and payments.
+
+Decodes the same synthetic rows into the Pydantic models, like crud.py did
+before, and into the records it uses now, and reports the time per row and
+the memory the decoded objects hold on to:
+
+    python benchmarks/decode.py [--rows 20000] [--switches 4]
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+from time import perf_counter
+from typing import Callable
+
+from harness import load_modules
+
+
+def device_row(n: int) -> dict:
+    return {
+        "id": f"device{n:06d}",
+        "key": "k" * 22,
+        "title": f"Device {n}",
+        "wallet": f"wallet{n % 50:04d}",
+        "currency": "EUR",
+        "timestamp": "2024-01-01 00:00:00",
+        "available_start": "08:00",
+        "available_stop": "20:00",
+        "timeout": 30,
+        "timezone": "Europe/Berlin",
+        "maxperday": 10,
+        "closed_url": None,
+        "wait_url": None,
+        "windows": json.dumps(
+            [{"days": [0, 1, 2, 3, 4], "start": "08:00", "stop": "20:00"}]
+        ),
+        "holidays": json.dumps(["2024-12-25"]),
+    }
+
+
+LNURL = "LNURL1DP68GURN8GHJ7MRWW4EXCTNXD9SHG6NPVCHXXMMD9AKXUATJDSKHQCTE8AEK2UMND9HKU0"
+
+
+def switch_rows(n: int, count: int) -> list[dict]:
+    return [
+        {
+            "device_id": f"device{n:06d}",
+            "switch_id": f"switch{n:06d}{i}",
+            "position": i,
+            "amount": 1.5,
+            "gpio_pin": 21 + i,
+            "gpio_duration": 2100,
+            "lnurl": LNURL,
+            "label": f"Switch {i}",
+            "trigger_ttl": 60,
+        }
+        for i in range(count)
+    ]
+
+
+def payment_row(n: int) -> dict:
+    return {
+        "id": f"payment{n:015d}",
+        "deviceid": f"device{n % 1000:06d}",
+        "payhash": f"{n:064x}",
+        "payload": "21-2100",
+        "switchid": f"switch{n % 1000:06d}0",
+        "sats": 1500,
+        "status": "used",
+        "epoch": 1700000000 + n,
+        "delivery": "delivered",
+        "latency_ms": 42,
+        "timestamp": "2024-01-01 00:00:00",
+    }
+
+
+def model_device(row: dict, switches: list[dict]):
+    from devicetimer.models import Lnurldevice
+
+    return Lnurldevice(
+        **{
+            **row,
+            "switches": [{**s, "id": s["switch_id"]} for s in switches],
+            "windows": json.loads(row["windows"]),
+            "holidays": json.loads(row["holidays"]),
+        }
+    )
+
+
+def record_device(row: dict, switches: list[dict]):
+    from devicetimer.records import DeviceRecord, SwitchRecord
+
+    return DeviceRecord.from_row(row, [SwitchRecord.from_row(s) for s in switches])
+
+
+def measure(decode: Callable[[], list]) -> tuple[float, float]:
+    """Seconds to decode, and bytes the decoded objects retain"""
+    gc.collect()
+    start = perf_counter()
+    decode()
+    elapsed = perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = decode()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return elapsed, retained
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--switches", type=int, default=4)
+    args = parser.parse_args()
+
+    load_modules()
+    from devicetimer.models import LnurldevicePayment
+    from devicetimer.records import PaymentRecord
+
+    devices = [
+        (device_row(n), switch_rows(n, args.switches)) for n in range(args.rows)
+    ]
+    payments = [payment_row(n) for n in range(args.rows)]
+
+    cases = {
+        "device": {
+            "pydantic": lambda: [model_device(r, s) for r, s in devices],
+            "record": lambda: [record_device(r, s) for r, s in devices],
+        },
+        "payment": {
+            "pydantic": lambda: [LnurldevicePayment(**r) for r in payments],
+            "record": lambda: [PaymentRecord.from_row(r) for r in payments],
+        },
+    }
+
+    print(f"{'row':<10}{'decoder':<10}{'us/row':>10}{'bytes/row':>12}")
+    for kind, decoders in cases.items():
+        for label, decode in decoders.items():
+            elapsed, retained = measure(decode)
+            print(
+                f"{kind:<10}{label:<10}{elapsed / args.rows * 1e6:>10.2f}"
+                f"{retained / args.rows:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Shared setup for the DeviceTimer benchmarks.
+
+The benchmarks need an LNbits installation (`pip install lnbits`). They load
+this repository as the `devicetimer` package against a throw-away SQLite
+data folder and run the extension's migrations on it. Benchmarks of modules
+that do not touch LNbits use `load_modules` instead, which only needs the
+extension's own dependencies.
+"""
+
+import importlib.util
+import inspect
+import os
+import sys
+import tempfile
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def load_extension(data_folder: str = "") -> ModuleType:
+    """Import the extension as `devicetimer` with a temporary database"""
+    os.environ.setdefault(
+        "LNBITS_DATA_FOLDER", data_folder or tempfile.mkdtemp(prefix="devicetimer-")
+    )
+    if "devicetimer" in sys.modules:
+        return sys.modules["devicetimer"]
+    spec = importlib.util.spec_from_file_location(
+        "devicetimer", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)]
+    )
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["devicetimer"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_modules() -> ModuleType:
+    """Make `devicetimer.<module>` importable without running __init__.py"""
+    if "devicetimer" in sys.modules:
+        return sys.modules["devicetimer"]
+    module = ModuleType("devicetimer")
+    module.__path__ = [str(ROOT)]
+    sys.modules["devicetimer"] = module
+    return module
+
+
+async def migrate() -> None:
+    """Run all migrations of the extension in order"""
+    from devicetimer import migrations
+    from devicetimer.crud import db
+
+    steps = [
+        fn
+        for name, fn in inspect.getmembers(migrations, inspect.iscoroutinefunction)
+        if name[0] == "m" and name[1:4].isdigit()
+    ]
+    for step in sorted(steps, key=lambda fn: fn.__name__):
+        await step(db)
+
+
+class QueryCounter:
+    """
+    Counts the statements the extension sends to its database, at the
+    connection level so statements on explicitly opened connections count
+    too. The ATTACH or CREATE SCHEMA every new connection starts with does
+    not count.
+    """
+
+    def __init__(self):
+        from lnbits.db import Connection
+
+        self.connection = Connection
+        self.count = 0
+        self._originals: dict = {}
+
+    def __enter__(self) -> "QueryCounter":
+        for name in ("execute", "fetchone", "fetchall"):
+            original = getattr(self.connection, name)
+            self._originals[name] = original
+
+            async def counted(conn, query, *args, _original=original, **kwargs):
+                if not query.startswith(("ATTACH", "CREATE SCHEMA")):
+                    self.count += 1
+                return await _original(conn, query, *args, **kwargs)
+
+            setattr(self.connection, name, counted)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for name, original in self._originals.items():
+            setattr(self.connection, name, original)
+        self._originals.clear()
+
+
+class FakeRequest:
+    """Just enough of a Starlette Request for crud.create_device"""
+
+    base_url = "https://lnbits.example.com/devicetimer"
+
+    def url_for(self, name: str, **params) -> str:
+        return f"{self.base_url}/api/v2/lnurl/{params['device_id']}"
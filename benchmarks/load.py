@@ -0,0 +1,300 @@
+"""
+End-to-end load test of the scan to relay pipeline.
+
+Serves the extension with uvicorn against SQLite, with the LNbits core
+stubbed out: create_invoice returns a fake invoice, get_fiat_rate_satoshis
+a fixed rate, and register_invoice_listener hands us the queue that paid
+invoices arrive on. Simulated protocol 2 hardware keeps a WebSocket open
+per device, answers pings and ACKs triggers. Each flow then
+
+    scans      GET /api/v2/lnurl/{device_id}
+    requests   GET the callback for the invoice
+    pays       puts the paid invoice on the listener queue
+    waits      for the trigger to reach the device's socket
+
+with `--concurrency` flows in flight. Reports latency percentiles per
+stage, HTTP requests and flows per second, and database statements per
+flow, and compares them with a saved baseline:
+
+    python benchmarks/load.py [--devices 50] [--flows 2000] [--concurrency 64]
+    python benchmarks/load.py --save-baseline
+
+Besides LNbits this needs uvicorn, httpx and websockets, which LNbits
+installs. The LNURL rate limits are off unless --ratelimit is given.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+from hashlib import sha256
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+from typing import NamedTuple, Optional
+
+import httpx
+import uvicorn
+import websockets
+from fastapi import FastAPI
+from loguru import logger
+
+from harness import FakeRequest, QueryCounter, load_extension, migrate
+
+BASELINE = Path(__file__).with_name("baseline.json")
+STAGES = ("scan", "callback", "trigger", "flow")
+
+# satoshis per unit of any fiat currency
+FIAT_RATE = 2500.0
+
+
+class Invoice(NamedTuple):
+    payment_hash: str
+    bolt11: str
+
+
+class StubbedCore:
+    """The parts of the LNbits core the pipeline talks to"""
+
+    def __init__(self):
+        self.invoices: dict[str, dict] = {}
+        self.paid: Optional[asyncio.Queue] = None
+
+    async def create_invoice(self, *, wallet_id: str, amount: int, extra: dict, **_):
+        payment_hash = sha256(extra["id"].encode()).hexdigest()
+        self.invoices[payment_hash] = extra
+        return Invoice(payment_hash, f"lnbcrt{amount}n1{payment_hash}")
+
+    async def get_fiat_rate_satoshis(self, currency: str) -> float:
+        return FIAT_RATE
+
+    def register_invoice_listener(self, queue: asyncio.Queue, name: str) -> None:
+        self.paid = queue
+
+    def pay(self, bolt11: str) -> str:
+        """Settle an invoice, returns the payment id the trigger will carry"""
+        payment_hash = bolt11[-64:]
+        extra = self.invoices.pop(payment_hash)
+        assert self.paid, "wait_for_paid_invoices is not running"
+        self.paid.put_nowait(SimpleNamespace(payment_hash=payment_hash, extra=extra))
+        return extra["id"]
+
+
+class Hardware:
+    """A protocol 2 device: ACKs triggers and answers pings"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.waiting: dict[str, asyncio.Future] = {}
+        self.ready = asyncio.Event()
+
+    def expect(self, payment_id: str) -> asyncio.Future:
+        return self.waiting.setdefault(
+            payment_id, asyncio.get_running_loop().create_future()
+        )
+
+    @staticmethod
+    def reply(kind: str, message_id: str) -> str:
+        return json.dumps({"v": 2, "type": kind, "id": message_id})
+
+    async def run(self) -> None:
+        async with websockets.connect(self.url) as ws:
+            self.ready.set()
+            async for data in ws:
+                message = json.loads(data)
+                if message.get("type") == "ping":
+                    await ws.send(self.reply("pong", message["id"]))
+                elif message.get("type") == "trigger":
+                    await ws.send(self.reply("ack", message["id"]))
+                    future = self.expect(message["id"])
+                    if not future.done():
+                        future.set_result(perf_counter())
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def create_devices(count: int) -> list[tuple[str, str]]:
+    from devicetimer import crud
+
+    devices = []
+    for n in range(count):
+        device = await crud.create_device(
+            crud.CreateLnurldevice(
+                title=f"Load {n}",
+                wallet=f"load-wallet-{n % 10}",
+                currency="EUR" if n % 2 else "sat",
+                available_start="00:00",
+                available_stop="23:59",
+                timeout=0,
+                timezone="UTC",
+                switches=[
+                    {"amount": 1, "gpio_pin": 21, "gpio_duration": 100, "label": "a"}
+                ],
+            ),
+            FakeRequest(),
+        )
+        devices.append((device.id, device.switches[0].id))
+    return devices
+
+
+async def flow(
+    client,
+    core: StubbedCore,
+    hardware: Hardware,
+    device_id: str,
+    switch_id: str,
+    timings: dict[str, list[float]],
+) -> None:
+    start = perf_counter()
+    response = await client.get(
+        f"/devicetimer/api/v2/lnurl/{device_id}", params={"switch_id": switch_id}
+    )
+    params = response.json()
+    assert params.get("tag") == "payRequest", params
+    scanned = perf_counter()
+
+    response = await client.get(
+        params["callback"], params={"amount": params["minSendable"]}
+    )
+    invoice = response.json()
+    assert "pr" in invoice, invoice
+    invoiced = perf_counter()
+
+    payment_id = core.pay(invoice["pr"])
+    triggered = await asyncio.wait_for(hardware.expect(payment_id), 30)
+    del hardware.waiting[payment_id]
+    timings["scan"].append((scanned - start) * 1000)
+    timings["callback"].append((invoiced - scanned) * 1000)
+    timings["trigger"].append((triggered - invoiced) * 1000)
+    timings["flow"].append((triggered - start) * 1000)
+
+
+async def run(args) -> dict:
+    load_extension()
+    await migrate()
+    logger.disable("devicetimer")
+
+    from devicetimer import devicetimer_ext, lnurl, rates, tasks
+    from devicetimer.helpers import percentile
+
+    core = StubbedCore()
+    lnurl.create_invoice = core.create_invoice
+    rates.get_fiat_rate_satoshis = core.get_fiat_rate_satoshis
+    tasks.register_invoice_listener = core.register_invoice_listener
+
+    app = FastAPI()
+    app.include_router(devicetimer_ext)
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    background = [
+        asyncio.create_task(server.serve()),
+        asyncio.create_task(tasks.wait_for_paid_invoices()),
+    ]
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    devices = await create_devices(args.devices)
+    hardware = {
+        device_id: Hardware(
+            f"ws://127.0.0.1:{port}/devicetimer/api/v1/ws/{device_id}?protocol=2"
+        )
+        for device_id, _ in devices
+    }
+    background += [asyncio.create_task(h.run()) for h in hardware.values()]
+    await asyncio.gather(*(h.ready.wait() for h in hardware.values()))
+
+    timings: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited(n: int) -> None:
+        device_id, switch_id = devices[n % len(devices)]
+        async with slots:
+            await flow(client, core, hardware[device_id], device_id, switch_id, timings)
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits
+    ) as client:
+        with QueryCounter() as counter:
+            start = perf_counter()
+            await asyncio.gather(*(limited(n) for n in range(args.flows)))
+            elapsed = perf_counter() - start
+
+    server.should_exit = True
+    for task in background[1:]:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    latency = {}
+    for stage, values in timings.items():
+        values.sort()
+        latency[stage] = {
+            f"p{q}": round(percentile(values, q / 100), 2) for q in (50, 95, 99)
+        }
+    return {
+        "devices": args.devices,
+        "flows": args.flows,
+        "concurrency": args.concurrency,
+        "requests_per_s": round(2 * args.flows / elapsed, 1),
+        "flows_per_s": round(args.flows / elapsed, 1),
+        "queries_per_flow": round(counter.count / args.flows, 2),
+        "latency_ms": latency,
+    }
+
+
+def report(results: dict, baseline: Optional[dict]) -> None:
+    def change(value: float, before: Optional[float]) -> str:
+        if not before:
+            return ""
+        return f"{(value - before) / before * 100:+.1f}%"
+
+    rows = [
+        (key, results[key], (baseline or {}).get(key))
+        for key in ("requests_per_s", "flows_per_s", "queries_per_flow")
+    ]
+    for stage in STAGES:
+        for q, value in results["latency_ms"][stage].items():
+            before = (baseline or {}).get("latency_ms", {}).get(stage, {}).get(q)
+            rows.append((f"{stage} {q} ms", value, before))
+
+    print(f"{'metric':<20}{'value':>12}{'baseline':>12}{'change':>10}")
+    for name, value, before in rows:
+        shown = "" if before is None else before
+        print(f"{name:<20}{value:>12}{shown:>12}{change(value, before):>10}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--flows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--ratelimit", action="store_true")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    if not args.ratelimit:
+        # every flow comes from 127.0.0.1
+        os.environ.setdefault("DEVICETIMER_LNURL_IP_RATE", "0")
+        os.environ.setdefault("DEVICETIMER_LNURL_SWITCH_RATE", "0")
+
+    results = await run(args)
+    baseline = None
+    if args.baseline.exists() and not args.save_baseline:
+        baseline = json.loads(args.baseline.read_text())
+    report(results, baseline)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"saved baseline to {args.baseline}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
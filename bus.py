@@ -0,0 +1,288 @@
+"""
+Message buses connecting the workers of a multi-process deployment.
+
+Every worker only holds the WebSockets that landed on it. Events such as
+"trigger this device" are broadcast over a bus and acted on by the worker
+that owns the socket, see routing.py. Backends:
+
+inprocess (default): a single worker, nothing is ever broadcast.
+sqlite: several workers on one host share an event table in a local
+    SQLite file that every worker polls.
+postgres: Postgres LISTEN/NOTIFY on the LNbits database. Events must stay
+    below 8000 bytes, larger presence snapshots are split (routing.py).
+"""
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+from abc import ABC, abstractmethod
+from time import time
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+from loguru import logger
+
+from .settings import (
+    BUS_POLL_INTERVAL,
+    BUS_PRESENCE_INTERVAL,
+    BUS_RECONNECT_DELAY,
+    BUS_RECONNECT_MAX_DELAY,
+    BUS_RETENTION,
+)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+CHANNEL = "devicetimer"
+# payloads of Postgres NOTIFY must be shorter than this
+NOTIFY_MAX_BYTES = 8000
+
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}"
+
+
+class MessageBus(ABC):
+    """Broadcasts JSON events to all other workers"""
+
+    def __init__(self):
+        self.worker_id = new_worker_id()
+        self._handler: Optional[EventHandler] = None
+
+    async def start(self, handler: EventHandler) -> None:
+        self._handler = handler
+
+    async def stop(self) -> None:
+        self._handler = None
+
+    @abstractmethod
+    async def publish(self, event: dict) -> None:
+        """Deliver `event` to every other worker"""
+
+    async def _dispatch(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.get("origin") == self.worker_id or not self._handler:
+            return
+        try:
+            await self._handler(event)
+        except Exception as e:
+            logger.warning(f"Failed to handle bus event {event.get('type')}: {e}")
+
+    def _encode(self, event: dict) -> str:
+        return json.dumps({**event, "origin": self.worker_id})
+
+
+class InProcessBus(MessageBus):
+    """Single worker, there is nobody to publish to"""
+
+    async def publish(self, event: dict) -> None:
+        return None
+
+
+class SQLiteBus(MessageBus):
+    """Workers on one host exchanging events through a shared SQLite file"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._last_id = 0
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+            """
+        )
+        conn.commit()
+        return conn
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+
+    async def start(self, handler: EventHandler) -> None:
+        await super().start(handler)
+        self._conn = await asyncio.to_thread(self._connect)
+        row = await self._run(
+            lambda: self._conn.execute("SELECT MAX(id) FROM events").fetchone()
+        )
+        self._last_id = row[0] or 0
+        self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+        await super().stop()
+
+    async def publish(self, event: dict) -> None:
+        assert self._conn, "SQLiteBus is not started"
+        payload = self._encode(event)
+
+        def _insert():
+            self._conn.execute(
+                "INSERT INTO events (created, payload) VALUES (?, ?)",
+                (time(), payload),
+            )
+            self._conn.commit()
+
+        await self._run(_insert)
+
+    async def _poll(self) -> None:
+        last_prune = time()
+        while True:
+            try:
+                rows = await self._run(
+                    lambda: self._conn.execute(
+                        "SELECT id, payload FROM events WHERE id > ? ORDER BY id",
+                        (self._last_id,),
+                    ).fetchall()
+                )
+                for event_id, payload in rows:
+                    self._last_id = event_id
+                    await self._dispatch(payload)
+                if time() - last_prune > BUS_RETENTION:
+                    await self._run(self._prune)
+                    last_prune = time()
+            except Exception as e:
+                logger.warning(f"SQLite bus poll failed: {e}")
+            await asyncio.sleep(BUS_POLL_INTERVAL)
+
+    def _prune(self) -> None:
+        self._conn.execute(
+            "DELETE FROM events WHERE created < ?", (time() - BUS_RETENTION,)
+        )
+        self._conn.commit()
+
+
+class PostgresBus(MessageBus):
+    """
+    Workers sharing the LNbits Postgres database, using LISTEN/NOTIFY. A lost
+    connection is re-established with backoff and LISTENs again; events
+    published meanwhile are missed, the next presence snapshots recover.
+    """
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._lost = asyncio.Event()
+        self._watchdog: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, handler: EventHandler) -> None:
+        await super().start(handler)
+        await self._connect()
+        self._watchdog = asyncio.create_task(self._keep_connected())
+
+    async def _connect(self) -> None:
+        import asyncpg
+
+        conn = await asyncpg.connect(self.dsn)
+        conn.add_termination_listener(self._on_terminated)
+        await conn.add_listener(CHANNEL, self._on_notify)
+        self._conn = conn
+
+    def _on_terminated(self, conn) -> None:
+        if conn is self._conn:
+            self._lost.set()
+
+    async def _alive(self) -> bool:
+        # a half-open connection never reports its termination
+        try:
+            async with self._lock:
+                await asyncio.wait_for(
+                    self._conn.execute("SELECT 1"), BUS_PRESENCE_INTERVAL
+                )
+            return True
+        except Exception:
+            return False
+
+    async def _keep_connected(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), BUS_PRESENCE_INTERVAL)
+            except asyncio.TimeoutError:
+                if await self._alive():
+                    continue
+            logger.warning("Postgres bus connection lost, reconnecting")
+            self._lost.clear()
+            conn, self._conn = self._conn, None
+            if conn:
+                conn.terminate()
+            delay = BUS_RECONNECT_DELAY
+            while not self._conn:
+                try:
+                    await self._connect()
+                except Exception as e:
+                    logger.warning(
+                        f"Postgres bus reconnect failed, retrying in {delay:g}s: {e}"
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, BUS_RECONNECT_MAX_DELAY)
+            logger.info("Postgres bus reconnected")
+
+    def _on_notify(self, _conn, _pid, _channel, payload: str) -> None:
+        task = asyncio.create_task(self._dispatch(payload))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self) -> None:
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self._conn:
+            await self._conn.close()
+            self._conn = None
+        await super().stop()
+
+    async def publish(self, event: dict) -> None:
+        if not self._conn:
+            raise ConnectionError("PostgresBus is not connected")
+        payload = self._encode(event)
+        size = len(payload.encode())
+        if size >= NOTIFY_MAX_BYTES:
+            raise ValueError(f"{size} byte event exceeds the NOTIFY payload limit")
+        async with self._lock:
+            await self._conn.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+
+
+def postgres_dsn() -> str:
+    """asyncpg DSN of the LNbits Postgres database"""
+    from lnbits.db import DB_TYPE, POSTGRES
+    from lnbits.settings import settings
+    from sqlalchemy.engine import make_url
+
+    if DB_TYPE != POSTGRES or not settings.lnbits_database_url:
+        raise ValueError("the postgres bus needs LNbits to run on Postgres")
+    url = make_url(settings.lnbits_database_url).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+
+def create_bus(backend: str) -> MessageBus:
+    """Instantiate the configured bus backend"""
+    from lnbits.settings import settings
+
+    if backend == "sqlite":
+        path = os.path.join(settings.lnbits_data_folder, "devicetimer_bus.sqlite3")
+        return SQLiteBus(path)
+    if backend == "postgres":
+        return PostgresBus(postgres_dsn())
+    return InProcessBus()
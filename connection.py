@@ -0,0 +1,154 @@
+"""
+Per-connection outbound queues for device and browser WebSockets.
+
+Every accepted WebSocket is wrapped in a DeviceConnection that owns a bounded
+queue and a writer task draining it. Producers such as on_invoice_paid only
+enqueue, so a slow consumer can never block them, and the memory held per
+connection is bounded by the queue size.
+"""
+
+import asyncio
+from enum import Enum
+from time import monotonic
+from typing import Callable, Optional
+
+from fastapi import WebSocket
+from loguru import logger
+
+from .settings import WS_SEND_TIMEOUT
+
+
+class OverflowPolicy(Enum):
+    # discard the oldest queued message, fine for UI notifications
+    DROP_OLDEST = "drop_oldest"
+    # never discard a queued message; a peer that cannot keep up is closed
+    NEVER_DROP = "never_drop"
+
+
+class DeviceConnection:
+    """A WebSocket with a bounded outbound queue and a dedicated writer"""
+
+    __slots__ = (
+        "websocket",
+        "device_id",
+        "client_type",
+        "protocol",
+        "policy",
+        "queue",
+        "dropped",
+        "closed",
+        "last_seen",
+        "rtt_ms",
+        "pong",
+        "_writer",
+        "_on_close",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        device_id: str,
+        client_type: str,
+        policy: OverflowPolicy,
+        maxsize: int,
+        on_close: Optional[Callable[["DeviceConnection"], None]] = None,
+        protocol: int = 1,
+    ):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.client_type = client_type
+        # 1: plain "pin-duration" triggers, 2: JSON triggers with ACKs
+        self.protocol = protocol
+        self.policy = policy
+        self.queue: asyncio.Queue[tuple[str, Optional[asyncio.Future]]] = (
+            asyncio.Queue(maxsize=maxsize)
+        )
+        self.dropped = 0
+        self.closed = False
+        # monotonic time anything was last received from the peer
+        self.last_seen = monotonic()
+        self.rtt_ms: Optional[float] = None
+        # (ping id, future) of the heartbeat ping awaiting its pong
+        self.pong: Optional[tuple[str, asyncio.Future]] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._on_close = on_close
+
+    @property
+    def peer(self) -> str:
+        client = self.websocket.client
+        return f"{client.host}:{client.port}" if client else "unknown"
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, message: str, sent: Optional[asyncio.Future] = None) -> bool:
+        """
+        Queue a message without waiting. `sent`, if given, resolves to True
+        once the message was written and to False if it never will be.
+        Returns False when the message was not accepted.
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((message, sent))
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy == OverflowPolicy.DROP_OLDEST:
+            _, dropped = self.queue.get_nowait()
+            self._resolve(dropped, False)
+            self.dropped += 1
+            self.queue.put_nowait((message, sent))
+            return True
+
+        logger.warning(
+            f"Outbound queue full for {self.client_type} {self.peer} "
+            f"of device {self.device_id}, closing"
+        )
+        self.close()
+        return False
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                message, sent = await self.queue.get()
+                try:
+                    await asyncio.wait_for(
+                        self.websocket.send_text(message), WS_SEND_TIMEOUT
+                    )
+                except BaseException:
+                    self._resolve(sent, False)
+                    raise
+                self._resolve(sent, True)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug(
+                f"Failed to send to {self.client_type} {self.peer}: "
+                f"{str(e) or type(e).__name__}"
+            )
+        finally:
+            self.close()
+            try:
+                await asyncio.wait_for(self.websocket.close(), WS_SEND_TIMEOUT)
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        """Stop the writer and fail everything still queued"""
+        if self.closed:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            _, sent = self.queue.get_nowait()
+            self._resolve(sent, False)
+        if self._writer and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if self._on_close:
+            self._on_close(self)
+
+    @staticmethod
+    def _resolve(sent: Optional[asyncio.Future], value: bool) -> None:
+        if sent is not None and not sent.done():
+            sent.set_result(value)
@@ -1,31 +1,126 @@
+import base64
 import json
+import sqlite3
+from dataclasses import replace
+from time import time
 from typing import Optional
 
 import shortuuid
 from fastapi import Request
 from loguru import logger
 
-from lnbits.db import Database
+from lnbits.db import SQLITE, Database
 from lnbits.helpers import urlsafe_short_hash
 
+from . import admission
+from .cache import TTLCache
 from .helpers import encode_lnurl, is_valid_lnurl
 from .models import (
     CreateLnurldevice,
-    Lnurldevice,
     LnurldeviceSwitch,
-    LnurldevicePayment,
+    LnurldeviceSummary,
+    LnurldeviceTrigger,
     PaymentAllowed,
 )
-
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from time import time
-import re
+from .records import DeviceRecord, PaymentRecord, SwitchRecord
+from .schedule import CompiledSchedule, compile_schedule
+from .settings import (
+    DEVICE_CACHE_SIZE,
+    DEVICE_CACHE_TTL,
+    VERIFY_WRITES,
+    WALLET_INDEX_SIZE,
+)
 
 db = Database("ext_devicetimer")
 
+# UPDATE ... RETURNING needs SQLite 3.35, Postgres has always had it
+_supports_returning = db.type != SQLITE or sqlite3.sqlite_version_info >= (3, 35)
+
+
+async def _write_returning(query: str, params: dict, conn=None) -> Optional[dict]:
+    """
+    Run an INSERT or UPDATE and return the written row in the same round
+    trip. Returns None when the database cannot, or no row was written.
+    """
+    if not _supports_returning:
+        await (conn or db).execute(query, params)
+        return None
+    async with db.reuse_conn(conn) if conn else db.connect() as conn:
+        row = await conn.fetchone(f"{query} RETURNING *", params)
+        # LNbits only commits in execute(), the write would be rolled back
+        await conn.conn.commit()
+    return dict(row) if row else None
+
+
+def _verify_write(kind: str, written, stored) -> None:
+    """With VERIFY_WRITES, compare a record built from a write to its row"""
+    if stored is None:
+        logger.error(f"{kind} {written.id} was written but could not be read")
+    # the timestamp column is filled by the database
+    elif replace(written, timestamp=stored.timestamp) != stored:
+        logger.error(f"{kind} {written.id} differs from its row: {stored}")
+
+
+# Parsed devices by id, invalidated by create/update/delete_device
+_device_cache: TTLCache[str, DeviceRecord] = TTLCache(
+    maxsize=DEVICE_CACHE_SIZE, ttl=DEVICE_CACHE_TTL
+)
+
+
+# wallet id -> device ids, filled lazily per wallet and kept current by
+# create/update/delete_device. Entries expire like cached devices, so changes
+# made on another worker show up within DEVICE_CACHE_TTL.
+_wallet_devices: TTLCache[str, set[str]] = TTLCache(
+    maxsize=WALLET_INDEX_SIZE, ttl=DEVICE_CACHE_TTL
+)
+
+
+def get_device_cache_stats() -> dict:
+    """Return hit/miss counters of the device cache"""
+    return _device_cache.stats()
+
+
+def _index_device(device_id: str, wallet: Optional[str]) -> None:
+    for device_ids in _wallet_devices.values():
+        device_ids.discard(device_id)
+    device_ids = _wallet_devices.peek(wallet) if wallet else None
+    if device_ids is not None:
+        device_ids.add(device_id)
+
+
+def _bind_list(prefix: str, values: list) -> tuple[str, dict]:
+    """Placeholders and parameters for an IN (...) list"""
+    params = {f"{prefix}{i}": value for i, value in enumerate(values)}
+    return ", ".join(f":{key}" for key in params), params
+
+
+async def get_device_ids_by_wallets(wallet_ids: list[str]) -> set[str]:
+    """Ids of the devices of the given wallets, served from an index"""
+    device_ids: set[str] = set()
+    missing = []
+    for wallet in wallet_ids:
+        cached = _wallet_devices.get(wallet)
+        if cached is None:
+            missing.append(wallet)
+        else:
+            device_ids |= cached
+    if missing:
+        placeholders, params = _bind_list("w", missing)
+        rows = await db.fetchall(
+            f"""SELECT id, wallet FROM devicetimer.device
+                WHERE wallet IN ({placeholders})""",
+            params,
+        )
+        fetched: dict[str, set[str]] = {wallet: set() for wallet in missing}
+        for row in rows:
+            fetched[row["wallet"]].add(row["id"])
+        for wallet, wallet_device_ids in fetched.items():
+            _wallet_devices.set(wallet, wallet_device_ids)
+            device_ids |= wallet_device_ids
+    return device_ids
 
-async def create_device(data: CreateLnurldevice, req: Request) -> Lnurldevice:
+
+async def create_device(data: CreateLnurldevice, req: Request) -> DeviceRecord:
     logger.debug("create_device")
     device_id = urlsafe_short_hash()
     device_key = urlsafe_short_hash()
@@ -42,49 +137,56 @@ async def create_device(data: CreateLnurldevice, req: Request) -> Lnurldevice:
         [s.dict() for s in data.switches] if data.switches else []
     )
 
-    await db.execute(
-        """
-        INSERT INTO devicetimer.device
-        (id, key, title, wallet, currency, available_start, available_stop,
-         timeout, timezone, closed_url, wait_url, maxperday, switches)
-        VALUES (:id, :key, :title, :wallet, :currency, :available_start,
-                :available_stop, :timeout, :timezone, :closed_url, :wait_url,
-                :maxperday, :switches)
-        """,
-        {
-            "id": device_id,
-            "key": device_key,
-            "title": data.title,
-            "wallet": data.wallet,
-            "currency": data.currency,
-            "available_start": data.available_start,
-            "available_stop": data.available_stop,
-            "timeout": data.timeout,
-            "timezone": data.timezone,
-            "closed_url": data.closed_url,
-            "wait_url": data.wait_url,
-            "maxperday": data.maxperday or 0,
-            "switches": switches_json,
-        },
-    )
+    values = {
+        "id": device_id,
+        "key": device_key,
+        "title": data.title,
+        "wallet": data.wallet,
+        "currency": data.currency,
+        "available_start": data.available_start,
+        "available_stop": data.available_stop,
+        "timeout": data.timeout,
+        "timezone": data.timezone,
+        "closed_url": data.closed_url,
+        "wait_url": data.wait_url,
+        "maxperday": data.maxperday or 0,
+        "switches": switches_json,
+        "windows": json.dumps([w.dict() for w in data.windows or []]),
+        "holidays": json.dumps(data.holidays or []),
+    }
+    switches = data.switches or []
+    async with db.connect() as conn:
+        row = await _write_returning(
+            """
+            INSERT INTO devicetimer.device
+            (id, key, title, wallet, currency, available_start, available_stop,
+             timeout, timezone, closed_url, wait_url, maxperday, switches,
+             windows, holidays)
+            VALUES (:id, :key, :title, :wallet, :currency, :available_start,
+                    :available_stop, :timeout, :timezone, :closed_url, :wait_url,
+                    :maxperday, :switches, :windows, :holidays)
+            """,
+            values,
+            conn,
+        )
+        await _replace_switches(conn, device_id, switches)
 
-    device = await get_device(device_id)
-    assert device, "Lnurldevice was created but could not be retrieved"
-    return device
+    _index_device(device_id, data.wallet)
+    return await _cache_written_device(row or values, switches)
 
 
 async def update_device(
     device_id: str, data: CreateLnurldevice, req: Request
-) -> Lnurldevice:
+) -> DeviceRecord:
     if data.switches:
         base_url = str(req.url_for("devicetimer.lnurl_v2_params", device_id=device_id))
         for _switch in data.switches:
             if _switch.id is None:
                 _switch.id = shortuuid.uuid()[:8]
 
-            # Always regenerate LNURL if missing or invalid
-            if not is_valid_lnurl(_switch.lnurl):
-                full_url = f"{base_url}?switch_id={_switch.id}"
+            # Regenerate the LNURL if missing, invalid or pointing elsewhere
+            full_url = f"{base_url}?switch_id={_switch.id}"
+            if not is_valid_lnurl(_switch.lnurl, full_url):
                 _switch.lnurl = encode_lnurl(full_url)
                 logger.debug(f"Regenerated LNURL for switch {_switch.id}: {_switch.lnurl[:20]}...")
 
@@ -92,82 +194,302 @@ async def update_device(
         [s.dict() for s in data.switches] if data.switches else []
     )
 
-    await db.execute(
-        """
-        UPDATE devicetimer.device SET
-            title = :title,
-            wallet = :wallet,
-            currency = :currency,
-            available_start = :available_start,
-            available_stop = :available_stop,
-            timeout = :timeout,
-            timezone = :timezone,
-            closed_url = :closed_url,
-            maxperday = :maxperday,
-            wait_url = :wait_url,
-            switches = :switches
-        WHERE id = :id
-        """,
-        {
-            "title": data.title,
-            "wallet": data.wallet,
-            "currency": data.currency,
-            "available_start": data.available_start,
-            "available_stop": data.available_stop,
-            "timeout": data.timeout,
-            "timezone": data.timezone,
-            "closed_url": data.closed_url,
-            "maxperday": data.maxperday or 0,
-            "wait_url": data.wait_url,
-            "switches": switches_json,
-            "id": device_id,
-        },
-    )
+    switches = data.switches or []
+    async with db.connect() as conn:
+        row = await _write_returning(
+            """
+            UPDATE devicetimer.device SET
+                title = :title,
+                wallet = :wallet,
+                currency = :currency,
+                available_start = :available_start,
+                available_stop = :available_stop,
+                timeout = :timeout,
+                timezone = :timezone,
+                closed_url = :closed_url,
+                maxperday = :maxperday,
+                wait_url = :wait_url,
+                switches = :switches,
+                windows = :windows,
+                holidays = :holidays
+            WHERE id = :id
+            """,
+            {
+                "title": data.title,
+                "wallet": data.wallet,
+                "currency": data.currency,
+                "available_start": data.available_start,
+                "available_stop": data.available_stop,
+                "timeout": data.timeout,
+                "timezone": data.timezone,
+                "closed_url": data.closed_url,
+                "maxperday": data.maxperday or 0,
+                "wait_url": data.wait_url,
+                "switches": switches_json,
+                "windows": json.dumps([w.dict() for w in data.windows or []]),
+                "holidays": json.dumps(data.holidays or []),
+                "id": device_id,
+            },
+            conn,
+        )
+        if row or not _supports_returning:
+            await _replace_switches(conn, device_id, switches)
+
+    _index_device(device_id, data.wallet)
+    if row:
+        return await _cache_written_device(row, switches)
+    # no RETURNING, the key and timestamp were not written here
+    _device_cache.pop(device_id)
     device = await get_device(device_id)
     assert device, "Lnurldevice was updated but could not be retrieved"
     return device
 
 
-def _parse_device(row) -> Lnurldevice:
-    """Parse a database row into a Lnurldevice model"""
-    data = dict(row)
-    # Parse switches from JSON string
-    if data.get("switches") and isinstance(data["switches"], str):
-        try:
-            switches_data = json.loads(data["switches"])
-            data["switches"] = [LnurldeviceSwitch(**s) for s in switches_data]
-        except (json.JSONDecodeError, TypeError):
-            data["switches"] = []
-    elif not data.get("switches"):
-        data["switches"] = []
-    return Lnurldevice(**data)
+async def _cache_written_device(
+    row: dict, switches: list[LnurldeviceSwitch]
+) -> DeviceRecord:
+    """Decode a device from the row just written and cache it"""
+    device = _parse_device(row, [SwitchRecord.from_model(s) for s in switches])
+    if VERIFY_WRITES:
+        _device_cache.pop(device.id)
+        _verify_write("Lnurldevice", device, await get_device(device.id))
+    _device_cache.set(device.id, device)
+    return device
+
+
+async def _replace_switches(
+    conn, device_id: str, switches: list[LnurldeviceSwitch]
+) -> None:
+    """Store a device's switches in the switch table, in their order"""
+    await conn.execute(
+        "DELETE FROM devicetimer.switch WHERE device_id = :device_id",
+        {"device_id": device_id},
+    )
+    for position, switch in enumerate(switches):
+        await conn.execute(
+            """
+            INSERT INTO devicetimer.switch
+            (device_id, switch_id, position, amount, gpio_pin, gpio_duration,
+             lnurl, label, trigger_ttl)
+            VALUES (:device_id, :switch_id, :position, :amount, :gpio_pin,
+                    :gpio_duration, :lnurl, :label, :trigger_ttl)
+            """,
+            {
+                "device_id": device_id,
+                "switch_id": switch.id,
+                "position": position,
+                "amount": switch.amount,
+                "gpio_pin": switch.gpio_pin,
+                "gpio_duration": switch.gpio_duration,
+                "lnurl": switch.lnurl,
+                "label": switch.label,
+                "trigger_ttl": switch.trigger_ttl,
+            },
+        )
 
 
-async def get_device(device_id: str) -> Optional[Lnurldevice]:
+async def update_switch_lnurls(device_id: str, lnurls: dict[str, str]) -> None:
+    """Store corrected LNURLs of a device's switches, by switch id"""
+    async with db.connect() as conn:
+        for switch_id, lnurl in lnurls.items():
+            await conn.execute(
+                """
+                UPDATE devicetimer.switch SET lnurl = :lnurl
+                WHERE device_id = :device_id AND switch_id = :switch_id
+                """,
+                {"lnurl": lnurl, "device_id": device_id, "switch_id": switch_id},
+            )
+        # keep the JSON column written for older versions in step
+        row = await conn.fetchone(
+            "SELECT switches FROM devicetimer.device WHERE id = :id",
+            {"id": device_id},
+        )
+        try:
+            switches = json.loads(row["switches"] or "[]") if row else []
+        except (TypeError, ValueError):
+            switches = []
+        if switches:
+            for switch in switches:
+                if switch.get("id") in lnurls:
+                    switch["lnurl"] = lnurls[switch["id"]]
+            await conn.execute(
+                "UPDATE devicetimer.device SET switches = :switches WHERE id = :id",
+                {"switches": json.dumps(switches), "id": device_id},
+            )
+    _device_cache.pop(device_id)
+
+
+async def _get_switches(device_ids: list[str]) -> dict[str, list[SwitchRecord]]:
+    """Switches of the given devices, by device id in their order"""
+    if not device_ids:
+        return {}
+    placeholders, params = _bind_list("d", device_ids)
+    rows = await db.fetchall(
+        f"""SELECT * FROM devicetimer.switch WHERE device_id IN ({placeholders})
+            ORDER BY device_id, position""",
+        params,
+    )
+    switches: dict[str, list[SwitchRecord]] = {}
+    for row in rows:
+        switches.setdefault(row["device_id"], []).append(SwitchRecord.from_row(row))
+    return switches
+
+
+def _parse_device(row, switches: list[SwitchRecord]) -> DeviceRecord:
+    """Decode a database row and the device's switches into a DeviceRecord"""
+    device = DeviceRecord.from_row(row, switches)
+    # compile the opening hours once per load instead of once per scan
+    try:
+        return replace(device, schedule=compile_schedule(device))
+    except Exception as e:
+        logger.warning(f"Invalid opening hours for device {device.id}: {e}")
+        return device
+
+
+async def get_device(device_id: str) -> Optional[DeviceRecord]:
+    """
+    Return a device by id, served from the in-process cache when possible.
+    """
+    device = _device_cache.get(device_id)
+    if device:
+        return device
     row = await db.fetchone(
         "SELECT * FROM devicetimer.device WHERE id = :id",
         {"id": device_id},
     )
     if not row:
         return None
-    return _parse_device(row)
+    switches = await _get_switches([device_id])
+    device = _parse_device(row, switches.get(device_id, []))
+    _device_cache.set(device_id, device)
+    return device
+
+
+async def get_switch(device_id: str, switch_id: str) -> Optional[SwitchRecord]:
+    """
+    Return one switch of a device, from the cached device when there is
+    one and by its primary key otherwise.
+    """
+    device = _device_cache.peek(device_id)
+    if device:
+        return device.get_switch(switch_id)
+    row = await db.fetchone(
+        """SELECT * FROM devicetimer.switch
+           WHERE device_id = :device_id AND switch_id = :switch_id""",
+        {"device_id": device_id, "switch_id": switch_id},
+    )
+    return SwitchRecord.from_row(row) if row else None
 
 
-async def get_devices(wallet_ids: list[str]) -> list[Lnurldevice]:
+async def get_devices(wallet_ids: list[str]) -> list[DeviceRecord]:
     if not wallet_ids:
         return []
-    q = ",".join([f"'{w}'" for w in wallet_ids])
+    placeholders, params = _bind_list("w", wallet_ids)
     rows = await db.fetchall(
-        f"SELECT * FROM devicetimer.device WHERE wallet IN ({q}) ORDER BY id",
+        f"""SELECT * FROM devicetimer.device WHERE wallet IN ({placeholders})
+            ORDER BY id""",
+        params,
     )
-    return [_parse_device(row) for row in rows]
+    switches = await _get_switches([row["id"] for row in rows])
+    return [_parse_device(row, switches.get(row["id"], [])) for row in rows]
 
 
-async def delete_device(lnurldevice_id: str) -> None:
-    await db.execute(
-        "DELETE FROM devicetimer.device WHERE id = :id",
-        {"id": lnurldevice_id},
+DEVICE_SORT_COLUMNS = ("title", "id", "currency")
+
+_SUMMARY_COLUMNS = ", ".join(LnurldeviceSummary.__fields__)
+
+
+def _encode_cursor(sort_value: str, device_id: str) -> str:
+    raw = json.dumps([sort_value, device_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[str, str]:
+    """Raises ValueError for cursors we did not issue"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, device_id = json.loads(raw)
+    except (TypeError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    return str(sort_value), str(device_id)
+
+
+async def get_devices_page(
+    wallet_ids: list[str],
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    search: Optional[str] = None,
+    sort: str = "title",
+    descending: bool = False,
+    summary: bool = False,
+) -> tuple[list, Optional[str]]:
+    """
+    A page of the devices of `wallet_ids`, ordered by `sort` then id and
+    starting after `cursor`. With `summary` only LnurldeviceSummary columns
+    are read. Returns the devices and the cursor of the next page, if any.
+    """
+    assert sort in DEVICE_SORT_COLUMNS, f"Cannot sort devices by {sort}"
+    if not wallet_ids:
+        return [], None
+    placeholders, params = _bind_list("w", wallet_ids)
+    where = [f"wallet IN ({placeholders})"]
+    if search:
+        escaped = search.lower().replace("\\", "\\\\")
+        escaped = escaped.replace("%", "\\%").replace("_", "\\_")
+        where.append("(LOWER(title) LIKE :search ESCAPE '\\' OR id = :search_id)")
+        params.update(search=f"%{escaped}%", search_id=search)
+    op, direction = ("<", "DESC") if descending else (">", "ASC")
+    if cursor:
+        after_value, after_id = _decode_cursor(cursor)
+        if sort == "id":
+            where.append(f"id {op} :after_id")
+        else:
+            where.append(
+                f"({sort} {op} :after_value "
+                f"OR ({sort} = :after_value AND id {op} :after_id))"
+            )
+        params.update(after_value=after_value, after_id=after_id)
+    order = f"id {direction}" if sort == "id" else f"{sort} {direction}, id {direction}"
+
+    rows = await db.fetchall(
+        f"""SELECT {_SUMMARY_COLUMNS if summary else "*"} FROM devicetimer.device
+            WHERE {" AND ".join(where)} ORDER BY {order} LIMIT :limit""",
+        {**params, "limit": limit + 1},
+    )
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if summary:
+        devices: list = [LnurldeviceSummary(**row) for row in rows]
+    else:
+        switches = await _get_switches([row["id"] for row in rows])
+        devices = [_parse_device(row, switches.get(row["id"], [])) for row in rows]
+    next_cursor = None
+    if more:
+        last = rows[-1]
+        next_cursor = _encode_cursor(str(last[sort]), last["id"])
+    return devices, next_cursor
+
+
+async def get_device_currencies() -> list[str]:
+    """Fiat currencies used by any device"""
+    rows = await db.fetchall(
+        "SELECT DISTINCT currency FROM devicetimer.device WHERE currency <> 'sat'"
     )
+    return [row["currency"] for row in rows]
+
+
+async def delete_device(lnurldevice_id: str) -> None:
+    async with db.connect() as conn:
+        await conn.execute(
+            "DELETE FROM devicetimer.switch WHERE device_id = :id",
+            {"id": lnurldevice_id},
+        )
+        await conn.execute(
+            "DELETE FROM devicetimer.device WHERE id = :id",
+            {"id": lnurldevice_id},
+        )
+    _device_cache.pop(lnurldevice_id)
+    _index_device(lnurldevice_id, None)
 
 
 async def create_payment(
@@ -176,75 +498,150 @@ async def create_payment(
     payload: str | None = None,
     payhash: str | None = None,
     sats: int = 0,
-) -> LnurldevicePayment:
-    payment_id = urlsafe_short_hash()
-    await db.execute(
+    status: str = "pending",
+    payment_id: Optional[str] = None,
+) -> PaymentRecord:
+    values = {
+        "id": payment_id or urlsafe_short_hash(),
+        "deviceid": device_id,
+        "switchid": switch_id,
+        "payload": payload or "",
+        "payhash": payhash or "",
+        "sats": sats,
+        "status": status,
+        "epoch": int(time()),
+    }
+    row = await _write_returning(
         """
         INSERT INTO devicetimer.payment
-        (id, deviceid, switchid, payload, payhash, sats)
-        VALUES (:id, :deviceid, :switchid, :payload, :payhash, :sats)
+        (id, deviceid, switchid, payload, payhash, sats, status, epoch)
+        VALUES (:id, :deviceid, :switchid, :payload, :payhash, :sats, :status,
+                :epoch)
         """,
-        {
-            "id": payment_id,
-            "deviceid": device_id,
-            "switchid": switch_id,
-            "payload": payload or "",
-            "payhash": payhash or "",
-            "sats": sats,
-        },
+        values,
     )
-    payment = await get_payment(payment_id)
-    assert payment, "Could not retrieve newly created payment"
+    payment = PaymentRecord.from_row(row or values)
+    if VERIFY_WRITES:
+        _verify_write("Payment", payment, await get_payment(payment.id))
     return payment
 
 
-async def update_payment(payment_id: str, **kwargs) -> LnurldevicePayment:
+async def reserve_payment(
+    device_id: str, switch_id: str, payload: str, sats: int, payment_id: str
+) -> Optional[PaymentRecord]:
+    """
+    Insert a pending payment under `payment_id` unless the id is taken, in a
+    single statement. Returns None when it was, so concurrent callbacks of
+    one LNURL cannot both create an invoice.
+    """
+    values = {
+        "id": payment_id,
+        "deviceid": device_id,
+        "switchid": switch_id,
+        "payload": payload,
+        "payhash": "",
+        "sats": sats,
+        "status": "pending",
+        "epoch": int(time()),
+    }
+    query = """
+        INSERT INTO devicetimer.payment
+        (id, deviceid, switchid, payload, payhash, sats, status, epoch)
+        VALUES (:id, :deviceid, :switchid, :payload, :payhash, :sats, :status,
+                :epoch)
+        ON CONFLICT (id) DO NOTHING
+    """
+    if _supports_returning:
+        row = await _write_returning(query, values)
+        return PaymentRecord.from_row(row) if row else None
+
+    result = await db.execute(query, values)
+    return PaymentRecord.from_row(values) if result.rowcount else None
+
+
+async def release_payment(payment_id: str) -> None:
+    """Drop a reserved payment that never got its invoice"""
+    await db.execute(
+        "DELETE FROM devicetimer.payment WHERE id = :id AND status = 'pending'",
+        {"id": payment_id},
+    )
+
+
+async def update_payment(payment_id: str, **kwargs) -> PaymentRecord:
     set_clause = ", ".join([f"{field} = :{field}" for field in kwargs.keys()])
     params = {**kwargs, "id": payment_id}
-    await db.execute(
+    row = await _write_returning(
         f"UPDATE devicetimer.payment SET {set_clause} WHERE id = :id",
         params,
     )
+    if row and not VERIFY_WRITES:
+        return PaymentRecord.from_row(row)
+    # without RETURNING only the updated columns are known
     dpayment = await get_payment(payment_id)
-    assert dpayment, "Could not retrieve updated LnurldevicePayment"
+    assert dpayment, "Could not retrieve updated payment"
+    if row:
+        _verify_write("Payment", PaymentRecord.from_row(row), dpayment)
     return dpayment
 
 
-async def get_payment(lnurldevicepayment_id: str) -> Optional[LnurldevicePayment]:
-    return await db.fetchone(
+async def claim_payment(payment_id: str, epoch: int) -> Optional[PaymentRecord]:
+    """
+    Mark a payment used unless it already is, in a single statement.
+    Returns the claimed payment, or None when it does not exist or was
+    claimed before, so concurrent deliveries cannot both fire the relay.
+    """
+    query = """
+        UPDATE devicetimer.payment SET status = 'used', epoch = :epoch
+        WHERE id = :id AND status <> 'used'
+    """
+    params = {"id": payment_id, "epoch": epoch}
+    if _supports_returning:
+        row = await _write_returning(query, params)
+        return PaymentRecord.from_row(row) if row else None
+
+    result = await db.execute(query, params)
+    if not result.rowcount:
+        return None
+    return await get_payment(payment_id)
+
+
+async def _fetch_payment(query: str, params: dict) -> Optional[PaymentRecord]:
+    row = await db.fetchone(query, params)
+    return PaymentRecord.from_row(row) if row else None
+
+
+async def get_payment(lnurldevicepayment_id: str) -> Optional[PaymentRecord]:
+    return await _fetch_payment(
         "SELECT * FROM devicetimer.payment WHERE id = :id",
         {"id": lnurldevicepayment_id},
-        LnurldevicePayment,
     )
 
 
-async def get_payment_by_p(p: str) -> Optional[LnurldevicePayment]:
-    return await db.fetchone(
+async def get_payment_by_p(p: str) -> Optional[PaymentRecord]:
+    return await _fetch_payment(
         "SELECT * FROM devicetimer.payment WHERE payhash = :payhash",
         {"payhash": p},
-        LnurldevicePayment,
     )
 
 
 async def get_lnurlpayload(
     lnurldevicepayment_payload: str,
-) -> Optional[LnurldevicePayment]:
-    return await db.fetchone(
+) -> Optional[PaymentRecord]:
+    return await _fetch_payment(
         "SELECT * FROM devicetimer.payment WHERE payload = :payload",
         {"payload": lnurldevicepayment_payload},
-        LnurldevicePayment,
     )
 
 
 async def get_last_payment(
     deviceid: str, switchid: str
-) -> Optional[LnurldevicePayment]:
-    return await db.fetchone(
+) -> Optional[PaymentRecord]:
+    return await _fetch_payment(
         """SELECT * FROM devicetimer.payment
-           WHERE payhash = 'used' AND deviceid = :deviceid AND switchid = :switchid
-           ORDER BY timestamp DESC LIMIT 1""",
+           WHERE deviceid = :deviceid AND switchid = :switchid
+           AND status = 'used'
+           ORDER BY epoch DESC LIMIT 1""",
         {"deviceid": deviceid, "switchid": switchid},
-        LnurldevicePayment,
     )
 
 
@@ -253,56 +650,178 @@ async def get_num_payments_after(
 ) -> int:
     row = await db.fetchone(
         """SELECT count(*) as count FROM devicetimer.payment
-           WHERE payhash = 'used' AND deviceid = :deviceid
-           AND switchid = :switchid AND timestamp > :timestamp""",
-        {"deviceid": deviceid, "switchid": switchid, "timestamp": str(int(timestamp))},
+           WHERE deviceid = :deviceid AND switchid = :switchid
+           AND status = 'used' AND epoch > :epoch""",
+        {"deviceid": deviceid, "switchid": switchid, "epoch": int(timestamp)},
     )
     if row:
-        return int(row.count) if hasattr(row, 'count') else int(row[0])
+        return int(row["count"])
     return 0
 
 
-def get_minutes(timestr: str) -> int:
-    """Convert a time string to minutes"""
-    result = re.search(r"^(\d{2}):(\d{2})$", timestr)
-    assert result, "illegal time format"
-    return int(result.groups()[0]) * 60 + int(result.groups()[1])
+def get_schedule(device: DeviceRecord) -> CompiledSchedule:
+    """Return the compiled opening hours of a device"""
+    # compiling again raises the error _parse_device logged
+    return device.schedule or compile_schedule(device)
 
 
-async def get_payment_allowed(
-    device: Lnurldevice, switch: LnurldeviceSwitch
-) -> PaymentAllowed:
-    now = datetime.now(ZoneInfo(device.timezone))
-    minutes = now.hour * 60 + now.minute
+async def create_outbox_trigger(trigger: LnurldeviceTrigger) -> None:
+    await db.execute(
+        """
+        INSERT INTO devicetimer.outbox
+        (id, deviceid, switchid, pin, duration, epoch, expires)
+        VALUES (:id, :deviceid, :switchid, :pin, :duration, :epoch, :expires)
+        """,
+        trigger.dict(exclude={"paid_at"}),
+    )
 
-    start_minutes = get_minutes(device.available_start)
-    stop_minutes = get_minutes(device.available_stop)
 
-    if stop_minutes <= start_minutes:
-        if (minutes < start_minutes or minutes > stop_minutes + (60 * 24)) and (
-            minutes < start_minutes - (60 * 24) or minutes > stop_minutes
-        ):
-            return PaymentAllowed.CLOSED
-    else:
-        if minutes < start_minutes or minutes > stop_minutes:
-            return PaymentAllowed.CLOSED
+async def get_outbox_triggers(deviceid: str) -> list[LnurldeviceTrigger]:
+    """All queued triggers of a device, oldest first"""
+    return await db.fetchall(
+        """SELECT * FROM devicetimer.outbox
+           WHERE deviceid = :deviceid ORDER BY epoch""",
+        {"deviceid": deviceid},
+        LnurldeviceTrigger,
+    )
+
+
+async def delete_outbox_triggers(trigger_ids: list[str]) -> None:
+    if not trigger_ids:
+        return
+    placeholders, params = _bind_list("id", trigger_ids)
+    await db.execute(
+        f"DELETE FROM devicetimer.outbox WHERE id IN ({placeholders})", params
+    )
+
+
+async def get_actuation_latencies(deviceid: str, limit: int = 1000) -> list[int]:
+    """Latencies of the most recent acknowledged triggers of a device"""
+    rows = await db.fetchall(
+        """SELECT latency_ms FROM devicetimer.payment
+           WHERE deviceid = :deviceid AND status = 'used'
+           AND latency_ms IS NOT NULL
+           ORDER BY epoch DESC LIMIT :limit""",
+        {"deviceid": deviceid, "limit": limit},
+    )
+    return [int(row["latency_ms"]) for row in rows]
+
+
+async def get_failed_actuations(deviceid: str) -> list[PaymentRecord]:
+    """Paid triggers the device never confirmed, candidates for a refund"""
+    rows = await db.fetchall(
+        """SELECT * FROM devicetimer.payment
+           WHERE deviceid = :deviceid AND status = 'used'
+           AND delivery IN ('failed', 'unacked')
+           ORDER BY epoch DESC""",
+        {"deviceid": deviceid},
+    )
+    return [PaymentRecord.from_row(row) for row in rows]
+
+
+async def get_used_payment_epochs(
+    deviceid: str, switchid: str, since: float, limit: int
+) -> list[int]:
+    """Epochs of the most recent used payments after `since`, newest first"""
+    rows = await db.fetchall(
+        """SELECT epoch FROM devicetimer.payment
+           WHERE deviceid = :deviceid AND switchid = :switchid
+           AND status = 'used' AND epoch > :since
+           ORDER BY epoch DESC LIMIT :limit""",
+        {
+            "deviceid": deviceid,
+            "switchid": switchid,
+            "since": int(since),
+            "limit": limit,
+        },
+    )
+    return [int(row["epoch"]) for row in rows]
+
+
+async def get_payment_allowed(
+    device: DeviceRecord, switch: SwitchRecord
+) -> PaymentAllowed:
+    if not get_schedule(device).is_open():
+        return PaymentAllowed.CLOSED
 
     now_ts = time()
-    if device.maxperday is not None and device.maxperday > 0:
-        num_payments = await get_num_payments_after(
-            deviceid=device.id, switchid=switch.id, timestamp=now_ts - 86400
+    size = admission.buffer_size(device.maxperday)
+    state = admission.get_state(device.id, switch.id, size)
+    if not state:
+        # cold start or expired state, one indexed query re-seeds it
+        epochs = await get_used_payment_epochs(
+            deviceid=device.id,
+            switchid=switch.id,
+            since=now_ts - max(admission.DAY_SECONDS, device.timeout),
+            limit=size,
         )
-        if num_payments >= device.maxperday:
-            return PaymentAllowed.CLOSED
+        state = admission.seed_state(
+            device.id, switch.id, epochs, size, device.timeout
+        )
+
+    result = state.decide(now_ts, device.maxperday or 0, device.timeout)
+    logger.debug(f"Admission for {device.id}/{switch.id}: {result}")
+    return result
 
-    last_payment = await get_last_payment(deviceid=device.id, switchid=switch.id)
-    if not last_payment:
-        return PaymentAllowed.OPEN
 
-    logger.info(
-        f"Last payment at {last_payment.timestamp} {now_ts - int(last_payment.timestamp)}"
+_ARCHIVED_COLUMNS = (
+    "id, deviceid, switchid, payhash, payload, sats, status, epoch, timestamp"
+)
+
+
+async def prune_unpaid_payments(cutoff: int, limit: int, archive: bool) -> int:
+    """
+    Delete, or move to payment_archive, up to `limit` payments that were
+    scanned or invoiced before `cutoff` and never paid. Returns the count.
+    """
+    rows = await db.fetchall(
+        """SELECT id FROM devicetimer.payment
+           WHERE status IN ('pending', 'invoiced') AND epoch < :cutoff
+           ORDER BY epoch LIMIT :limit""",
+        {"cutoff": cutoff, "limit": limit},
     )
-    if last_payment is not None and now_ts - int(last_payment.timestamp) < device.timeout:
-        return PaymentAllowed.WAIT
+    if not rows:
+        return 0
+    placeholders, params = _bind_list("id", [row["id"] for row in rows])
+    # never remove a payment that got paid meanwhile
+    where = f"id IN ({placeholders}) AND status <> 'used'"
+    async with db.connect() as conn:
+        if archive:
+            await conn.execute(
+                f"""
+                INSERT INTO devicetimer.payment_archive
+                ({_ARCHIVED_COLUMNS}, archived)
+                SELECT {_ARCHIVED_COLUMNS}, :archived
+                FROM devicetimer.payment WHERE {where}
+                """,
+                {**params, "archived": int(time())},
+            )
+        result = await conn.execute(
+            f"DELETE FROM devicetimer.payment WHERE {where}", params
+        )
+    return result.rowcount
+
 
-    return PaymentAllowed.OPEN
+async def prune_expired_outbox(now: int, limit: int) -> int:
+    """
+    Drop up to `limit` queued triggers that expired before their device
+    came back, marking their payments failed. Returns the count.
+    """
+    rows = await db.fetchall(
+        """SELECT id FROM devicetimer.outbox
+           WHERE expires <= :now ORDER BY expires LIMIT :limit""",
+        {"now": now, "limit": limit},
+    )
+    if not rows:
+        return 0
+    placeholders, params = _bind_list("id", [row["id"] for row in rows])
+    async with db.connect() as conn:
+        await conn.execute(
+            f"""UPDATE devicetimer.payment SET delivery = 'failed'
+                WHERE id IN ({placeholders}) AND delivery = 'queued'""",
+            params,
+        )
+        result = await conn.execute(
+            f"DELETE FROM devicetimer.outbox WHERE id IN ({placeholders})", params
+        )
+    return result.rowcount
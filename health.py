@@ -0,0 +1,96 @@
+"""
+Liveness and round-trip times of hardware connections.
+
+The heartbeat in websocket.py records every pong here. A device's record
+outlives its connections (up to HEALTH_RETENTION) so a site that keeps
+dropping off still shows when it was last seen, how often it was evicted
+and how its round-trip times were distributed.
+"""
+
+from collections import deque
+from time import time
+from typing import Callable, Optional
+
+from .cache import TTLCache
+from .helpers import percentile
+from .settings import HEALTH_CACHE_SIZE, HEALTH_RETENTION, HEARTBEAT_RTT_SAMPLES
+
+# upper bounds of the RTT histogram buckets in milliseconds
+RTT_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class DeviceHealth:
+    """Last-seen time, evictions and the latest RTT samples of a device"""
+
+    __slots__ = ("last_seen", "connects", "evictions", "rtts")
+
+    def __init__(self):
+        self.last_seen = 0.0
+        self.connects = 0
+        self.evictions = 0
+        self.rtts: deque[float] = deque(maxlen=HEARTBEAT_RTT_SAMPLES)
+
+    def touch(self) -> None:
+        self.last_seen = time()
+
+    def record_rtt(self, rtt_ms: float) -> None:
+        self.rtts.append(rtt_ms)
+        self.touch()
+
+    def summary(self) -> dict:
+        rtts = sorted(self.rtts)
+        histogram = dict.fromkeys([f"<={b}" for b in RTT_BUCKETS_MS] + ["more"], 0)
+        for rtt in rtts:
+            bucket = next((b for b in RTT_BUCKETS_MS if rtt <= b), None)
+            histogram[f"<={bucket}" if bucket else "more"] += 1
+        return {
+            "last_seen": int(self.last_seen) or None,
+            "connects": self.connects,
+            "evictions": self.evictions,
+            "rtt_ms": {
+                "samples": len(rtts),
+                "last": round(self.rtts[-1], 1) if rtts else None,
+                "p50": round(percentile(rtts, 0.5), 1) if rtts else None,
+                "p95": round(percentile(rtts, 0.95), 1) if rtts else None,
+                "max": round(rtts[-1], 1) if rtts else None,
+                "histogram": histogram,
+            },
+        }
+
+
+_health: TTLCache[str, DeviceHealth] = TTLCache(
+    maxsize=HEALTH_CACHE_SIZE, ttl=HEALTH_RETENTION
+)
+
+# Health summaries of devices connected to other workers, set by routing.py
+_remote_health: Callable[[], dict[str, dict]] = dict
+
+
+def set_remote_health_provider(provider: Callable[[], dict[str, dict]]) -> None:
+    global _remote_health
+    _remote_health = provider
+
+
+def device_health(device_id: str) -> DeviceHealth:
+    """The health record of a device, created and kept alive on access"""
+    health = _health.peek(device_id) or DeviceHealth()
+    _health.set(device_id, health)
+    return health
+
+
+def get_device_health(device_id: str) -> Optional[dict]:
+    """Summary of a device's health as seen by this or another worker"""
+    health = _health.peek(device_id)
+    if health and health.last_seen:
+        return health.summary()
+    return _remote_health().get(device_id)
+
+
+def get_local_health(device_ids: list[str]) -> dict[str, dict]:
+    """Summaries of the given devices' local health records"""
+    summaries = {}
+    for device_id in device_ids:
+        health = _health.peek(device_id)
+        if health:
+            summaries[device_id] = health.summary()
+    return summaries
@@ -1,12 +1,20 @@
 """Helper utilities for DeviceTimer extension"""
 
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import urlsplit
+
 from lnurl import Lnurl
 from loguru import logger
 
+from .settings import LNURL_CACHE_SIZE
+
 
+@lru_cache(maxsize=LNURL_CACHE_SIZE)
 def encode_lnurl(url: str) -> str:
     """
-    Encode a URL to LNURL bech32 format.
+    Encode a URL to LNURL bech32 format. Results are memoised by URL,
+    failures are not.
 
     Args:
         url: The URL to encode (must be https for production)
@@ -23,16 +31,48 @@ def encode_lnurl(url: str) -> str:
         raise ValueError(f"Invalid URL for LNURL encoding: {url}") from e
 
 
-def is_valid_lnurl(value: str) -> bool:
+@lru_cache(maxsize=LNURL_CACHE_SIZE)
+def decode_lnurl(value: str) -> Optional[str]:
+    """
+    Decode a bech32 LNURL. Results are memoised by LNURL.
+
+    Returns:
+        The URL the LNURL points at, None if it does not decode
+    """
+    try:
+        return str(Lnurl(value).url)
+    except Exception:
+        return None
+
+
+def is_valid_lnurl(value: Optional[str], url: Optional[str] = None) -> bool:
     """
     Check if a string is a valid bech32 encoded LNURL.
 
     Args:
         value: The string to check
+        url: If given, the URL the LNURL must point at. Only host, path and
+            query are compared, so a server moving to https keeps its LNURLs.
 
     Returns:
         True if valid LNURL format, False otherwise
     """
-    if not value:
+    if not value or not value.upper().startswith("LNURL1"):
         return False
-    return value.upper().startswith("LNURL1")
+    target = decode_lnurl(value.upper())
+    if target is None:
+        return False
+    return url is None or urlsplit(target)[1:] == urlsplit(url)[1:]
+
+
+def get_lnurl_cache_stats() -> dict:
+    return {
+        name: func.cache_info()._asdict()
+        for name, func in (("encode", encode_lnurl), ("decode", decode_lnurl))
+    }
+
+
+def percentile(sorted_values: list, fraction: float):
+    """Nearest-rank percentile of an ascending list"""
+    rank = round(fraction * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
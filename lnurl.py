@@ -2,18 +2,23 @@ from http import HTTPStatus
 import json
 
 from fastapi import APIRouter, HTTPException, Query, Request
+from loguru import logger
 
+from lnbits.core.crud import get_standalone_payment
 from lnbits.core.services import create_invoice
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
 
 from .models import PaymentAllowed
 from .crud import (
-    create_payment,
     get_device,
     get_payment,
+    release_payment,
+    reserve_payment,
     update_payment,
     get_payment_allowed,
 )
+from .rates import get_price_msat
+from .ratelimit import allow_client, allow_switch
+from .tokens import CallbackToken, issue_token, parse_token
 
 devicetimer_lnurl_router = APIRouter()
 
@@ -47,6 +52,10 @@ async def lnurl_v2_params(request: Request, device_id: str, switch_id: str):
 
 
 async def lnurl_params(request: Request, device_id: str, switch_id: str):
+    client_ip = request.client.host if request.client else ""
+    if not allow_client(client_ip):
+        return {"status": "ERROR", "reason": "Too many requests, try again shortly."}
+
     # find the device
     device = await get_device(device_id)
     if not device:
@@ -55,46 +64,31 @@ async def lnurl_params(request: Request, device_id: str, switch_id: str):
             "reason": f"lnurldevice {device_id} not found on this server",
         }
 
-    # find the switch
-    switch = None
-    if device.switches:
-        for _switch in device.switches:
-            if _switch.id == switch_id:
-                switch = _switch
-                break
+    switch = device.get_switch(switch_id)
     if not switch:
         return {"status": "ERROR", "reason": "Switch params wrong"}
 
+    if not allow_switch(device.id, switch.id):
+        return {"status": "ERROR", "reason": "Too many requests, try again shortly."}
+
     result = await get_payment_allowed(device, switch)
     if result == PaymentAllowed.CLOSED:
         return {"status": "ERROR", "reason": "Payment not allowed outside opening hours"}
     if result == PaymentAllowed.WAIT:
         return {"status": "ERROR", "reason": "Payment not allowed due to recent payment"}
 
-    price_msat = int(
-        (
-            await fiat_amount_as_satoshis(float(switch.amount), device.currency)
-            if device.currency != "sat"
-            else float(switch.amount)
-        )
-        * 1000
-    )
+    try:
+        price_msat = await get_price_msat(switch.amount, device.currency)
+    except Exception as e:
+        logger.warning(f"No {device.currency} exchange rate: {e}")
+        return {"status": "ERROR", "reason": "Exchange rate unavailable."}
 
-    lnurldevicepayment = await create_payment(
-        device_id=device.id,
-        switch_id=switch.id,
-        payload=f"{switch.gpio_pin}-{switch.gpio_duration}",
-        sats=price_msat,
-        payhash="pending",
-    )
-    if not lnurldevicepayment:
-        return {"status": "ERROR", "reason": "Could not create payment."}
+    # nothing is stored until the wallet asks for the invoice
+    token = issue_token(device.id, device.key, switch.id, price_msat)
 
     return {
         "tag": "payRequest",
-        "callback": str(
-            request.url_for("devicetimer.lnurl_callback", paymentid=lnurldevicepayment.id)
-        ),
+        "callback": str(request.url_for("devicetimer.lnurl_callback", paymentid=token)),
         "minSendable": price_msat,
         "maxSendable": price_msat,
         "metadata": json.dumps([["text/plain", create_payment_memo(device, switch)]]),
@@ -111,23 +105,23 @@ async def lnurl_callback(
     paymentid: str,
     amount: int = Query(..., description="Amount in millisatoshis"),
 ):
+    token = parse_token(paymentid)
+    if token:
+        return await token_callback(token, amount)
+
+    # payments stored by scans before callback tokens were introduced
     payment = await get_payment(paymentid)
     if not payment:
         return {"status": "ERROR", "reason": "Payment not found."}
 
-    if payment.payhash == "used":
+    if payment.status == "used":
         return {"status": "ERROR", "reason": "Payment already used."}
 
     device = await get_device(payment.deviceid)
     if not device:
         return {"status": "ERROR", "reason": "Device not found."}
 
-    switch = None
-    for _switch in device.switches:
-        if _switch.id == payment.switchid:
-            switch = _switch
-            break
-
+    switch = device.get_switch(payment.switchid)
     if not switch:
         return {"status": "ERROR", "reason": "Switch not found."}
 
@@ -136,26 +130,11 @@ async def lnurl_callback(
         return {"status": "ERROR", "reason": f"Amount mismatch. Expected {payment.sats} msats."}
 
     try:
-        invoice = await create_invoice(
-            wallet_id=device.wallet,
-            amount=int(amount / 1000),
-            memo=create_payment_memo(device, switch),
-            unhashed_description=json.dumps(
-                [["text/plain", create_payment_memo(device, switch)]]
-            ).encode(),
-            extra={
-                "tag": "DeviceTimer",
-                "Device": device.id,
-                "Switch": switch.id,
-                "amount": switch.amount,
-                "currency": device.currency,
-                "id": paymentid,
-                "received": False,
-                "fulfilled": False,
-            },
-        )
+        invoice = await create_switch_invoice(device, switch, amount, paymentid)
 
-        await update_payment(payment_id=paymentid, payhash=invoice.payment_hash)
+        await update_payment(
+            payment_id=paymentid, payhash=invoice.payment_hash, status="invoiced"
+        )
 
         return {
             "pr": invoice.bolt11,
@@ -163,3 +142,81 @@ async def lnurl_callback(
         }
     except Exception as e:
         return {"status": "ERROR", "reason": str(e)}
+
+
+async def token_callback(token: CallbackToken, amount: int):
+    device = await get_device(token.device_id)
+    if not device or not token.is_valid(device.key):
+        return {"status": "ERROR", "reason": "Invalid or expired payment request."}
+
+    switch = device.get_switch(token.switch_id)
+    if not switch:
+        return {"status": "ERROR", "reason": "Switch not found."}
+
+    if amount != token.msat:
+        return {"status": "ERROR", "reason": f"Amount mismatch. Expected {token.msat} msats."}
+
+    # claim the payment id before creating the invoice, so a wallet asking
+    # twice at once cannot get two invoices for one scan
+    payment = await reserve_payment(
+        device_id=device.id,
+        switch_id=switch.id,
+        payload=f"{switch.gpio_pin}-{switch.gpio_duration}",
+        sats=amount,
+        payment_id=token.payment_id,
+    )
+    if not payment:
+        return await repeated_callback(token)
+
+    try:
+        invoice = await create_switch_invoice(device, switch, amount, payment.id)
+        await update_payment(
+            payment_id=payment.id, payhash=invoice.payment_hash, status="invoiced"
+        )
+    except Exception as e:
+        # let the wallet try again
+        await release_payment(payment.id)
+        return {"status": "ERROR", "reason": str(e)}
+
+    return {
+        "pr": invoice.bolt11,
+        "routes": [],
+    }
+
+
+async def repeated_callback(token: CallbackToken):
+    """A wallet asking again gets the invoice it was given before"""
+    payment = await get_payment(token.payment_id)
+    if payment and payment.status == "used":
+        return {"status": "ERROR", "reason": "Payment already used."}
+    if not payment or payment.status != "invoiced":
+        return {"status": "ERROR", "reason": "Invoice is being created, try again."}
+
+    invoice = await get_standalone_payment(payment.payhash, incoming=True)
+    if not invoice:
+        return {"status": "ERROR", "reason": "Invoice not found."}
+    return {
+        "pr": invoice.bolt11,
+        "routes": [],
+    }
+
+
+async def create_switch_invoice(device, switch, amount: int, payment_id: str):
+    return await create_invoice(
+        wallet_id=device.wallet,
+        amount=int(amount / 1000),
+        memo=create_payment_memo(device, switch),
+        unhashed_description=json.dumps(
+            [["text/plain", create_payment_memo(device, switch)]]
+        ).encode(),
+        extra={
+            "tag": "DeviceTimer",
+            "Device": device.id,
+            "Switch": switch.id,
+            "amount": switch.amount,
+            "currency": device.currency,
+            "id": payment_id,
+            "received": False,
+            "fulfilled": False,
+        },
+    )
@@ -1,6 +1,18 @@
 import json
 
-from lnbits.db import Database
+from lnbits.db import SQLITE, Database
+from lnbits.settings import settings
+
+from .helpers import encode_lnurl, is_valid_lnurl
+
+
+def _create_index(db, name: str, table: str, columns: str) -> str:
+    """CREATE INDEX statement for a devicetimer table on any backend"""
+    if db.type == SQLITE:
+        # sqlite qualifies the index name, the table lives in the same schema
+        return f"CREATE INDEX IF NOT EXISTS devicetimer.{name} ON {table} ({columns})"
+    return f"CREATE INDEX IF NOT EXISTS {name} ON devicetimer.{table} ({columns})"
+
 
 async def m001_initial(db):
     """
@@ -70,3 +82,233 @@ async def m005_redux(db):
         UPDATE devicetimer.device SET timezone='europe/amsterdam'
         """
     )
+
+
+async def m006_payment_epoch(db):
+    """
+    Add an integer epoch and an explicit status to payments and index the
+    columns used by the rate-limit and lookup queries.
+
+    status is one of 'pending' (LNURL scanned), 'invoiced' (invoice created)
+    or 'used' (invoice paid); previously this state was stored in payhash.
+    epoch is the unix time of the last status change.
+    """
+    await db.execute(
+        f"ALTER TABLE devicetimer.payment ADD COLUMN epoch {db.big_int} DEFAULT 0"
+    )
+    await db.execute(
+        "ALTER TABLE devicetimer.payment ADD COLUMN status TEXT DEFAULT 'pending'"
+    )
+
+    if db.type == SQLITE:
+        # timestamps are stored as unix time by lnbits, but accept text too
+        epoch = (
+            "COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), "
+            "CAST(timestamp AS INTEGER))"
+        )
+    else:
+        epoch = "CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT)"
+    await db.execute(
+        f"""
+        UPDATE devicetimer.payment SET
+            epoch = {epoch},
+            status = CASE
+                WHEN payhash = 'used' THEN 'used'
+                WHEN payhash = 'pending' OR payhash = '' OR payhash IS NULL
+                    THEN 'pending'
+                ELSE 'invoiced'
+            END
+        """
+    )
+
+    await db.execute(
+        _create_index(
+            db, "payment_rate_idx", "payment", "deviceid, switchid, status, epoch"
+        )
+    )
+    await db.execute(_create_index(db, "payment_payhash_idx", "payment", "payhash"))
+    await db.execute(_create_index(db, "payment_payload_idx", "payment", "payload"))
+
+
+async def m007_schedule(db):
+    """
+    Opening windows per weekday and closed dates per device, both JSON.
+    Devices without windows keep using available_start/available_stop.
+    """
+    await db.execute("ALTER TABLE devicetimer.device ADD COLUMN windows TEXT")
+    await db.execute("ALTER TABLE devicetimer.device ADD COLUMN holidays TEXT")
+
+
+async def m008_actuation(db):
+    """
+    Record how a paid trigger was delivered ('acked', 'sent' or 'failed')
+    and the payment-to-relay latency of acknowledged triggers.
+    """
+    await db.execute("ALTER TABLE devicetimer.payment ADD COLUMN delivery TEXT")
+    await db.execute("ALTER TABLE devicetimer.payment ADD COLUMN latency_ms INT")
+
+
+async def m009_outbox(db):
+    """
+    Paid triggers that could not be delivered, replayed in order when the
+    device reconnects until they expire. id is the payment id; the payment's
+    delivery is 'queued' while its trigger waits here.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE devicetimer.outbox (
+            id TEXT NOT NULL PRIMARY KEY,
+            deviceid TEXT NOT NULL,
+            switchid TEXT NOT NULL,
+            pin INT NOT NULL,
+            duration INT NOT NULL,
+            epoch {db.big_int} NOT NULL,
+            expires {db.big_int} NOT NULL
+        );
+    """
+    )
+    await db.execute(_create_index(db, "outbox_device_idx", "outbox", "deviceid, epoch"))
+
+
+async def m010_payment_archive(db):
+    """
+    Archive for unpaid payments removed by the reaper, and an index to find
+    them by status and age.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE devicetimer.payment_archive (
+            id TEXT NOT NULL PRIMARY KEY,
+            deviceid TEXT NOT NULL,
+            switchid TEXT,
+            payhash TEXT,
+            payload TEXT,
+            sats {db.big_int},
+            status TEXT,
+            epoch {db.big_int},
+            timestamp TIMESTAMP,
+            archived {db.big_int} NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        _create_index(db, "payment_status_idx", "payment", "status, epoch")
+    )
+
+
+async def m011_device_listing(db):
+    """
+    Index for the paginated device listing, by wallet in title order.
+    """
+    await db.execute(
+        _create_index(db, "device_wallet_idx", "device", "wallet, title, id")
+    )
+
+
+async def m012_switch_table(db):
+    """
+    Switches in their own table, keyed by (device_id, switch_id), instead of
+    the device.switches JSON. The JSON column is still written for older
+    versions but no longer read.
+    """
+    await db.execute(
+        """
+        CREATE TABLE devicetimer.switch (
+            device_id TEXT NOT NULL,
+            switch_id TEXT NOT NULL,
+            position INT NOT NULL DEFAULT 0,
+            amount FLOAT NOT NULL DEFAULT 0,
+            gpio_pin INT NOT NULL DEFAULT 21,
+            gpio_duration INT NOT NULL DEFAULT 2100,
+            lnurl TEXT,
+            label TEXT,
+            trigger_ttl INT NOT NULL DEFAULT 300,
+            PRIMARY KEY (device_id, switch_id)
+        );
+    """
+    )
+
+    rows = await db.fetchall("SELECT id, switches FROM devicetimer.device")
+    for row in rows:
+        try:
+            switches = json.loads(row["switches"] or "[]") or []
+        except (TypeError, ValueError):
+            switches = []
+        seen = set()
+        for position, switch in enumerate(switches):
+            if not switch.get("id") or switch["id"] in seen:
+                # unreachable: the LNURL of a switch carries its id
+                continue
+            seen.add(switch["id"])
+            await db.execute(
+                """
+                INSERT INTO devicetimer.switch
+                (device_id, switch_id, position, amount, gpio_pin, gpio_duration,
+                 lnurl, label, trigger_ttl)
+                VALUES (:device_id, :switch_id, :position, :amount, :gpio_pin,
+                        :gpio_duration, :lnurl, :label, :trigger_ttl)
+                """,
+                {
+                    "device_id": row["id"],
+                    "switch_id": switch["id"],
+                    "position": position,
+                    "amount": float(switch.get("amount", 0)),
+                    "gpio_pin": int(switch.get("gpio_pin", 21)),
+                    "gpio_duration": int(switch.get("gpio_duration", 2100)),
+                    "lnurl": switch.get("lnurl"),
+                    "label": switch.get("label"),
+                    "trigger_ttl": int(switch.get("trigger_ttl", 300)),
+                },
+            )
+
+
+async def m013_lnurl_backfill(db):
+    """
+    Encode the switch LNURLs that are missing or not valid bech32. LNURLs
+    pointing at another host are left alone: the base URL known here may
+    not be the public one, the request path corrects and stores those.
+    """
+    base_url = f"{settings.lnbits_baseurl.rstrip('/')}/devicetimer/api/v2/lnurl"
+    rows = await db.fetchall("SELECT device_id, switch_id, lnurl FROM devicetimer.switch")
+    fixed: dict[str, dict[str, str]] = {}
+    for row in rows:
+        url = f"{base_url}/{row['device_id']}?switch_id={row['switch_id']}"
+        if is_valid_lnurl(row["lnurl"]):
+            continue
+        try:
+            lnurl = encode_lnurl(url)
+        except ValueError:
+            # e.g. a base URL the lnurl library refuses, fixed per request
+            continue
+        fixed.setdefault(row["device_id"], {})[row["switch_id"]] = lnurl
+        await db.execute(
+            """
+            UPDATE devicetimer.switch SET lnurl = :lnurl
+            WHERE device_id = :device_id AND switch_id = :switch_id
+            """,
+            {
+                "lnurl": lnurl,
+                "device_id": row["device_id"],
+                "switch_id": row["switch_id"],
+            },
+        )
+
+    # keep the JSON column written for older versions in step
+    for device_id, lnurls in fixed.items():
+        row = await db.fetchone(
+            "SELECT switches FROM devicetimer.device WHERE id = :id",
+            {"id": device_id},
+        )
+        if not row:
+            continue
+        try:
+            switches = json.loads(row["switches"] or "[]") or []
+        except (TypeError, ValueError):
+            continue
+        for switch in switches:
+            if switch.get("id") in lnurls:
+                switch["lnurl"] = lnurls[switch["id"]]
+        await db.execute(
+            "UPDATE devicetimer.device SET switches = :switches WHERE id = :id",
+            {"switches": json.dumps(switches), "id": device_id},
+        )
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 from enum import Enum
 
 from pydantic import BaseModel
@@ -17,6 +17,16 @@ class LnurldeviceSwitch(BaseModel):
     gpio_duration: int = 2100
     lnurl: Optional[str] = None
     label: Optional[str] = None
+    # seconds a paid trigger waits for an offline device, 0 drops it
+    trigger_ttl: int = 300
+
+
+class LnurldeviceWindow(BaseModel):
+    """Daily opening window on the given weekdays (Monday = 0)"""
+
+    days: List[int] = [0, 1, 2, 3, 4, 5, 6]
+    start: str
+    stop: str
 
 
 class CreateLnurldevice(BaseModel):
@@ -31,6 +41,8 @@ class CreateLnurldevice(BaseModel):
     closed_url: Optional[str] = None
     wait_url: Optional[str] = None
     switches: Optional[List[LnurldeviceSwitch]] = None
+    windows: Optional[List[LnurldeviceWindow]] = None
+    holidays: Optional[List[str]] = None
 
 
 class Lnurldevice(BaseModel):
@@ -48,6 +60,30 @@ class Lnurldevice(BaseModel):
     maxperday: Optional[int] = None
     closed_url: Optional[str] = None
     wait_url: Optional[str] = None
+    windows: List[LnurldeviceWindow] = []
+    holidays: List[str] = []
+
+
+class LnurldeviceSummary(BaseModel):
+    """Device listing without switches and schedule"""
+
+    id: str
+    title: str
+    wallet: str
+    currency: str
+    timezone: str
+    available_start: str
+    available_stop: str
+    timeout: int
+    maxperday: Optional[int] = None
+
+
+class LnurldevicePage(BaseModel):
+    """One page of a device listing, next_cursor continues it"""
+
+    data: List[Union[Lnurldevice, LnurldeviceSummary]] = []
+    next_cursor: Optional[str] = None
+
 
 class LnurldevicePayment(BaseModel):
     id: str
@@ -56,4 +92,32 @@ class LnurldevicePayment(BaseModel):
     payload: str
     switchid: str
     sats: int
+    status: str = "pending"
+    epoch: int = 0
+    delivery: Optional[str] = None
+    latency_ms: Optional[int] = None
     timestamp: str = ""
+
+
+class LnurldeviceTrigger(BaseModel):
+    """Undelivered paid trigger in the outbox"""
+
+    id: str
+    deviceid: str
+    switchid: str
+    pin: int
+    duration: int
+    epoch: int
+    expires: int
+    # unix time the invoice was paid, for the latency of the first delivery;
+    # not kept in the outbox, replays measure from epoch
+    paid_at: float = 0
+
+
+class ActuationStats(BaseModel):
+    """Payment-to-relay latency of a device's acknowledged triggers"""
+
+    count: int = 0
+    p50_ms: Optional[int] = None
+    p99_ms: Optional[int] = None
+    failed: List[LnurldevicePayment] = []
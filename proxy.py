@@ -0,0 +1,216 @@
+"""
+Fetching of the closed_url / wait_url images shown instead of a QR code.
+
+A single pooled httpx client is opened in devicetimer_start and closed in
+devicetimer_stop. Fetched images are kept in a bounded cache and revalidated
+with ETag / Last-Modified once they expire. Requests have a strict timeout
+and bodies larger than PROXY_MAX_BYTES are refused.
+
+The URLs are set by device owners but fetched by the server, so only https
+URLs whose host resolves to public addresses are fetched. The connection
+goes to the address that was checked, the host name is only sent as Host
+header and TLS server name, so a second DNS answer cannot redirect it.
+Redirects are followed by hand, at most PROXY_MAX_REDIRECTS of them, and
+every hop is checked the same way. Only image/* responses are accepted, anything else
+would be served from the LNbits origin.
+"""
+
+import asyncio
+import ipaddress
+import socket
+from typing import NamedTuple, Optional
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from loguru import logger
+
+from .cache import TTLCache
+from .settings import (
+    PROXY_CACHE_SIZE,
+    PROXY_CACHE_TTL,
+    PROXY_MAX_BYTES,
+    PROXY_MAX_REDIRECTS,
+    PROXY_TIMEOUT,
+)
+
+
+class ProxiedImage(NamedTuple):
+    content: bytes
+    content_type: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+# Fresh images by url, see _stale for revalidation
+_images: TTLCache[str, ProxiedImage] = TTLCache(
+    maxsize=PROXY_CACHE_SIZE, ttl=PROXY_CACHE_TTL
+)
+# Last known image per url, kept after expiry for conditional requests
+_stale: TTLCache[str, ProxiedImage] = TTLCache(
+    maxsize=PROXY_CACHE_SIZE, ttl=float("inf")
+)
+
+
+def _is_public_address(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address).is_global
+    except ValueError:
+        # e.g. a scoped IPv6 address like fe80::1%eth0
+        return False
+
+
+def proxy_allowed(url: Optional[str]) -> bool:
+    """
+    Check if URL is allowed to be proxied: https, and not addressed to a
+    loopback, private, link-local or otherwise non-public host. Host names
+    are checked again once resolved, see _resolve_public.
+    """
+    if not url:
+        return False
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+        parts.port
+    except ValueError:
+        return False
+    if parts.scheme != "https" or not host:
+        return False
+    host = host.rstrip(".")
+    if host == "localhost" or host.endswith(".localhost"):
+        return False
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return True
+    return _is_public_address(host)
+
+
+async def _resolve_public(host: str, port: int) -> Optional[str]:
+    """An address to connect to, None unless every address of `host` is public"""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+    except OSError:
+        return None
+    addresses = [info[4][0] for info in infos]
+    if not addresses or not all(_is_public_address(a) for a in addresses):
+        return None
+    return addresses[0]
+
+
+def _authority(host: str, port: Optional[int]) -> str:
+    host = f"[{host}]" if ":" in host else host
+    return f"{host}:{port}" if port else host
+
+
+async def _pinned(url: str) -> tuple[str, str, str]:
+    """
+    The URL rewritten to a checked public address of its host, plus the
+    Host header and TLS server name to send
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    address = None
+    if proxy_allowed(url) and host:
+        address = await _resolve_public(host, parts.port or 443)
+    if not address:
+        raise ValueError(f"refusing to fetch {url}")
+    pinned = parts._replace(netloc=_authority(address, parts.port)).geturl()
+    return pinned, _authority(host, parts.port), host
+
+
+def image_media_type(content_type: Optional[str]) -> Optional[str]:
+    """The media type of an image/* content type, None for anything else"""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return media_type if media_type.startswith("image/") else None
+
+
+def start_http_client() -> None:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(PROXY_TIMEOUT),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            # redirects are followed in _download, checking every hop
+            follow_redirects=False,
+        )
+
+
+async def stop_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # the extension may serve requests before devicetimer_start ran
+    start_http_client()
+    assert _client
+    return _client
+
+
+async def _download(url: str, known: Optional[ProxiedImage]) -> ProxiedImage:
+    headers = {}
+    if known and known.etag:
+        headers["If-None-Match"] = known.etag
+    if known and known.last_modified:
+        headers["If-Modified-Since"] = known.last_modified
+
+    for _ in range(PROXY_MAX_REDIRECTS + 1):
+        pinned, authority, server_name = await _pinned(url)
+        async with get_http_client().stream(
+            "GET",
+            pinned,
+            headers={**headers, "Host": authority},
+            extensions={"sni_hostname": server_name},
+        ) as response:
+            if response.has_redirect_location:
+                url = urljoin(url, response.headers["location"])
+                continue
+            if response.status_code == 304 and known:
+                return known
+            response.raise_for_status()
+            media_type = image_media_type(response.headers.get("content-type"))
+            if not media_type:
+                raise ValueError(
+                    f"not an image: {response.headers.get('content-type')}"
+                )
+            if int(response.headers.get("content-length") or 0) > PROXY_MAX_BYTES:
+                raise ValueError("image too large")
+            content = bytearray()
+            async for chunk in response.aiter_bytes():
+                content += chunk
+                if len(content) > PROXY_MAX_BYTES:
+                    raise ValueError("image too large")
+            return ProxiedImage(
+                content=bytes(content),
+                content_type=media_type,
+                etag=response.headers.get("etag"),
+                last_modified=response.headers.get("last-modified"),
+            )
+    raise ValueError("too many redirects")
+
+
+async def fetch_image(url: str) -> Optional[ProxiedImage]:
+    """Return the image at `url`, or None when it cannot be fetched"""
+    image = _images.get(url)
+    if image:
+        return image
+    known = _stale.peek(url)
+    try:
+        # httpx times out per read, bound the whole download as well
+        image = await asyncio.wait_for(_download(url, known), PROXY_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Failed to retrieve image {url}: {e}")
+        return None
+    _images.set(url, image)
+    _stale.set(url, image)
+    return image
+
+
+def get_proxy_cache_stats() -> dict:
+    return _images.stats()
@@ -0,0 +1,117 @@
+"""
+Scan-flood protection for the public LNURL endpoints.
+
+Every scan costs database queries and possibly an exchange rate lookup, so
+lnurl_params takes a token from a bucket of the client IP before doing any
+work. Once the device and switch are known to exist it takes one from a
+bucket of that (device, switch) too, so scans of made-up ids cannot create
+buckets or drain the bucket of a real switch. A bucket holds up to `burst`
+tokens and refills at `rate` tokens per second.
+
+A bucket that has been idle long enough to be full again is the same as no
+bucket, so buckets are kept in least recently used order and dropped from
+the front once they are full again. Memory therefore follows the number of
+keys active within the last `burst / rate` seconds, capped at `maxsize`.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Hashable, Optional
+
+from .settings import (
+    LNURL_IP_BURST,
+    LNURL_IP_RATE,
+    LNURL_SWITCH_BURST,
+    LNURL_SWITCH_RATE,
+    RATELIMIT_MAX_KEYS,
+)
+
+# removed per call at most, keeps the cost of a burst of evictions bounded
+EVICT_PER_CALL = 8
+
+
+class TokenBuckets:
+    """
+    Token buckets by key, each stored as (tokens, last update).
+
+    Not thread-safe; it is meant to be used from the event loop only.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.limited = 0
+        self._buckets: OrderedDict[Hashable, tuple[float, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and self.maxsize > 0
+
+    def take(self, key: Hashable, now: Optional[float] = None) -> bool:
+        """Take a token for `key`, False if its bucket is empty"""
+        if not self.enabled:
+            return True
+        now = monotonic() if now is None else now
+        self._evict(now)
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+            self.allowed += 1
+        else:
+            self.limited += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def _evict(self, now: float) -> None:
+        # the front holds the longest idle buckets
+        for _ in range(EVICT_PER_CALL):
+            if not self._buckets:
+                return
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            if (now - updated) * self.rate < self.burst - tokens:
+                return
+            del self._buckets[key]
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "size": len(self._buckets),
+            "maxsize": self.maxsize,
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+_ip_buckets = TokenBuckets(LNURL_IP_RATE, LNURL_IP_BURST, RATELIMIT_MAX_KEYS)
+_switch_buckets = TokenBuckets(
+    LNURL_SWITCH_RATE, LNURL_SWITCH_BURST, RATELIMIT_MAX_KEYS
+)
+
+
+def allow_client(client_ip: str) -> bool:
+    """Whether a client may scan, taking a token from its bucket"""
+    return _ip_buckets.take(client_ip)
+
+
+def allow_switch(device_id: str, switch_id: str) -> bool:
+    """Whether an existing switch may be scanned, taking a token from its bucket"""
+    return _switch_buckets.take((device_id, switch_id))
+
+
+def get_ratelimit_stats() -> dict:
+    return {"ip": _ip_buckets.stats(), "switch": _switch_buckets.stats()}
@@ -0,0 +1,96 @@
+"""
+Exchange-rate cache for fiat-priced switches.
+
+A background task refreshes the rates of the currencies our devices use, so
+LNURL scans normally read a cached rate. Rates older than RATE_MAX_AGE are
+still served while a refresh runs in the background (stale-while-revalidate),
+up to RATE_MAX_STALENESS, after which a scan fetches the rate itself.
+"""
+
+import asyncio
+import math
+from time import monotonic
+
+from loguru import logger
+
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
+
+from .crud import get_device_currencies
+from .settings import RATE_MAX_AGE, RATE_MAX_STALENESS, RATE_REFRESH_INTERVAL
+
+# currency -> (satoshis per unit, monotonic time fetched)
+_rates: dict[str, tuple[float, float]] = {}
+_refreshing: dict[str, asyncio.Task] = {}
+
+
+async def fetch_rate(currency: str) -> float:
+    rate = await get_fiat_rate_satoshis(currency)
+    # LNbits answers 0 when every provider failed, never cache that
+    if not math.isfinite(rate) or rate <= 0:
+        raise ValueError(f"no usable {currency} rate: {rate}")
+    _rates[currency] = (rate, monotonic())
+    return rate
+
+
+def _refresh_in_background(currency: str) -> None:
+    if currency in _refreshing:
+        return
+
+    async def _refresh():
+        try:
+            await fetch_rate(currency)
+        except Exception as e:
+            logger.warning(f"Could not refresh {currency} rate: {e}")
+        finally:
+            _refreshing.pop(currency, None)
+
+    _refreshing[currency] = asyncio.create_task(_refresh())
+
+
+async def get_sat_rate(currency: str) -> float:
+    """Satoshis per unit of `currency`"""
+    entry = _rates.get(currency)
+    if entry:
+        rate, fetched = entry
+        age = monotonic() - fetched
+        if age < RATE_MAX_AGE:
+            return rate
+        if age < RATE_MAX_STALENESS:
+            _refresh_in_background(currency)
+            return rate
+    return await fetch_rate(currency)
+
+
+async def get_price_msat(amount: float, currency: str) -> int:
+    """Price of a switch in millisatoshis, rounded down to whole satoshis"""
+    if currency == "sat":
+        return int(float(amount) * 1000)
+    return int(float(amount) * await get_sat_rate(currency)) * 1000
+
+
+async def refresh_exchange_rates() -> None:
+    """Keep the rates of all currencies in use fresh"""
+    while True:
+        try:
+            currencies = set(await get_device_currencies())
+        except Exception as e:
+            logger.warning(f"Could not load device currencies: {e}")
+            currencies = set(_rates.keys())
+        # currencies no device uses any more are not polled
+        for currency in set(_rates.keys()) - currencies:
+            _rates.pop(currency, None)
+        for currency in currencies:
+            try:
+                await fetch_rate(currency)
+            except Exception as e:
+                # keep serving the last rate until it is too stale
+                logger.warning(f"Could not refresh {currency} rate: {e}")
+        await asyncio.sleep(RATE_REFRESH_INTERVAL)
+
+
+def get_rate_stats() -> dict:
+    now = monotonic()
+    return {
+        currency: {"rate": rate, "age": round(now - fetched, 1)}
+        for currency, (rate, fetched) in _rates.items()
+    }
@@ -0,0 +1,85 @@
+"""
+Background removal of payments that were never paid.
+
+A payment is stored once a wallet asks for its invoice, and stays pending
+or invoiced when the customer walks away. The reaper deletes (or, with
+REAPER_ARCHIVE, archives) unpaid payments older than UNPAID_RETENTION in
+bounded batches, so no single run holds the table for long, and drops
+outbox triggers whose device never came back before they expired.
+"""
+
+import asyncio
+from time import monotonic, time
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from .crud import prune_expired_outbox, prune_unpaid_payments
+from .settings import (
+    REAPER_ARCHIVE,
+    REAPER_BATCH_SIZE,
+    REAPER_INTERVAL,
+    REAPER_MAX_BATCHES,
+    UNPAID_RETENTION,
+)
+
+_stats: dict = {
+    "runs": 0,
+    "payments_pruned": 0,
+    "triggers_pruned": 0,
+    "last_run": None,
+}
+
+
+async def _prune_in_batches(prune: Callable[[int], Awaitable[int]]) -> int:
+    total = 0
+    for _ in range(REAPER_MAX_BATCHES):
+        pruned = await prune(REAPER_BATCH_SIZE)
+        total += pruned
+        if pruned < REAPER_BATCH_SIZE:
+            break
+        # let requests in between batches
+        await asyncio.sleep(0)
+    return total
+
+
+async def reap_once() -> tuple[int, int]:
+    """One reaper run, returns the payments and triggers pruned"""
+    started = monotonic()
+    now = int(time())
+    cutoff = now - UNPAID_RETENTION
+    payments = await _prune_in_batches(
+        lambda limit: prune_unpaid_payments(cutoff, limit, REAPER_ARCHIVE)
+    )
+    triggers = await _prune_in_batches(
+        lambda limit: prune_expired_outbox(now, limit)
+    )
+
+    _stats["runs"] += 1
+    _stats["payments_pruned"] += payments
+    _stats["triggers_pruned"] += triggers
+    _stats["last_run"] = {
+        "at": now,
+        "payments": payments,
+        "triggers": triggers,
+        "duration_ms": round((monotonic() - started) * 1000, 1),
+    }
+    if payments or triggers:
+        logger.info(
+            f"DeviceTimer reaper {'archived' if REAPER_ARCHIVE else 'deleted'} "
+            f"{payments} unpaid payments and dropped {triggers} expired triggers"
+        )
+    return payments, triggers
+
+
+async def run_reaper() -> None:
+    while True:
+        try:
+            await reap_once()
+        except Exception as e:
+            logger.warning(f"DeviceTimer reaper failed: {e}")
+        await asyncio.sleep(REAPER_INTERVAL)
+
+
+def get_reaper_stats() -> dict:
+    return {**_stats, "retention": UNPAID_RETENTION, "archive": REAPER_ARCHIVE}
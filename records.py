@@ -0,0 +1,208 @@
+"""
+Immutable records for rows read on the hot paths.
+
+Rows come from our own tables, so validating them with Pydantic on every
+read buys nothing. crud.py decodes them into these slotted, frozen
+dataclasses instead, which are cheaper to build and smaller in memory, and
+can be shared through the device cache without defensive copies. The
+Pydantic models in models.py remain the API boundary: endpoints convert a
+record with `to_model()` right before returning it.
+"""
+
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .models import (
+    Lnurldevice,
+    LnurldevicePayment,
+    LnurldeviceSwitch,
+    LnurldeviceWindow,
+)
+from .schedule import CompiledSchedule
+
+
+def _load_json_list(value) -> list:
+    """Load a JSON list column, tolerating NULL and malformed values"""
+    if not value:
+        return []
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value) or []
+    except (json.JSONDecodeError, TypeError):
+        return []
+
+
+@dataclass(frozen=True, slots=True)
+class SwitchRecord:
+    id: str
+    amount: float
+    gpio_pin: int
+    gpio_duration: int
+    lnurl: Optional[str]
+    label: Optional[str]
+    trigger_ttl: int
+
+    @classmethod
+    def from_row(cls, row) -> "SwitchRecord":
+        return cls(
+            id=row["switch_id"],
+            amount=row["amount"],
+            gpio_pin=row["gpio_pin"],
+            gpio_duration=row["gpio_duration"],
+            lnurl=row["lnurl"],
+            label=row["label"],
+            trigger_ttl=row["trigger_ttl"],
+        )
+
+    @classmethod
+    def from_model(cls, switch: LnurldeviceSwitch) -> "SwitchRecord":
+        return cls(
+            id=switch.id or "",
+            amount=switch.amount,
+            gpio_pin=switch.gpio_pin,
+            gpio_duration=switch.gpio_duration,
+            lnurl=switch.lnurl,
+            label=switch.label,
+            trigger_ttl=switch.trigger_ttl,
+        )
+
+    def to_model(self) -> LnurldeviceSwitch:
+        return LnurldeviceSwitch(
+            id=self.id,
+            amount=self.amount,
+            gpio_pin=self.gpio_pin,
+            gpio_duration=self.gpio_duration,
+            lnurl=self.lnurl,
+            label=self.label,
+            trigger_ttl=self.trigger_ttl,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class WindowRecord:
+    days: tuple[int, ...]
+    start: str
+    stop: str
+
+
+@dataclass(frozen=True, slots=True)
+class DeviceRecord:
+    id: str
+    key: str
+    title: str
+    wallet: str
+    currency: str
+    switches: tuple[SwitchRecord, ...]
+    timestamp: str
+    available_start: str
+    available_stop: str
+    timeout: int
+    timezone: str
+    maxperday: Optional[int]
+    closed_url: Optional[str]
+    wait_url: Optional[str]
+    windows: tuple[WindowRecord, ...]
+    holidays: tuple[str, ...]
+    # compiled opening hours, see schedule.py; None if they do not compile
+    schedule: Optional[CompiledSchedule] = field(default=None, compare=False)
+
+    @classmethod
+    def from_row(cls, row, switches: list[SwitchRecord]) -> "DeviceRecord":
+        return cls(
+            id=row["id"],
+            key=row["key"],
+            title=row["title"],
+            wallet=row["wallet"],
+            currency=row["currency"],
+            switches=tuple(switches),
+            timestamp=str(row.get("timestamp") or ""),
+            available_start=row["available_start"],
+            available_stop=row["available_stop"],
+            timeout=row["timeout"],
+            timezone=row["timezone"],
+            maxperday=row["maxperday"],
+            closed_url=row["closed_url"],
+            wait_url=row["wait_url"],
+            windows=tuple(
+                WindowRecord(tuple(w.get("days", range(7))), w["start"], w["stop"])
+                for w in _load_json_list(row.get("windows"))
+            ),
+            holidays=tuple(_load_json_list(row.get("holidays"))),
+        )
+
+    def get_switch(self, switch_id: str) -> Optional[SwitchRecord]:
+        for switch in self.switches:
+            if switch.id == switch_id:
+                return switch
+        return None
+
+    def to_model(self) -> Lnurldevice:
+        return Lnurldevice(
+            id=self.id,
+            key=self.key,
+            title=self.title,
+            wallet=self.wallet,
+            currency=self.currency,
+            switches=[switch.to_model() for switch in self.switches],
+            timestamp=self.timestamp,
+            available_start=self.available_start,
+            available_stop=self.available_stop,
+            timeout=self.timeout,
+            timezone=self.timezone,
+            maxperday=self.maxperday,
+            closed_url=self.closed_url,
+            wait_url=self.wait_url,
+            windows=[
+                LnurldeviceWindow(days=list(w.days), start=w.start, stop=w.stop)
+                for w in self.windows
+            ],
+            holidays=list(self.holidays),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class PaymentRecord:
+    id: str
+    deviceid: str
+    payhash: str
+    payload: str
+    switchid: str
+    sats: int
+    status: str
+    epoch: int
+    delivery: Optional[str]
+    latency_ms: Optional[int]
+    timestamp: str
+
+    @classmethod
+    def from_row(cls, row) -> "PaymentRecord":
+        return cls(
+            id=row["id"],
+            deviceid=row["deviceid"],
+            payhash=row["payhash"] or "",
+            payload=row["payload"] or "",
+            switchid=row["switchid"],
+            sats=int(row["sats"] or 0),
+            status=row["status"] or "pending",
+            epoch=int(row["epoch"] or 0),
+            delivery=row.get("delivery"),
+            latency_ms=row.get("latency_ms"),
+            timestamp=str(row.get("timestamp") or ""),
+        )
+
+    def to_model(self) -> LnurldevicePayment:
+        return LnurldevicePayment(
+            id=self.id,
+            deviceid=self.deviceid,
+            payhash=self.payhash,
+            payload=self.payload,
+            switchid=self.switchid,
+            sats=self.sats,
+            status=self.status,
+            epoch=self.epoch,
+            delivery=self.delivery,
+            latency_ms=self.latency_ms,
+            timestamp=self.timestamp,
+        )
@@ -0,0 +1,381 @@
+"""
+Routing of device triggers across workers.
+
+A paid trigger is delivered by the worker that owns a hardware socket of
+the device. Workers announce the devices connected to them on the message
+bus (bus.py), so every worker knows where a device lives, and a trigger for
+a device owned by another worker is published for that worker to deliver.
+With the default in-process bus this reduces to local delivery.
+
+Routing a trigger takes a handshake: the dispatching worker offers it, the
+owner accepts if the device is still connected there, and only once the
+dispatcher confirms does the owner deliver it. An offer that is declined or
+not answered within BUS_ROUTE_TIMEOUT is queued in the outbox instead, so a
+trigger is not lost to a dead worker and never delivered by both.
+"""
+
+import asyncio
+import json
+from time import monotonic
+from typing import Optional
+from uuid import uuid4
+
+from loguru import logger
+
+from .admission import record_used
+from .bus import InProcessBus, MessageBus, create_bus
+from .cache import TTLCache
+from .crud import create_outbox_trigger, update_payment
+from .health import get_local_health, set_remote_health_provider
+from .models import LnurldeviceTrigger
+from .settings import (
+    BUS_BACKEND,
+    BUS_MAX_EVENT_BYTES,
+    BUS_PRESENCE_INTERVAL,
+    BUS_ROUTE_TIMEOUT,
+)
+from .status import device_presence_changed
+from .websocket import (
+    TriggerResult,
+    add_presence_listener,
+    device_lock,
+    drain_outbox,
+    get_local_device_ids,
+    is_device_connected,
+    notify_browsers,
+    replay_outbox,
+    send_trigger,
+    set_remote_device_provider,
+)
+
+_bus: MessageBus = InProcessBus()
+
+# worker id -> (device ids connected there, monotonic time last heard)
+_remote_devices: dict[str, tuple[set[str], float]] = {}
+# worker id -> health summaries of its devices, sent with presence snapshots
+_remote_health: dict[str, dict[str, dict]] = {}
+# worker id -> (snapshot id, parts, devices, health) of a presence snapshot
+# that is still arriving in parts
+_snapshots: dict[str, tuple[str, set[int], set[str], dict[str, dict]]] = {}
+
+# trigger id -> whether the owning worker accepted our offer
+_offers: dict[str, asyncio.Future] = {}
+# trigger id -> (trigger, ttl) offered to us, delivered once confirmed
+_accepted: TTLCache[str, tuple[LnurldeviceTrigger, int]] = TTLCache(
+    maxsize=1024, ttl=2 * BUS_ROUTE_TIMEOUT
+)
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _live_workers() -> dict[str, set[str]]:
+    cutoff = monotonic() - 3 * BUS_PRESENCE_INTERVAL
+    silent = [w for w, (_, seen) in _remote_devices.items() if seen < cutoff]
+    for worker_id in silent:
+        del _remote_devices[worker_id]
+        _remote_health.pop(worker_id, None)
+        _snapshots.pop(worker_id, None)
+    return {worker_id: devices for worker_id, (devices, _) in _remote_devices.items()}
+
+
+def get_remote_device_ids() -> set[str]:
+    return set().union(*_live_workers().values())
+
+
+def get_remote_health() -> dict[str, dict]:
+    health: dict[str, dict] = {}
+    for worker_id in _live_workers():
+        health.update(_remote_health.get(worker_id, {}))
+    return health
+
+
+def find_owner(device_id: str) -> Optional[str]:
+    """Worker holding a hardware socket of a device, if any other does"""
+    for worker_id, devices in _live_workers().items():
+        if device_id in devices:
+            return worker_id
+    return None
+
+
+async def deliver_trigger(trigger: LnurldeviceTrigger, ttl: int) -> str:
+    """
+    Fire a trigger on a device connected to this worker, record the outcome
+    on the payment and queue it in the outbox when it was not delivered.
+    Triggers queued earlier for the device are replayed first. Returns the
+    recorded delivery.
+    """
+    async with device_lock(trigger.deviceid):
+        if await replay_outbox(trigger.deviceid):
+            result = await send_trigger(
+                trigger.deviceid,
+                trigger.id,
+                trigger.pin,
+                trigger.duration,
+                trigger.paid_at or trigger.epoch,
+            )
+        else:
+            # the device went away while older triggers were replayed
+            result = TriggerResult("failed")
+        delivery = result.delivery
+        # only a trigger that never reached the device may be replayed later,
+        # an unacked one may have fired the relay already
+        if delivery == "failed" and ttl > 0:
+            await queue_trigger(trigger, ttl)
+            delivery = "queued"
+        await update_payment(
+            payment_id=trigger.id, delivery=delivery, latency_ms=result.latency_ms
+        )
+
+    if delivery == "acked":
+        logger.info(
+            f"Device {trigger.deviceid} actuated switch {trigger.switchid} "
+            f"after {result.latency_ms} ms ({result.attempts} attempts)"
+        )
+    elif delivery == "sent":
+        logger.info(
+            f"Payment notification sent to device {trigger.deviceid}: "
+            f"{trigger.pin}-{trigger.duration}"
+        )
+    elif delivery == "unacked":
+        logger.warning(
+            f"Device {trigger.deviceid} never acknowledged the trigger "
+            f"for payment {trigger.id}"
+        )
+    elif delivery == "failed":
+        logger.warning(
+            f"Trigger for payment {trigger.id} was not delivered "
+            f"to device {trigger.deviceid}"
+        )
+    return delivery
+
+
+async def queue_trigger(trigger: LnurldeviceTrigger, ttl: int) -> None:
+    # replayed by websocket_endpoint once the device reconnects
+    trigger.expires = trigger.epoch + ttl
+    await create_outbox_trigger(trigger)
+    logger.warning(
+        f"Device {trigger.deviceid} is offline, trigger for payment "
+        f"{trigger.id} queued for {ttl}s"
+    )
+    # the device may have connected, and drained its outbox, since it was
+    # found offline
+    if is_device_connected(trigger.deviceid):
+        _spawn(drain_outbox(trigger.deviceid))
+
+
+async def dispatch_trigger(trigger: LnurldeviceTrigger, ttl: int) -> str:
+    """
+    Deliver a paid trigger through whichever worker owns the device.
+    Returns the delivery, "routed" when another worker took it over.
+    """
+    message = f"{trigger.pin}-{trigger.duration}"
+    notify = {"type": "notify", "device": trigger.deviceid, "message": message}
+    if is_device_connected(trigger.deviceid):
+        await _publish(notify)
+        return await deliver_trigger(trigger, ttl)
+
+    notify_browsers(trigger.deviceid, message)
+    owner = find_owner(trigger.deviceid)
+    if owner:
+        # the offer also notifies the browsers on the other workers
+        if await _route(trigger, ttl, owner):
+            return "routed"
+        logger.warning(
+            f"Worker {owner} did not take the trigger for payment {trigger.id}"
+        )
+    else:
+        await _publish(notify)
+    if ttl > 0:
+        await queue_trigger(trigger, ttl)
+        await update_payment(payment_id=trigger.id, delivery="queued")
+        return "queued"
+    await update_payment(payment_id=trigger.id, delivery="failed")
+    return "failed"
+
+
+async def _route(trigger: LnurldeviceTrigger, ttl: int, owner: str) -> bool:
+    """Hand a trigger to the worker owning its device, True once it took it"""
+    accepted = asyncio.get_running_loop().create_future()
+    _offers[trigger.id] = accepted
+    try:
+        await _bus.publish(
+            {
+                "type": "trigger",
+                "target": owner,
+                "trigger": trigger.dict(),
+                "ttl": ttl,
+            }
+        )
+        if not await asyncio.wait_for(accepted, BUS_ROUTE_TIMEOUT):
+            return False
+        await _bus.publish({"type": "confirm", "target": owner, "id": trigger.id})
+        return True
+    except Exception as e:
+        logger.debug(f"Routing trigger {trigger.id} to {owner} failed: {e!r}")
+        return False
+    finally:
+        _offers.pop(trigger.id, None)
+
+
+async def publish_used(device_id: str, switch_id: str, epoch: int) -> None:
+    """Let the other workers' admission state see a paid trigger"""
+    await _publish(
+        {"type": "used", "device": device_id, "switch": switch_id, "epoch": epoch}
+    )
+
+
+async def _publish(event: dict) -> None:
+    try:
+        await _bus.publish(event)
+    except Exception as e:
+        logger.warning(f"Could not publish {event['type']} event: {e}")
+
+
+async def _handle_event(event: dict) -> None:
+    kind = event.get("type")
+    mine = event.get("target") == _bus.worker_id
+    if kind == "presence":
+        devices = set(event.get("devices") or [])
+        previous, _ = _remote_devices.get(event["origin"], (set(), 0.0))
+        if event.get("snapshot"):
+            snapshot = _snapshot_part(event)
+            if snapshot is None:
+                _remote_devices[event["origin"]] = (previous, monotonic())
+                return
+            known, _remote_health[event["origin"]] = snapshot
+        elif event.get("connected"):
+            known = previous | devices
+        else:
+            known = previous - devices
+        _remote_devices[event["origin"]] = (known, monotonic())
+        device_presence_changed(previous ^ known)
+    elif kind == "trigger":
+        trigger = LnurldeviceTrigger(**event["trigger"])
+        if mine:
+            accept = is_device_connected(trigger.deviceid)
+            if accept:
+                _accepted.set(trigger.id, (trigger, int(event.get("ttl") or 0)))
+            await _publish(
+                {
+                    "type": "accept",
+                    "target": event["origin"],
+                    "id": trigger.id,
+                    "accepted": accept,
+                }
+            )
+        else:
+            notify_browsers(trigger.deviceid, f"{trigger.pin}-{trigger.duration}")
+    elif kind == "accept" and mine:
+        offer = _offers.get(event["id"])
+        if offer and not offer.done():
+            offer.set_result(bool(event.get("accepted")))
+    elif kind == "confirm" and mine:
+        accepted = _accepted.pop(event["id"])
+        if accepted:
+            # delivering may take until the ACK deadline, do not hold the bus
+            _spawn(deliver_trigger(*accepted))
+    elif kind == "notify":
+        notify_browsers(event["device"], event["message"])
+    elif kind == "used":
+        record_used(event["device"], event["switch"], int(event["epoch"]))
+    elif kind == "leave":
+        devices, _ = _remote_devices.pop(event["origin"], (set(), 0.0))
+        _remote_health.pop(event["origin"], None)
+        _snapshots.pop(event["origin"], None)
+        device_presence_changed(devices)
+
+
+def _snapshot_part(event: dict) -> Optional[tuple[set[str], dict[str, dict]]]:
+    """Collect a part of a presence snapshot, return the devices once complete"""
+    origin = event["origin"]
+    snapshot = _snapshots.get(origin)
+    if not snapshot or snapshot[0] != event["snapshot"]:
+        snapshot = (event["snapshot"], set(), set(), {})
+        _snapshots[origin] = snapshot
+    _, parts, devices, health = snapshot
+    parts.add(int(event.get("part") or 0))
+    devices.update(event.get("devices") or [])
+    health.update(event.get("health") or {})
+    if len(parts) < int(event.get("parts") or 1):
+        return None
+    del _snapshots[origin]
+    return devices, health
+
+
+def presence_snapshot(devices: list[str]) -> list[dict]:
+    """
+    Presence snapshot events announcing `devices` and their health, split
+    so no event exceeds BUS_MAX_EVENT_BYTES
+    """
+    health = get_local_health(devices)
+    # leave room for the event's other fields and the origin
+    budget = BUS_MAX_EVENT_BYTES - 256
+    parts: list[tuple[list[str], dict[str, dict]]] = [([], {})]
+    size = 0
+    for device_id in devices:
+        cost = len(json.dumps(device_id)) + 2
+        if device_id in health:
+            cost += len(json.dumps({device_id: health[device_id]}))
+        if size + cost > budget and parts[-1][0]:
+            parts.append(([], {}))
+            size = 0
+        part_devices, part_health = parts[-1]
+        part_devices.append(device_id)
+        if device_id in health:
+            part_health[device_id] = health[device_id]
+        size += cost
+    snapshot = uuid4().hex[:8]
+    return [
+        {
+            "type": "presence",
+            "snapshot": snapshot,
+            "part": i,
+            "parts": len(parts),
+            "devices": part_devices,
+            "health": part_health,
+        }
+        for i, (part_devices, part_health) in enumerate(parts)
+    ]
+
+
+def _on_presence(device_id: str, connected: bool) -> None:
+    _spawn(
+        _publish({"type": "presence", "devices": [device_id], "connected": connected})
+    )
+
+
+async def run_message_bus() -> None:
+    """Connect to the configured bus and announce our devices periodically"""
+    global _bus
+    _bus = create_bus(BUS_BACKEND)
+    await _bus.start(_handle_event)
+    set_remote_device_provider(get_remote_device_ids)
+    set_remote_health_provider(get_remote_health)
+    add_presence_listener(_on_presence)
+    logger.info(f"DeviceTimer worker {_bus.worker_id} joined the {BUS_BACKEND} bus")
+    try:
+        while True:
+            for event in presence_snapshot(get_local_device_ids()):
+                await _publish(event)
+            await asyncio.sleep(BUS_PRESENCE_INTERVAL)
+    finally:
+        await _publish({"type": "leave"})
+        await _bus.stop()
+
+
+def get_bus_stats() -> dict:
+    return {
+        "backend": BUS_BACKEND,
+        "worker": _bus.worker_id,
+        "remote_workers": {
+            worker_id: len(devices) for worker_id, devices in _live_workers().items()
+        },
+    }
+
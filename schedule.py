@@ -0,0 +1,143 @@
+"""
+Compiled opening hours of a device.
+
+The opening hours (the legacy available_start/available_stop pair or the
+per-weekday windows) are compiled once per loaded device into a sorted array
+of open intervals over the minutes of a week. "Is it open now" and "when is
+the next transition" are then binary searches instead of re-parsing the
+configuration on every scan.
+"""
+
+import re
+from bisect import bisect_right
+from datetime import date, datetime, timedelta, tzinfo
+from functools import lru_cache
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+ALL_DAYS = list(range(7))
+
+
+def get_minutes(timestr: str) -> int:
+    """Convert a time string to minutes"""
+    result = re.search(r"^(\d{2}):(\d{2})$", timestr)
+    assert result, "illegal time format"
+    return int(result.groups()[0]) * 60 + int(result.groups()[1])
+
+
+@lru_cache(maxsize=None)
+def get_tzinfo(timezone: str) -> tzinfo:
+    return ZoneInfo(timezone)
+
+
+class CompiledSchedule:
+    """Open intervals of a week, Monday 00:00 is minute 0"""
+
+    __slots__ = ("tzinfo", "starts", "stops", "edges", "holidays")
+
+    def __init__(
+        self,
+        tz: tzinfo,
+        intervals: list[tuple[int, int]],
+        holidays: frozenset[date] = frozenset(),
+    ):
+        merged: list[list[int]] = []
+        for start, stop in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        self.tzinfo = tz
+        self.starts = [start for start, _ in merged]
+        self.stops = [stop for _, stop in merged]
+        self.edges = sorted({edge for pair in merged for edge in pair})
+        self.holidays = holidays
+
+    @staticmethod
+    def minute_of_week(local: datetime) -> int:
+        return local.weekday() * DAY_MINUTES + local.hour * 60 + local.minute
+
+    def _is_open_local(self, local: datetime) -> bool:
+        if local.date() in self.holidays:
+            return False
+        minute = self.minute_of_week(local)
+        i = bisect_right(self.starts, minute) - 1
+        return i >= 0 and minute < self.stops[i]
+
+    def local_time(self, now: Optional[datetime] = None) -> datetime:
+        if now is None:
+            return datetime.now(self.tzinfo)
+        return now.astimezone(self.tzinfo)
+
+    def is_open(self, now: Optional[datetime] = None) -> bool:
+        return self._is_open_local(self.local_time(now))
+
+    def next_transition(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Return the next time the open/closed state changes, if it ever does"""
+        if not self.holidays and (
+            not self.starts or self.starts == [0] and self.stops == [WEEK_MINUTES]
+        ):
+            return None
+        local = self.local_time(now).replace(second=0, microsecond=0)
+        state = self._is_open_local(local)
+        # every step lands on an interval edge or a midnight, a year of
+        # steps is more than enough to leave any run of holidays
+        for _ in range(2 * len(self.edges) + 2 * 366):
+            local = self._next_edge(local)
+            if self._is_open_local(local) != state:
+                return local
+        return None
+
+    def _next_edge(self, local: datetime) -> datetime:
+        minute = self.minute_of_week(local)
+        i = bisect_right(self.edges, minute)
+        if i < len(self.edges):
+            delta = self.edges[i] - minute
+        elif self.edges:
+            delta = self.edges[0] + WEEK_MINUTES - minute
+        else:
+            delta = WEEK_MINUTES
+        if self.holidays:
+            delta = min(delta, DAY_MINUTES - local.hour * 60 - local.minute)
+        return local + timedelta(minutes=delta)
+
+
+def window_intervals(days: list[int], start: str, stop: str) -> list[tuple[int, int]]:
+    """
+    Open intervals of one daily window on the given weekdays.
+
+    As before, the stop minute itself is still open and a stop at or before
+    the start wraps past midnight into the next day.
+    """
+    start_minutes = get_minutes(start)
+    stop_minutes = get_minutes(stop)
+    if stop_minutes <= start_minutes:
+        stop_minutes += DAY_MINUTES
+    stop_minutes += 1
+
+    intervals = []
+    for day in days:
+        begin = day * DAY_MINUTES + start_minutes
+        end = day * DAY_MINUTES + stop_minutes
+        if end > WEEK_MINUTES:
+            intervals.append((begin, WEEK_MINUTES))
+            intervals.append((0, end - WEEK_MINUTES))
+        else:
+            intervals.append((begin, end))
+    return intervals
+
+
+def compile_schedule(device) -> CompiledSchedule:
+    """Compile the opening hours of a device"""
+    intervals: list[tuple[int, int]] = []
+    if device.windows:
+        for window in device.windows:
+            intervals += window_intervals(window.days, window.start, window.stop)
+    else:
+        intervals = window_intervals(
+            ALL_DAYS, device.available_start, device.available_stop
+        )
+    holidays = frozenset(date.fromisoformat(day) for day in device.holidays or [])
+    return CompiledSchedule(get_tzinfo(device.timezone), intervals, holidays)
@@ -0,0 +1,132 @@
+"""
+Runtime tunables for the DeviceTimer extension.
+
+Every value can be overridden with an environment variable of the same name
+prefixed with ``DEVICETIMER_``, e.g. ``DEVICETIMER_DEVICE_CACHE_TTL=30``.
+"""
+
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(f"DEVICETIMER_{name}")
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(f"DEVICETIMER_{name}")
+    return float(value) if value else default
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(f"DEVICETIMER_{name}") or default
+
+
+# Device cache (crud.get_device)
+DEVICE_CACHE_SIZE = _env_int("DEVICE_CACHE_SIZE", 1024)
+DEVICE_CACHE_TTL = _env_float("DEVICE_CACHE_TTL", 60)
+# wallets whose device ids are indexed (crud.get_device_ids_by_wallets), kept
+# for DEVICE_CACHE_TTL like the devices
+WALLET_INDEX_SIZE = _env_int("WALLET_INDEX_SIZE", 1024)
+
+# Admission state (crud.get_payment_allowed), see admission.py. States are
+# re-seeded after ADMISSION_STATE_TTL or the device's timeout if shorter.
+ADMISSION_CACHE_SIZE = _env_int("ADMISSION_CACHE_SIZE", 4096)
+ADMISSION_STATE_TTL = _env_float("ADMISSION_STATE_TTL", 300)
+
+# Rendered QR codes (views.devicetimer_qrcode)
+QR_CACHE_SIZE = _env_int("QR_CACHE_SIZE", 1024)
+QR_CACHE_TTL = _env_float("QR_CACHE_TTL", 3600)
+# seconds a client may reuse an OPEN QR code before revalidating
+QR_MAX_AGE = _env_int("QR_MAX_AGE", 5)
+
+# closed_url / wait_url image proxy (proxy.py)
+PROXY_CACHE_SIZE = _env_int("PROXY_CACHE_SIZE", 256)
+PROXY_CACHE_TTL = _env_float("PROXY_CACHE_TTL", 300)
+PROXY_TIMEOUT = _env_float("PROXY_TIMEOUT", 5)
+PROXY_MAX_BYTES = _env_int("PROXY_MAX_BYTES", 2 * 1024 * 1024)
+PROXY_MAX_REDIRECTS = _env_int("PROXY_MAX_REDIRECTS", 3)
+
+# Exchange rates of fiat-priced switches (rates.py)
+RATE_REFRESH_INTERVAL = _env_float("RATE_REFRESH_INTERVAL", 60)
+RATE_MAX_AGE = _env_float("RATE_MAX_AGE", 120)
+RATE_MAX_STALENESS = _env_float("RATE_MAX_STALENESS", 900)
+
+# WebSocket delivery (websocket.py)
+WS_SEND_TIMEOUT = _env_float("WS_SEND_TIMEOUT", 2)
+WS_QUEUE_SIZE_HARDWARE = _env_int("WS_QUEUE_SIZE_HARDWARE", 64)
+WS_QUEUE_SIZE_BROWSER = _env_int("WS_QUEUE_SIZE_BROWSER", 16)
+
+# Acknowledged triggers (websocket.send_trigger, protocol 2)
+TRIGGER_ACK_DEADLINE = _env_float("TRIGGER_ACK_DEADLINE", 10)
+TRIGGER_RETRY_DELAY = _env_float("TRIGGER_RETRY_DELAY", 0.5)
+
+# Cross-worker message bus (bus.py, routing.py): inprocess, sqlite or postgres
+BUS_BACKEND = _env_str("BUS_BACKEND", "inprocess")
+BUS_POLL_INTERVAL = _env_float("BUS_POLL_INTERVAL", 0.05)
+BUS_RETENTION = _env_float("BUS_RETENTION", 60)
+# workers re-announce their devices this often, silent workers are forgotten
+# after three intervals
+BUS_PRESENCE_INTERVAL = _env_float("BUS_PRESENCE_INTERVAL", 10)
+# presence snapshots are split into events of at most this many bytes, below
+# the 8000 byte payload limit of Postgres NOTIFY
+BUS_MAX_EVENT_BYTES = _env_int("BUS_MAX_EVENT_BYTES", 7000)
+# a trigger routed to another worker is queued in the outbox instead when
+# that worker does not accept it within this many seconds
+BUS_ROUTE_TIMEOUT = _env_float("BUS_ROUTE_TIMEOUT", 2)
+# a lost Postgres bus connection is re-established after this delay,
+# doubling up to the maximum while it keeps failing
+BUS_RECONNECT_DELAY = _env_float("BUS_RECONNECT_DELAY", 1)
+BUS_RECONNECT_MAX_DELAY = _env_float("BUS_RECONNECT_MAX_DELAY", 30)
+
+# Dashboard status stream (status.py): a keepalive comment is sent and the
+# full status re-checked this often
+STATUS_KEEPALIVE = _env_float("STATUS_KEEPALIVE", 15)
+
+# Heartbeats (websocket.py): protocol 2 hardware is pinged every interval and
+# evicted when no pong arrives within the timeout. Protocol 1 firmware cannot
+# answer pings; with an idle timeout it is disconnected after that long
+# without sending anything and reconnects, 0 (the default) disables this.
+# Health records of devices are kept for HEALTH_RETENTION.
+HEARTBEAT_INTERVAL = _env_float("HEARTBEAT_INTERVAL", 20)
+HEARTBEAT_TIMEOUT = _env_float("HEARTBEAT_TIMEOUT", 10)
+HEARTBEAT_IDLE_TIMEOUT = _env_float("HEARTBEAT_IDLE_TIMEOUT", 0)
+HEARTBEAT_RTT_SAMPLES = _env_int("HEARTBEAT_RTT_SAMPLES", 128)
+HEALTH_CACHE_SIZE = _env_int("HEALTH_CACHE_SIZE", 4096)
+HEALTH_RETENTION = _env_float("HEALTH_RETENTION", 86400)
+
+# Paid-invoice processing (tasks.py): payments of one device are handled in
+# order, up to INVOICE_WORKERS devices at a time
+INVOICE_WORKERS = _env_int("INVOICE_WORKERS", 8)
+INVOICE_LAG_SAMPLES = _env_int("INVOICE_LAG_SAMPLES", 1000)
+
+# Re-read every row written by crud.py and log mismatches, for debugging
+VERIFY_WRITES = _env_str("VERIFY_WRITES", "") in ("1", "true", "yes")
+
+# Reaper (reaper.py): payments whose invoice was requested but never paid
+# are removed after UNPAID_RETENTION seconds, at most REAPER_BATCH_SIZE rows
+# per statement and REAPER_MAX_BATCHES statements per run. With
+# REAPER_ARCHIVE they are moved to devicetimer.payment_archive instead.
+REAPER_INTERVAL = _env_float("REAPER_INTERVAL", 300)
+UNPAID_RETENTION = _env_int("UNPAID_RETENTION", 86400)
+REAPER_BATCH_SIZE = _env_int("REAPER_BATCH_SIZE", 500)
+REAPER_MAX_BATCHES = _env_int("REAPER_MAX_BATCHES", 20)
+REAPER_ARCHIVE = _env_str("REAPER_ARCHIVE", "") in ("1", "true", "yes")
+
+# Signed LNURL callback tokens (tokens.py). Tokens are signed with the
+# device key and this secret; set it to the same value on every worker.
+CALLBACK_SECRET = _env_str("CALLBACK_SECRET", "")
+CALLBACK_TOKEN_TTL = _env_int("CALLBACK_TOKEN_TTL", 600)
+
+# Memoised LNURL encoding and decoding (helpers.py), entries per direction
+LNURL_CACHE_SIZE = _env_int("LNURL_CACHE_SIZE", 4096)
+
+# Scan-flood protection on the LNURL endpoints (ratelimit.py). Token buckets
+# per client IP and per (device, switch) hold up to *_BURST scans and refill
+# at *_RATE scans per second; a rate of 0 disables that limit. At most
+# RATELIMIT_MAX_KEYS buckets of each kind are kept.
+LNURL_IP_RATE = _env_float("LNURL_IP_RATE", 1)
+LNURL_IP_BURST = _env_float("LNURL_IP_BURST", 20)
+LNURL_SWITCH_RATE = _env_float("LNURL_SWITCH_RATE", 2)
+LNURL_SWITCH_BURST = _env_float("LNURL_SWITCH_BURST", 30)
+RATELIMIT_MAX_KEYS = _env_int("RATELIMIT_MAX_KEYS", 65536)
@@ -21,7 +21,7 @@ window.app = Vue.createApp({
       activeWebsocket: null,
       activeWebsocketDeviceId: null,
       connectedDevices: [],
-      statusPollInterval: null,
+      statusStream: null,
       protocol: window.location.protocol,
       wsLocation: '',
 
@@ -169,38 +169,42 @@ window.app = Vue.createApp({
       this.stats.offlineDevices = this.stats.totalDevices - this.stats.connectedDevices
     },
 
-    async fetchConnectionStatus() {
-      try {
-        const response = await LNbits.api.request(
-          'GET',
-          '/devicetimer/api/v1/ws/status',
+    startStatusStream() {
+      // Server-sent events: a snapshot first, then connect/disconnect deltas.
+      // EventSource reconnects on its own and gets a fresh snapshot.
+      this.stopStatusStream()
+      const stream = new EventSource(
+        '/devicetimer/api/v1/ws/status/stream?api-key=' +
           this.g.user.wallets[0].inkey
-        )
-        if (response.data && response.data.connected) {
-          this.connectedDevices = response.data.connected
-          this.calculateStats()
-        }
-      } catch (err) {
-        console.warn('Failed to fetch connection status')
+      )
+      stream.addEventListener('snapshot', event => {
+        this.connectedDevices = JSON.parse(event.data).connected
+        this.calculateStats()
+      })
+      stream.addEventListener('presence', event => {
+        const change = JSON.parse(event.data)
+        this.connectedDevices = this.connectedDevices
+          .filter(id => !change.disconnected.includes(id))
+          .concat(change.connected.filter(id => !this.connectedDevices.includes(id)))
+        this.calculateStats()
+      })
+      stream.onerror = () => {
+        console.warn('Connection status stream interrupted')
       }
+      this.statusStream = stream
     },
 
-    startStatusPolling() {
-      // Poll every 60 seconds
-      this.fetchConnectionStatus()
-      this.statusPollInterval = setInterval(() => {
-        this.fetchConnectionStatus()
-      }, 60000)
-    },
-
-    stopStatusPolling() {
-      if (this.statusPollInterval) {
-        clearInterval(this.statusPollInterval)
-        this.statusPollInterval = null
+    stopStatusStream() {
+      if (this.statusStream) {
+        this.statusStream.close()
+        this.statusStream = null
       }
     },
 
     formatHours(device) {
+      if (device.windows && device.windows.length) {
+        return device.windows.map(w => `${w.start} - ${w.stop}`).join(', ')
+      }
       return `${device.available_start} - ${device.available_stop}`
     },
 
@@ -425,8 +429,6 @@ window.app = Vue.createApp({
 
         ws.onmessage = (event) => {
           this.websocketMessage = 'Payment received!'
-          // Refresh status after payment
-          setTimeout(() => this.fetchConnectionStatus(), 1000)
         }
 
         ws.onclose = () => {
@@ -538,7 +540,7 @@ window.app = Vue.createApp({
     this.wsLocation = (window.location.protocol === 'https:' ? 'wss://' : 'ws://') + window.location.host
 
     await this.getDevices()
-    this.startStatusPolling()
+    this.startStatusStream()
 
     try {
       const response = await LNbits.api.request('GET', '/devicetimer/api/v1/timezones')
@@ -549,7 +551,7 @@ window.app = Vue.createApp({
   },
 
   beforeUnmount() {
-    this.stopStatusPolling()
+    this.stopStatusStream()
     this.disconnectWebsocket()
   }
 })
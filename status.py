@@ -0,0 +1,142 @@
+"""
+Connection status of the caller's devices for the dashboard.
+
+GET /api/v1/ws/status returns the connected devices of the caller's wallets
+once, with their last-seen and round-trip times (health.py).
+GET /api/v1/ws/status/stream is a server-sent event stream that starts with
+a "snapshot" event and then sends a "presence" event whenever devices
+connect or disconnect, on this worker or, through routing.py, on any other:
+
+    event: snapshot
+    data: {"connected": ["<device id>", ...]}
+
+    event: presence
+    data: {"connected": ["<device id>"], "disconnected": []}
+
+EventSource cannot send headers, pass the invoice key as `?api-key=`.
+"""
+
+import asyncio
+import json
+from typing import AsyncIterator, Iterable
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from lnbits.core.crud import get_user
+from lnbits.core.models import WalletTypeInfo
+from lnbits.decorators import require_invoice_key
+
+from .crud import get_device_ids_by_wallets
+from .health import get_device_health
+from .settings import STATUS_KEEPALIVE
+from .websocket import add_presence_listener, get_connected_among
+
+devicetimer_status_router = APIRouter()
+
+
+class StatusSubscriber:
+    """Device ids whose presence changed since a stream last looked"""
+
+    __slots__ = ("changed", "wakeup")
+
+    def __init__(self):
+        self.changed: set[str] = set()
+        self.wakeup = asyncio.Event()
+
+
+_subscribers: set[StatusSubscriber] = set()
+
+
+def device_presence_changed(device_ids: Iterable[str]) -> None:
+    """Wake the streams after devices connected or disconnected anywhere"""
+    device_ids = set(device_ids)
+    if not device_ids:
+        return
+    for subscriber in _subscribers:
+        subscriber.changed |= device_ids
+        subscriber.wakeup.set()
+
+
+def _on_local_presence(device_id: str, _connected: bool) -> None:
+    device_presence_changed((device_id,))
+
+
+def _event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _wallet_ids(wallet: WalletTypeInfo) -> list[str]:
+    user = await get_user(wallet.wallet.user)
+    return user.wallet_ids if user else [wallet.wallet.id]
+
+
+async def _stream(request: Request, wallet_ids: list[str]) -> AsyncIterator[str]:
+    subscriber = StatusSubscriber()
+    _subscribers.add(subscriber)
+    try:
+        device_ids = await get_device_ids_by_wallets(wallet_ids)
+        connected = get_connected_among(device_ids)
+        yield _event("snapshot", {"connected": sorted(connected)})
+
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.wakeup.wait(), STATUS_KEEPALIVE)
+                full_check = False
+            except asyncio.TimeoutError:
+                # also catches workers that went silent without leaving
+                full_check = True
+            subscriber.wakeup.clear()
+            changed, subscriber.changed = subscriber.changed, set()
+            if await request.is_disconnected():
+                break
+
+            # the index also follows devices created or deleted meanwhile
+            device_ids = await get_device_ids_by_wallets(wallet_ids)
+            candidates = (device_ids | connected) if full_check else changed
+            online = get_connected_among(candidates & device_ids)
+            came = online - connected
+            went = (candidates & connected) - online
+            if came or went:
+                connected = (connected - went) | came
+                yield _event(
+                    "presence",
+                    {"connected": sorted(came), "disconnected": sorted(went)},
+                )
+            elif full_check:
+                yield ": keepalive\n\n"
+    finally:
+        _subscribers.discard(subscriber)
+
+
+@devicetimer_status_router.get("/api/v1/ws/status")
+async def api_websocket_status(wallet: WalletTypeInfo = Depends(require_invoice_key)):
+    """
+    Return the connected devices of the caller's wallets, on any worker,
+    with when each device was last seen and its heartbeat round-trip times.
+    """
+    device_ids = await get_device_ids_by_wallets(await _wallet_ids(wallet))
+    health = {device_id: get_device_health(device_id) for device_id in device_ids}
+    return {
+        "connected": sorted(get_connected_among(device_ids)),
+        "health": {
+            device_id: summary for device_id, summary in health.items() if summary
+        },
+    }
+
+
+@devicetimer_status_router.get("/api/v1/ws/status/stream")
+async def api_websocket_status_stream(
+    request: Request, wallet: WalletTypeInfo = Depends(require_invoice_key)
+):
+    """
+    Stream connection status changes of the caller's devices.
+    Used by frontend to show real-time connection status.
+    """
+    add_presence_listener(_on_local_presence)
+    wallet_ids = await _wallet_ids(wallet)
+    return StreamingResponse(
+        _stream(request, wallet_ids),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
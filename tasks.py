@@ -1,20 +1,105 @@
 import asyncio
+from collections import deque
+from time import monotonic, time
 
 from loguru import logger
 from lnbits.core.models import Payment
 from lnbits.tasks import register_invoice_listener
 
-from .crud import get_payment, update_payment, get_device
-from .websocket import send_to_device
+from .admission import record_used
+from .crud import claim_payment, get_switch
+from .helpers import percentile
+from .models import LnurldeviceTrigger
+from .routing import dispatch_trigger, publish_used
+from .settings import INVOICE_LAG_SAMPLES, INVOICE_WORKERS
+
+
+class InvoiceLanes:
+    """
+    Per-device queues of paid invoices served by a fixed pool of workers.
+
+    A device is held by at most one worker at a time, so its payments are
+    handled in the order they arrived, while other devices' payments run
+    in parallel. A worker hands a device back after each payment, so one
+    busy device cannot starve the others.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # device id -> (payment, monotonic time received) in arrival order
+        self.lanes: dict[str, deque[tuple[Payment, float]]] = {}
+        # devices with waiting payments and no worker on them
+        self.ready: asyncio.Queue[str] = asyncio.Queue()
+        self.busy: set[str] = set()
+        self.lags_ms: deque[float] = deque(maxlen=INVOICE_LAG_SAMPLES)
+        self.processed = 0
+        self.failed = 0
+
+    def put(self, payment: Payment) -> None:
+        device_id = str(payment.extra.get("Device") or payment.extra.get("id"))
+        lane = self.lanes.setdefault(device_id, deque())
+        lane.append((payment, monotonic()))
+        if len(lane) == 1 and device_id not in self.busy:
+            self.ready.put_nowait(device_id)
+
+    async def work(self) -> None:
+        while True:
+            device_id = await self.ready.get()
+            lane = self.lanes[device_id]
+            payment, received = lane[0]
+            self.busy.add(device_id)
+            self.lags_ms.append((monotonic() - received) * 1000)
+            try:
+                await on_invoice_paid(payment)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to process payment {payment.payment_hash}: {e}")
+            finally:
+                self.busy.discard(device_id)
+                lane.popleft()
+                if lane:
+                    self.ready.put_nowait(device_id)
+                else:
+                    del self.lanes[device_id]
+
+    def stats(self) -> dict:
+        lags = sorted(self.lags_ms)
+        return {
+            "workers": self.workers,
+            "queued": sum(len(lane) for lane in self.lanes.values()),
+            "devices_queued": len(self.lanes),
+            "in_progress": len(self.busy),
+            "processed": self.processed,
+            "failed": self.failed,
+            "lag_ms": {
+                "p50": round(percentile(lags, 0.5), 1) if lags else None,
+                "p95": round(percentile(lags, 0.95), 1) if lags else None,
+                "max": round(lags[-1], 1) if lags else None,
+            },
+        }
+
+
+_lanes = InvoiceLanes(INVOICE_WORKERS)
+
+
+def get_invoice_stats() -> dict:
+    return _lanes.stats()
 
 
 async def wait_for_paid_invoices() -> None:
     invoice_queue: asyncio.Queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, "ext_devicetimer")
 
-    while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+    workers = [asyncio.create_task(_lanes.work()) for _ in range(_lanes.workers)]
+    try:
+        while True:
+            payment = await invoice_queue.get()
+            if payment.extra.get("tag") == "DeviceTimer":
+                _lanes.put(payment)
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 
 async def on_invoice_paid(payment: Payment) -> None:
@@ -22,32 +107,31 @@ async def on_invoice_paid(payment: Payment) -> None:
     if payment.extra.get("tag") != "DeviceTimer":
         return
 
-    device_payment = await get_payment(payment.extra["id"])
-
+    paid_at = time()
+    used_at = int(paid_at)
+    device_payment = await claim_payment(payment.extra["id"], used_at)
+    # unknown, or already claimed by an earlier delivery of this invoice
     if not device_payment:
         return
-    if device_payment.payhash == "used":
-        return
-
-    await update_payment(payment_id=payment.extra["id"], payhash="used")
 
-    device = await get_device(device_payment.deviceid)
-    if not device:
-        return
+    record_used(device_payment.deviceid, device_payment.switchid, used_at)
+    await publish_used(device_payment.deviceid, device_payment.switchid, used_at)
 
-    switch = None
-    for _switch in device.switches:
-        if _switch.id == device_payment.switchid:
-            switch = _switch
-            break
+    switch = await get_switch(device_payment.deviceid, device_payment.switchid)
     if not switch:
         return
 
-    # Send trigger command to hardware via our WebSocket
-    message = f"{switch.gpio_pin}-{switch.gpio_duration}"
-    sent = await send_to_device(device_payment.deviceid, message)
-
-    if sent:
-        logger.info(f"Payment notification sent to device {device_payment.deviceid}: {message}")
-    else:
-        logger.warning(f"No active connection for device {device_payment.deviceid}")
+    # Send trigger command to hardware via our WebSocket, on whichever
+    # worker the device is connected to
+    trigger = LnurldeviceTrigger(
+        id=device_payment.id,
+        deviceid=device_payment.deviceid,
+        switchid=switch.id,
+        pin=switch.gpio_pin,
+        duration=switch.gpio_duration,
+        epoch=used_at,
+        paid_at=paid_at,
+        # set from the switch's trigger_ttl if it has to be queued
+        expires=used_at,
+    )
+    await dispatch_trigger(trigger, switch.trigger_ttl)
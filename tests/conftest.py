@@ -0,0 +1,29 @@
+"""
+Makes `devicetimer.<module>` importable for the tests without running the
+extension's __init__.py, which needs a running LNbits. Only code that does
+not touch the database is tested here; modules importing crud.py get a
+throw-away LNbits data folder. Run from the repository root with
+
+    python -m pytest tests
+
+tests/pytest.ini keeps pytest from treating the repository root, which has
+an __init__.py, as a package to import.
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# the extension's modules must not shadow libraries, e.g. lnurl.py
+sys.path[:] = [p for p in sys.path if Path(p or ".").resolve() != ROOT]
+
+os.environ.setdefault("LNBITS_DATA_FOLDER", tempfile.mkdtemp(prefix="devicetimer-"))
+
+if "devicetimer" not in sys.modules:
+    package = ModuleType("devicetimer")
+    package.__path__ = [str(ROOT)]
+    sys.modules["devicetimer"] = package
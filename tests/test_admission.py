@@ -0,0 +1,81 @@
+import pytest
+
+from devicetimer import admission
+from devicetimer.admission import (
+    DAY_SECONDS,
+    AdmissionState,
+    buffer_size,
+    get_state,
+    record_used,
+    seed_state,
+    state_ttl,
+)
+from devicetimer.models import PaymentAllowed
+
+NOW = 1_700_000_000
+
+
+@pytest.fixture(autouse=True)
+def clear_states():
+    admission._states.clear()
+    yield
+    admission._states.clear()
+
+
+def test_open_without_payments():
+    state = AdmissionState([], 1)
+    assert state.decide(NOW, maxperday=0, timeout=30) == PaymentAllowed.OPEN
+
+
+def test_wait_within_timeout():
+    state = AdmissionState([NOW - 10], 1)
+    assert state.decide(NOW, maxperday=0, timeout=30) == PaymentAllowed.WAIT
+    assert state.decide(NOW + 20, maxperday=0, timeout=30) == PaymentAllowed.OPEN
+
+
+def test_closed_at_maxperday():
+    epochs = [NOW - 3600, NOW - 1800, NOW - 60]
+    state = AdmissionState(epochs, buffer_size(3))
+    assert state.decide(NOW, maxperday=3, timeout=0) == PaymentAllowed.CLOSED
+    assert state.decide(NOW, maxperday=4, timeout=0) == PaymentAllowed.OPEN
+
+
+def test_maxperday_only_counts_the_last_day():
+    epochs = [NOW - DAY_SECONDS - 1, NOW - 60]
+    state = AdmissionState(epochs, buffer_size(2))
+    assert state.decide(NOW, maxperday=2, timeout=0) == PaymentAllowed.OPEN
+
+
+def test_closed_wins_over_wait():
+    state = AdmissionState([NOW - 5], buffer_size(1))
+    assert state.decide(NOW, maxperday=1, timeout=30) == PaymentAllowed.CLOSED
+
+
+def test_record_keeps_order_and_size():
+    state = AdmissionState([NOW - 30, NOW - 10], 2)
+    state.record(NOW - 20)
+    assert list(state.used) == [NOW - 20, NOW - 10]
+    state.record(NOW)
+    assert list(state.used) == [NOW - 10, NOW]
+
+
+def test_record_used_updates_seeded_state_only():
+    record_used("dev", "sw", NOW)
+    assert get_state("dev", "sw", 1) is None
+
+    seed_state("dev", "sw", [], 1)
+    record_used("dev", "sw", NOW)
+    state = get_state("dev", "sw", 1)
+    assert state and state.decide(NOW + 1, 0, 30) == PaymentAllowed.WAIT
+
+
+def test_changed_maxperday_reseeds():
+    seed_state("dev", "sw", [NOW], buffer_size(1))
+    assert get_state("dev", "sw", buffer_size(5)) is None
+
+
+def test_state_ttl_capped_at_timeout(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_STATE_TTL", 300)
+    assert state_ttl(30) == 30
+    assert state_ttl(0) == 300
+    assert state_ttl(3600) == 300
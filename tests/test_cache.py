@@ -0,0 +1,61 @@
+from devicetimer import cache
+from devicetimer.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_set_and_stats(monkeypatch):
+    monkeypatch.setattr(cache, "monotonic", Clock())
+    items: TTLCache[str, int] = TTLCache(maxsize=4, ttl=10)
+    assert items.get("a") is None
+    items.set("a", 1)
+    assert items.get("a") == 1
+    stats = items.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+
+
+def test_entries_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "monotonic", clock)
+    items: TTLCache[str, int] = TTLCache(maxsize=4, ttl=10)
+    items.set("a", 1)
+    items.set("b", 2, ttl=30)
+    clock.now += 10
+    assert "a" not in items
+    assert items.get("a") is None
+    assert items.peek("b") == 2
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(cache, "monotonic", Clock())
+    items: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10)
+    items.set("a", 1)
+    items.set("b", 2)
+    items.get("a")
+    items.set("c", 3)
+    assert items.peek("a") == 1
+    assert items.peek("b") is None
+    assert len(items) == 2
+
+
+def test_zero_maxsize_stores_nothing():
+    items: TTLCache[str, int] = TTLCache(maxsize=0, ttl=10)
+    items.set("a", 1)
+    assert len(items) == 0
+
+
+def test_values_skips_expired(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "monotonic", clock)
+    items: TTLCache[str, int] = TTLCache(maxsize=4, ttl=10)
+    items.set("a", 1)
+    items.set("b", 2, ttl=30)
+    clock.now += 10
+    assert items.values() == [2]
+    assert (items.hits, items.misses) == (0, 0)
@@ -0,0 +1,56 @@
+import pytest
+
+from devicetimer.helpers import (
+    decode_lnurl,
+    encode_lnurl,
+    is_valid_lnurl,
+    percentile,
+)
+
+URL = "https://lnbits.example.com/devicetimer/api/v2/lnurl/dev?switch_id=sw"
+
+
+def test_encode_round_trip():
+    lnurl = encode_lnurl(URL)
+    assert lnurl.startswith("LNURL1") and lnurl == lnurl.upper()
+    assert decode_lnurl(lnurl) == URL
+
+
+def test_encode_rejects_invalid_urls():
+    with pytest.raises(ValueError):
+        encode_lnurl("not a url")
+
+
+def test_valid_lnurl_any_case():
+    lnurl = encode_lnurl(URL)
+    assert is_valid_lnurl(lnurl)
+    assert is_valid_lnurl(lnurl.lower())
+
+
+@pytest.mark.parametrize("value", [None, "", "lnurl", "LNURL1qqqq", URL])
+def test_invalid_lnurls(value):
+    assert not is_valid_lnurl(value)
+
+
+def test_target_url_must_match():
+    lnurl = encode_lnurl(URL)
+    assert is_valid_lnurl(lnurl, URL)
+    assert not is_valid_lnurl(lnurl, URL.replace("switch_id=sw", "switch_id=xx"))
+    assert not is_valid_lnurl(lnurl, URL.replace("lnbits.example", "other.example"))
+
+
+def test_scheme_change_keeps_lnurl_valid():
+    lnurl = encode_lnurl(URL)
+    assert is_valid_lnurl(lnurl, URL.replace("https://", "http://"))
+
+
+def test_decode_failures_return_none():
+    assert decode_lnurl("LNURL1INVALID") is None
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 1.0) == 100
+    assert percentile([7], 0.5) == 7
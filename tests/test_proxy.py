@@ -0,0 +1,92 @@
+import asyncio
+
+import httpx
+import pytest
+
+from devicetimer import proxy
+from devicetimer.proxy import image_media_type, proxy_allowed
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://example.com/a.png",
+        "https://localhost/a.png",
+        "https://cam.localhost/a.png",
+        "https://127.0.0.1/a.png",
+        "https://[::1]/a.png",
+        "https://0.0.0.0/a.png",
+        "https://10.1.2.3/a.png",
+        "https://192.168.0.10/a.png",
+        "https://169.254.169.254/latest/meta-data",
+        "https://[::ffff:127.0.0.1]/a.png",
+        "https://example.com:99999/a.png",
+        "",
+        None,
+    ],
+)
+def test_refuses_local_and_plain_urls(url):
+    assert not proxy_allowed(url)
+
+
+def test_allows_public_https():
+    assert proxy_allowed("https://example.com/a.png")
+    assert proxy_allowed("https://1.1.1.1/a.png")
+
+
+def test_image_media_type():
+    assert image_media_type("image/PNG; charset=binary") == "image/png"
+    assert image_media_type("text/html") is None
+    assert image_media_type("application/xhtml+xml") is None
+    assert image_media_type(None) is None
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        routes = {
+            "/internal": httpx.Response(
+                302, headers={"location": "http://169.254.169.254/latest"}
+            ),
+            "/moved": httpx.Response(302, headers={"location": "/a.png"}),
+            "/page": httpx.Response(
+                200, headers={"content-type": "text/html"}, content=b"<script>"
+            ),
+        }
+        return routes.get(
+            request.url.path,
+            httpx.Response(200, headers={"content-type": "image/png"}, content=b"png"),
+        )
+
+    async def resolve_public(host: str, port: int) -> str:
+        return "93.184.216.34"
+
+    requests: list[httpx.Request] = []
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(proxy, "_client", client)
+    monkeypatch.setattr(proxy, "_resolve_public", resolve_public)
+    proxy._images.clear()
+    proxy._stale.clear()
+    yield requests
+    asyncio.run(client.aclose())
+
+
+def test_redirects_are_checked_per_hop(upstream):
+    assert asyncio.run(proxy.fetch_image("https://example.com/internal")) is None
+    image = asyncio.run(proxy.fetch_image("https://example.com/moved"))
+    assert image and image.content == b"png"
+
+
+def test_only_images_are_fetched(upstream):
+    assert asyncio.run(proxy.fetch_image("https://example.com/page")) is None
+
+
+def test_connects_to_the_checked_address(upstream):
+    assert asyncio.run(proxy.fetch_image("https://example.com:8443/a.png"))
+    request = upstream[-1]
+    assert request.url.host == "93.184.216.34"
+    assert request.url.port == 8443
+    assert request.headers["host"] == "example.com:8443"
+    assert request.extensions["sni_hostname"] == "example.com"
@@ -0,0 +1,54 @@
+from devicetimer.ratelimit import TokenBuckets
+
+
+def test_burst_then_limited():
+    buckets = TokenBuckets(rate=1, burst=3, maxsize=10)
+    assert [buckets.take("ip", now=0) for _ in range(4)] == [True, True, True, False]
+    assert (buckets.allowed, buckets.limited) == (3, 1)
+
+
+def test_bucket_refills_at_rate():
+    buckets = TokenBuckets(rate=2, burst=2, maxsize=10)
+    assert buckets.take("ip", now=0) and buckets.take("ip", now=0)
+    assert not buckets.take("ip", now=0.25)
+    assert buckets.take("ip", now=0.5)
+    assert not buckets.take("ip", now=0.5)
+
+
+def test_refill_is_capped_at_burst():
+    buckets = TokenBuckets(rate=1, burst=2, maxsize=10)
+    buckets.take("ip", now=0)
+    taken = [buckets.take("ip", now=1000) for _ in range(3)]
+    assert taken == [True, True, False]
+
+
+def test_keys_are_independent():
+    buckets = TokenBuckets(rate=1, burst=1, maxsize=10)
+    assert buckets.take("a", now=0)
+    assert not buckets.take("a", now=0)
+    assert buckets.take("b", now=0)
+
+
+def test_full_buckets_are_evicted():
+    buckets = TokenBuckets(rate=1, burst=2, maxsize=10)
+    buckets.take("a", now=0)
+    buckets.take("b", now=0)
+    assert len(buckets) == 2
+    # both refilled after a second
+    buckets.take("c", now=1)
+    assert len(buckets) == 1
+
+
+def test_size_is_bounded():
+    buckets = TokenBuckets(rate=0.001, burst=1, maxsize=2)
+    for key in "abc":
+        assert buckets.take(key, now=0)
+    assert len(buckets) == 2
+    # the oldest key was dropped and starts with a full bucket again
+    assert buckets.take("a", now=0)
+
+
+def test_zero_rate_disables():
+    buckets = TokenBuckets(rate=0, burst=1, maxsize=10)
+    assert all(buckets.take("ip", now=0) for _ in range(100))
+    assert len(buckets) == 0
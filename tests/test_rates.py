@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from devicetimer import rates
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    answers: dict[str, float] = {}
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        return answers[currency]
+
+    monkeypatch.setattr(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    rates._rates.clear()
+    yield answers
+    rates._rates.clear()
+
+
+def test_failed_lookup_keeps_last_rate(provider):
+    provider["EUR"] = 1500.0
+    assert asyncio.run(rates.get_price_msat(5, "EUR")) == 7500 * 1000
+    for bad in (0.0, float("nan")):
+        provider["EUR"] = bad
+        with pytest.raises(ValueError):
+            asyncio.run(rates.fetch_rate("EUR"))
+    assert rates._rates["EUR"][0] == 1500.0
+    assert asyncio.run(rates.get_price_msat(5, "EUR")) == 7500 * 1000
+
+
+def test_refresh_drops_unused_currencies(provider, monkeypatch):
+    provider.update(EUR=1500.0, USD=1400.0)
+    asyncio.run(rates.fetch_rate("USD"))
+
+    async def get_device_currencies():
+        return ["EUR"]
+
+    async def stop(_):
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(rates, "get_device_currencies", get_device_currencies)
+    monkeypatch.setattr(rates.asyncio, "sleep", stop)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(rates.refresh_exchange_rates())
+    assert set(rates._rates) == {"EUR"}
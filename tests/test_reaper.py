@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from devicetimer import reaper
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(reaper, "REAPER_BATCH_SIZE", 10)
+    monkeypatch.setattr(reaper, "REAPER_MAX_BATCHES", 3)
+
+
+def backlog(rows: int):
+    calls: list[int] = []
+
+    async def prune(limit: int) -> int:
+        nonlocal rows
+        calls.append(limit)
+        pruned = min(rows, limit)
+        rows -= pruned
+        return pruned
+
+    return prune, calls
+
+
+def test_stops_after_a_short_batch():
+    prune, calls = backlog(15)
+    assert asyncio.run(reaper._prune_in_batches(prune)) == 15
+    assert calls == [10, 10]
+
+
+def test_exact_multiple_needs_an_empty_batch():
+    prune, calls = backlog(20)
+    assert asyncio.run(reaper._prune_in_batches(prune)) == 20
+    assert calls == [10, 10, 10]
+
+
+def test_batches_per_run_are_capped():
+    prune, calls = backlog(100)
+    assert asyncio.run(reaper._prune_in_batches(prune)) == 30
+    assert len(calls) == 3
+
+
+def test_nothing_to_prune():
+    prune, calls = backlog(0)
+    assert asyncio.run(reaper._prune_in_batches(prune)) == 0
+    assert calls == [10]
@@ -0,0 +1,105 @@
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+from devicetimer.schedule import (
+    WEEK_MINUTES,
+    CompiledSchedule,
+    compile_schedule,
+    get_tzinfo,
+    window_intervals,
+)
+
+BERLIN = get_tzinfo("Europe/Berlin")
+
+
+def device(start="08:00", stop="20:00", windows=None, holidays=None, tz="UTC"):
+    return SimpleNamespace(
+        available_start=start,
+        available_stop=stop,
+        windows=[SimpleNamespace(**w) for w in windows or []],
+        holidays=holidays or [],
+        timezone=tz,
+    )
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_stop_minute_is_open():
+    schedule = compile_schedule(device("08:00", "20:00"))
+    # 2024-01-01 is a Monday
+    assert not schedule.is_open(utc(2024, 1, 1, 7, 59))
+    assert schedule.is_open(utc(2024, 1, 1, 8, 0))
+    assert schedule.is_open(utc(2024, 1, 1, 20, 0))
+    assert not schedule.is_open(utc(2024, 1, 1, 20, 1))
+
+
+def test_window_wraps_past_midnight():
+    schedule = compile_schedule(device("22:00", "02:00"))
+    assert schedule.is_open(utc(2024, 1, 1, 23, 30))
+    assert schedule.is_open(utc(2024, 1, 2, 1, 30))
+    assert not schedule.is_open(utc(2024, 1, 2, 2, 1))
+    assert not schedule.is_open(utc(2024, 1, 2, 12, 0))
+
+
+def test_sunday_window_wraps_into_monday():
+    intervals = window_intervals([6], "23:00", "01:00")
+    assert intervals == [(6 * 1440 + 23 * 60, WEEK_MINUTES), (0, 61)]
+    schedule = CompiledSchedule(timezone.utc, intervals)
+    # 2024-01-07 is a Sunday
+    assert schedule.is_open(utc(2024, 1, 7, 23, 30))
+    assert schedule.is_open(utc(2024, 1, 8, 0, 30))
+    assert not schedule.is_open(utc(2024, 1, 8, 1, 30))
+
+
+def test_weekday_windows_and_split_shifts():
+    windows = [
+        {"days": [0, 1, 2, 3, 4], "start": "08:00", "stop": "12:00"},
+        {"days": [0, 1, 2, 3, 4], "start": "14:00", "stop": "18:00"},
+    ]
+    schedule = compile_schedule(device(windows=windows))
+    assert schedule.is_open(utc(2024, 1, 1, 9, 0))
+    assert not schedule.is_open(utc(2024, 1, 1, 13, 0))
+    assert schedule.is_open(utc(2024, 1, 1, 15, 0))
+    # Saturday
+    assert not schedule.is_open(utc(2024, 1, 6, 9, 0))
+    assert schedule.next_transition(utc(2024, 1, 1, 9, 0)) == utc(2024, 1, 1, 12, 1)
+
+
+def test_holidays_are_closed():
+    schedule = compile_schedule(device("00:00", "23:59", holidays=["2024-12-25"]))
+    assert schedule.holidays == frozenset({date(2024, 12, 25)})
+    assert not schedule.is_open(utc(2024, 12, 25, 12, 0))
+    assert schedule.is_open(utc(2024, 12, 26, 12, 0))
+    assert schedule.next_transition(utc(2024, 12, 24, 12, 0)) == utc(2024, 12, 25)
+
+
+def test_hours_follow_local_time_across_dst():
+    schedule = compile_schedule(device("08:00", "20:00", tz="Europe/Berlin"))
+    # winter, UTC+1
+    assert schedule.is_open(utc(2024, 3, 30, 7, 0))
+    assert not schedule.is_open(utc(2024, 3, 30, 6, 59))
+    # clocks went forward on 2024-03-31, UTC+2
+    assert schedule.is_open(utc(2024, 3, 31, 6, 0))
+    assert not schedule.is_open(utc(2024, 3, 31, 5, 59))
+    assert schedule.is_open(utc(2024, 3, 31, 18, 0))
+    assert not schedule.is_open(utc(2024, 3, 31, 18, 1))
+
+
+def test_next_transition_across_dst():
+    schedule = compile_schedule(device("08:00", "20:00", tz="Europe/Berlin"))
+    opens = schedule.next_transition(utc(2024, 3, 30, 21, 0))
+    assert opens is not None
+    assert opens.astimezone(BERLIN).hour == 8
+    assert opens == utc(2024, 3, 31, 6, 0)
+    # clocks went back on 2024-10-27, UTC+1 again
+    closes = schedule.next_transition(utc(2024, 10, 27, 10, 0))
+    assert closes == utc(2024, 10, 27, 19, 1)
+
+
+def test_always_open_has_no_transition():
+    window = {"days": list(range(7)), "start": "00:00", "stop": "00:00"}
+    schedule = compile_schedule(device(windows=[window]))
+    assert schedule.is_open(utc(2024, 1, 3, 3, 3))
+    assert schedule.next_transition(utc(2024, 1, 3, 3, 3)) is None
@@ -0,0 +1,63 @@
+import pytest
+
+from devicetimer import tokens
+from devicetimer.tokens import CallbackToken, issue_token, parse_token
+
+KEY = "device-key"
+NOW = 1_700_000_000
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    monkeypatch.setattr(tokens, "time", lambda: NOW)
+    monkeypatch.setattr(tokens, "CALLBACK_SECRET", "secret")
+
+
+def issue() -> CallbackToken:
+    token = parse_token(issue_token("dev", KEY, "sw", 21000))
+    assert token
+    return token
+
+
+def test_round_trip():
+    token = issue()
+    assert (token.device_id, token.switch_id, token.msat) == ("dev", "sw", 21000)
+    assert token.expires == NOW + tokens.CALLBACK_TOKEN_TTL
+    assert token.is_valid(KEY)
+    assert parse_token(str(token)) == token
+
+
+@pytest.mark.parametrize(
+    "field, value",
+    [("msat", 1), ("switch_id", "other"), ("expires", NOW + 10**6), ("nonce", "x")],
+)
+def test_tampered_fields_fail(field, value):
+    token = issue()._replace(**{field: value})
+    assert not token.is_valid(KEY)
+
+
+def test_wrong_key_or_secret_fails(monkeypatch):
+    token = issue()
+    assert not token.is_valid("other-key")
+    monkeypatch.setattr(tokens, "CALLBACK_SECRET", "rotated")
+    assert not token.is_valid(KEY)
+
+
+def test_expired_token_fails():
+    token = issue()
+    assert token.is_valid(KEY, now=token.expires)
+    assert not token.is_valid(KEY, now=token.expires + 1)
+
+
+def test_payment_id_is_stable_per_token():
+    first, second = issue(), issue()
+    assert first.payment_id == parse_token(str(first)).payment_id
+    assert first.payment_id != second.payment_id
+    assert len(first.payment_id) == 22
+
+
+@pytest.mark.parametrize(
+    "value", ["", "abc", "a.b.c.d.e", "dev.sw.x.1.n.sig", "dev.sw.1.-1.n.sig"]
+)
+def test_malformed_tokens_are_rejected(value):
+    assert parse_token(value) is None
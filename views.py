@@ -1,9 +1,10 @@
+from hashlib import sha256
 from http import HTTPStatus
 from io import BytesIO
 from pathlib import Path
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse, Response
+from fastapi.responses import HTMLResponse, FileResponse, Response
 
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
@@ -12,14 +13,21 @@ from lnbits.settings import settings
 
 from loguru import logger
 import pyqrcode
-import httpx
 
-from .crud import get_device, get_payment_allowed
+from .cache import TTLCache
+from .crud import get_device, get_payment_allowed, update_switch_lnurls
 from .helpers import encode_lnurl, is_valid_lnurl
 from .models import PaymentAllowed
+from .proxy import fetch_image, image_media_type, proxy_allowed
+from .settings import QR_CACHE_SIZE, QR_CACHE_TTL, QR_MAX_AGE
 
 devicetimer_generic_router = APIRouter()
 
+# Rendered QR codes by (lnurl, scale, format)
+_qrcode_cache: TTLCache[tuple[str, int, str], bytes] = TTLCache(
+    maxsize=QR_CACHE_SIZE, ttl=QR_CACHE_TTL
+)
+
 
 def devicetimer_renderer():
     return template_renderer(["devicetimer/templates"])
@@ -32,19 +40,6 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
     )
 
 
-def proxy_allowed(url: str | None) -> bool:
-    """Check if URL is allowed to be proxied"""
-    if not url:
-        return False
-    if "localhost" in url.lower():
-        return False
-    if "127.0.0.1" in url:
-        return False
-    if url.startswith("https://"):
-        return True
-    return False
-
-
 def default_unavailable_image() -> FileResponse:
     image_path = Path(
         settings.lnbits_extensions_path,
@@ -64,6 +59,38 @@ def default_unavailable_image() -> FileResponse:
     )
 
 
+def qrcode_etag(lnurl: str, scale: int, fmt: str) -> str:
+    """
+    Strong ETag of a QR code. The image is a pure function of its inputs,
+    so the tag is derived from them and a 304 never needs a render.
+    """
+    digest = sha256(f"{lnurl}|{scale}|{fmt}".encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def render_qrcode(lnurl: str, scale: int = 3, fmt: str = "svg") -> bytes:
+    key = (lnurl, scale, fmt)
+    image = _qrcode_cache.get(key)
+    if image is None:
+        stream = BytesIO()
+        pyqrcode.create(lnurl).svg(stream, scale=scale)
+        image = stream.getvalue()
+        _qrcode_cache.set(key, image)
+    return image
+
+
+def get_qrcode_cache_stats() -> dict:
+    return _qrcode_cache.stats()
+
+
 @devicetimer_generic_router.get("/device/{deviceid}/{switchid}/qrcode")
 async def devicetimer_qrcode(request: Request, deviceid: str, switchid: str):
     """
@@ -76,62 +103,54 @@ async def devicetimer_qrcode(request: Request, deviceid: str, switchid: str):
             status_code=HTTPStatus.NOT_FOUND, detail="Device does not exist"
         )
 
-    switch = None
-    for _switch in device.switches:
-        if _switch.id == switchid:
-            switch = _switch
-            break
-
+    switch = device.get_switch(switchid)
     if not switch:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Switch does not exist"
         )
 
     result = await get_payment_allowed(device, switch)
-    logger.info(f"get_payment_allowed result = {result}")
-
-    if result == PaymentAllowed.CLOSED:
-        if proxy_allowed(device.closed_url):
-            try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(device.closed_url)
-                    return Response(response.content)
-            except Exception as e:
-                logger.error(f"Failed to retrieve closed image: {e}")
-        return default_unavailable_image()
-
-    if result == PaymentAllowed.WAIT:
-        if proxy_allowed(device.wait_url):
-            try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(device.wait_url)
-                    return Response(response.content)
-            except Exception as e:
-                logger.error(f"Failed to retrieve wait image: {e}")
-        return default_unavailable_image()
-
-    # Ensure LNURL is properly bech32 encoded
-    lnurl_value = switch.lnurl
-    if not is_valid_lnurl(lnurl_value):
-        base_url = str(request.url_for("devicetimer.lnurl_v2_params", device_id=deviceid))
-        full_url = f"{base_url}?switch_id={switchid}"
-        lnurl_value = encode_lnurl(full_url)
-        logger.info(f"Generated LNURL on-the-fly for QR: {lnurl_value[:20]}...")
-
-    qr = pyqrcode.create(lnurl_value)
-    stream = BytesIO()
-    qr.svg(stream, scale=3)
-    stream.seek(0)
-
-    async def _generator(stream: BytesIO):
-        yield stream.getvalue()
-
-    return StreamingResponse(
-        _generator(stream),
-        headers={
-            "Content-Type": "image/svg+xml",
+    logger.debug(f"get_payment_allowed result = {result}")
+
+    if result in (PaymentAllowed.CLOSED, PaymentAllowed.WAIT):
+        url = device.closed_url if result == PaymentAllowed.CLOSED else device.wait_url
+        image = await fetch_image(url) if url and proxy_allowed(url) else None
+        # served from the LNbits origin, so never anything but an image
+        if not image or not image_media_type(image.content_type):
+            return default_unavailable_image()
+        headers = {
             "Cache-Control": "no-cache, no-store, must-revalidate",
             "Pragma": "no-cache",
             "Expires": "0",
-        },
+            "X-Content-Type-Options": "nosniff",
+        }
+        if image.content_type == "image/svg+xml":
+            # SVG can carry scripts
+            headers["Content-Security-Policy"] = "sandbox"
+        return Response(
+            content=image.content, media_type=image.content_type, headers=headers
+        )
+
+    # Ensure LNURL is properly bech32 encoded and points at this server
+    lnurl_value = switch.lnurl
+    base_url = str(request.url_for("devicetimer.lnurl_v2_params", device_id=deviceid))
+    full_url = f"{base_url}?switch_id={switchid}"
+    if not is_valid_lnurl(lnurl_value, full_url):
+        lnurl_value = encode_lnurl(full_url)
+        await update_switch_lnurls(deviceid, {switchid: lnurl_value})
+        logger.info(f"Stored regenerated LNURL for QR: {lnurl_value[:20]}...")
+
+    etag = qrcode_etag(lnurl_value, 3, "svg")
+    headers = {
+        "ETag": etag,
+        # short enough for a CLOSED or WAIT image to replace the QR promptly
+        "Cache-Control": f"private, max-age={QR_MAX_AGE}, must-revalidate",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    return Response(
+        content=render_qrcode(lnurl_value, 3, "svg"),
+        media_type="image/svg+xml",
+        headers=headers,
     )
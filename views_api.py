@@ -1,8 +1,10 @@
+from datetime import date
 from http import HTTPStatus
 import re
 import zoneinfo
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from loguru import logger
 
 from lnbits.core.crud import get_user
@@ -14,33 +16,96 @@ from lnbits.decorators import (
 )
 from lnbits.utils.exchange_rates import currencies
 
+from .admission import get_admission_stats
 from .crud import (
     create_device,
     delete_device,
     get_device,
+    get_actuation_latencies,
+    get_device_cache_stats,
+    DEVICE_SORT_COLUMNS,
     get_devices,
+    get_devices_page,
+    get_failed_actuations,
     update_device,
+    update_switch_lnurls,
 )
-from .helpers import encode_lnurl, is_valid_lnurl
-from .models import CreateLnurldevice, Lnurldevice
-
+from .helpers import (
+    encode_lnurl,
+    get_lnurl_cache_stats,
+    is_valid_lnurl,
+    percentile,
+)
+from .models import (
+    ActuationStats,
+    CreateLnurldevice,
+    Lnurldevice,
+    LnurldevicePage,
+)
+from .proxy import get_proxy_cache_stats
+from .records import DeviceRecord
+from .rates import get_rate_stats
+from .ratelimit import get_ratelimit_stats
+from .reaper import get_reaper_stats
+from .routing import get_bus_stats
+from .tasks import get_invoice_stats
+from .views import get_qrcode_cache_stats
 
-def fix_device_lnurls(device: Lnurldevice, req: Request) -> Lnurldevice:
-    """Ensure all switch LNURLs are properly bech32 encoded"""
-    if not device.switches:
-        return device
 
+async def fix_device_lnurls(device: DeviceRecord, req: Request) -> Lnurldevice:
+    """
+    Convert a device to its API model, ensuring all switch LNURLs are
+    properly bech32 encoded and point at this server. Corrected LNURLs are
+    stored, the request knows the public URL of the server.
+    """
+    model = device.to_model()
     base_url = str(req.url_for("devicetimer.lnurl_v2_params", device_id=device.id))
-    for switch in device.switches:
-        if not is_valid_lnurl(switch.lnurl):
-            full_url = f"{base_url}?switch_id={switch.id}"
-            switch.lnurl = encode_lnurl(full_url)
+    fixed: dict[str, str] = {}
+    for switch in model.switches:
+        full_url = f"{base_url}?switch_id={switch.id}"
+        if not is_valid_lnurl(switch.lnurl, full_url):
+            switch.lnurl = fixed[switch.id] = encode_lnurl(full_url)
+    if fixed:
+        await update_switch_lnurls(device.id, fixed)
 
-    return device
+    return model
 
 devicetimer_api_router = APIRouter()
 
 
+def check_schedule(data: CreateLnurldevice) -> None:
+    """Validate the opening windows and holidays of a device"""
+    for window in data.windows or []:
+        for value in (window.start, window.stop):
+            if not re.search(r"^\d{2}:\d{2}$", value):
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    detail="Window time format must be hh:mm",
+                )
+        if not window.days or any(day not in range(7) for day in window.days):
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail="Window days must be weekdays 0 (Monday) to 6 (Sunday)",
+            )
+    for holiday in data.holidays or []:
+        try:
+            date.fromisoformat(holiday)
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail="Holiday format must be yyyy-mm-dd",
+            ) from exc
+
+
+def check_switches(data: CreateLnurldevice) -> None:
+    """Switch ids key the switch table, they must be unique per device"""
+    switch_ids = [switch.id for switch in data.switches or [] if switch.id]
+    if len(switch_ids) != len(set(switch_ids)):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Switch ids must be unique"
+        )
+
+
 @devicetimer_api_router.get("/api/v1/currencies", status_code=HTTPStatus.OK)
 async def api_list_currencies_available() -> list[str]:
     return list(currencies.keys())
@@ -83,7 +148,10 @@ async def api_lnurldevice_create(
     else:
         data.maxperday = 0
 
-    return await create_device(data, req)
+    check_schedule(data)
+    check_switches(data)
+    device = await create_device(data, req)
+    return device.to_model()
 
 
 @devicetimer_api_router.put(
@@ -118,7 +186,10 @@ async def api_lnurldevice_update(
     else:
         data.maxperday = 0
 
-    return await update_device(lnurldevice_id, data, req)
+    check_schedule(data)
+    check_switches(data)
+    device = await update_device(lnurldevice_id, data, req)
+    return device.to_model()
 
 
 @devicetimer_api_router.get("/api/v1/device", status_code=HTTPStatus.OK)
@@ -129,7 +200,42 @@ async def api_lnurldevices_retrieve(
     assert user, "Lnurldevice cannot retrieve user"
     devices = await get_devices(user.wallet_ids)
     # Ensure all LNURLs are properly encoded
-    return [fix_device_lnurls(d, req) for d in devices]
+    return [await fix_device_lnurls(d, req) for d in devices]
+
+
+@devicetimer_api_router.get("/api/v1/devices", status_code=HTTPStatus.OK)
+async def api_lnurldevices_page(
+    req: Request,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    search: Optional[str] = None,
+    sort: str = "title",
+    descending: bool = False,
+    summary: bool = False,
+) -> LnurldevicePage:
+    """
+    Paginated device listing. Pass next_cursor of a page as `cursor` to
+    get the next one; `summary` leaves out switches and opening hours.
+    """
+    if sort not in DEVICE_SORT_COLUMNS:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"sort must be one of {', '.join(DEVICE_SORT_COLUMNS)}",
+        )
+    user = await get_user(wallet.wallet.user)
+    assert user, "Lnurldevice cannot retrieve user"
+    try:
+        devices, next_cursor = await get_devices_page(
+            user.wallet_ids, cursor, limit, search, sort, descending, summary
+        )
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+    if not summary:
+        devices = [await fix_device_lnurls(d, req) for d in devices]
+    return LnurldevicePage(data=devices, next_cursor=next_cursor)
 
 
 @devicetimer_api_router.get(
@@ -145,7 +251,28 @@ async def api_lnurldevice_retrieve(
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="lnurldevice does not exist"
         )
-    return fix_device_lnurls(device, req)
+    return await fix_device_lnurls(device, req)
+
+
+@devicetimer_api_router.get(
+    "/api/v1/device/{lnurldevice_id}/actuation",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(require_invoice_key)],
+)
+async def api_lnurldevice_actuation(lnurldevice_id: str) -> ActuationStats:
+    """Payment-to-relay latency and unconfirmed triggers of a device"""
+    device = await get_device(lnurldevice_id)
+    if not device:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="lnurldevice does not exist"
+        )
+    latencies = sorted(await get_actuation_latencies(lnurldevice_id))
+    return ActuationStats(
+        count=len(latencies),
+        p50_ms=percentile(latencies, 0.5) if latencies else None,
+        p99_ms=percentile(latencies, 0.99) if latencies else None,
+        failed=[p.to_model() for p in await get_failed_actuations(lnurldevice_id)],
+    )
 
 
 @devicetimer_api_router.delete(
@@ -161,3 +288,24 @@ async def api_lnurldevice_delete(req: Request, lnurldevice_id: str):
         )
     await delete_device(lnurldevice_id)
     return {"deleted": True}
+
+
+@devicetimer_api_router.get(
+    "/api/v1/metrics",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(check_admin)],
+)
+async def api_metrics() -> dict:
+    """Internal counters of the extension, for operators"""
+    return {
+        "device_cache": get_device_cache_stats(),
+        "admission": get_admission_stats(),
+        "qrcode_cache": get_qrcode_cache_stats(),
+        "lnurl_cache": get_lnurl_cache_stats(),
+        "image_cache": get_proxy_cache_stats(),
+        "exchange_rates": get_rate_stats(),
+        "bus": get_bus_stats(),
+        "paid_invoices": get_invoice_stats(),
+        "reaper": get_reaper_stats(),
+        "ratelimit": get_ratelimit_stats(),
+    }
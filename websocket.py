@@ -4,120 +4,491 @@ WebSocket management for DeviceTimer extension.
 Handles device connections and message broadcasting.
 Tracks connected hardware devices to show real-time status in UI.
 Browser connections (for watching payments) are tracked separately.
+Every connection is wrapped in a DeviceConnection with its own outbound
+queue, see connection.py.
+
+Hardware speaks one of two protocols, chosen with the `protocol` query
+parameter when connecting:
+
+1 (default): the server sends "{gpio_pin}-{gpio_duration}" and gets no
+   confirmation.
+2: the server sends
+   {"v": 2, "type": "trigger", "id": "<payment id>", "pin": 21, "duration": 2100}
+   and the device answers {"v": 2, "type": "ack", "id": "<payment id>"} once
+   the relay fired. Triggers are resent with backoff until acknowledged or
+   TRIGGER_ACK_DEADLINE passes; devices must ignore repeated ids. An ACK
+   only counts on a connection the trigger was written to. A trigger that
+   was written but never acknowledged is recorded as "unacked" and never
+   sent again, the relay may have fired.
+   Every HEARTBEAT_INTERVAL the server also sends
+   {"v": 2, "type": "ping", "id": "<n>"} and expects
+   {"v": 2, "type": "pong", "id": "<n>"} within HEARTBEAT_TIMEOUT, otherwise
+   the connection is considered dead and evicted. Round-trip times of the
+   pings are kept per device, see health.py.
+
+Protocol 1 firmware cannot be pinged; the server's transport pings catch
+its half-open sockets. Optionally it is disconnected after
+HEARTBEAT_IDLE_TIMEOUT without sending anything (0, the default, disables
+this), which is not counted as an eviction.
 """
 
+import asyncio
+import json
+from weakref import WeakValueDictionary
+from time import monotonic, time
+
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from loguru import logger
-from typing import Dict, Set, Optional
+from typing import Callable, Dict, NamedTuple, Set, Optional
+
+from .connection import DeviceConnection, OverflowPolicy
+from .crud import delete_outbox_triggers, get_outbox_triggers, update_payment
+from .health import device_health
+from .settings import (
+    HEARTBEAT_IDLE_TIMEOUT,
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_TIMEOUT,
+    TRIGGER_ACK_DEADLINE,
+    TRIGGER_RETRY_DELAY,
+    WS_QUEUE_SIZE_BROWSER,
+    WS_QUEUE_SIZE_HARDWARE,
+    WS_SEND_TIMEOUT,
+)
 
 devicetimer_websocket_router = APIRouter()
 
-# Track hardware device connections: device_id -> set of WebSocket connections
-_hardware_clients: Dict[str, Set[WebSocket]] = {}
+# Track hardware device connections: device_id -> set of connections
+_hardware_clients: Dict[str, Set[DeviceConnection]] = {}
 
 # Track browser connections (for payment notifications in UI)
-_browser_clients: Dict[str, Set[WebSocket]] = {}
+_browser_clients: Dict[str, Set[DeviceConnection]] = {}
+
+# Triggers waiting for a protocol 2 ACK: (device id, message id) ->
+# (ACK future, connections the trigger was written to)
+PendingAck = tuple[asyncio.Future, Set[DeviceConnection]]
+_pending_acks: Dict[tuple[str, str], PendingAck] = {}
+
+# Held while a device's outbox is replayed or a new trigger is delivered to
+# it, so its triggers fire in payment order. Unused locks are dropped.
+_device_locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+
+# Keep references to fire-and-forget tasks until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# Called with (device_id, connected) when a device's first hardware
+# connection opens or its last one closes on this worker
+PresenceListener = Callable[[str, bool], None]
+_presence_listeners: list[PresenceListener] = []
 
+# Device ids connected to other workers, provided by routing.py
+_remote_device_ids: Callable[[], Set[str]] = set
 
-def get_connected_device_ids() -> list[str]:
-    """Return list of device IDs with active hardware connections."""
+
+def add_presence_listener(listener: PresenceListener) -> None:
+    if listener not in _presence_listeners:
+        _presence_listeners.append(listener)
+
+
+def set_remote_device_provider(provider: Callable[[], Set[str]]) -> None:
+    global _remote_device_ids
+    _remote_device_ids = provider
+
+
+def _notify_presence(device_id: str, connected: bool) -> None:
+    for listener in _presence_listeners:
+        try:
+            listener(device_id, connected)
+        except Exception as e:
+            logger.warning(f"Presence listener failed: {e}")
+
+
+def get_local_device_ids() -> list[str]:
+    """Return device IDs with hardware connections on this worker."""
     return list(_hardware_clients.keys())
 
 
+def get_connected_among(device_ids: Set[str]) -> Set[str]:
+    """Return which of `device_ids` have a hardware connection on any worker."""
+    remote = _remote_device_ids()
+    return {d for d in device_ids if d in _hardware_clients or d in remote}
+
+
 def is_device_connected(device_id: str) -> bool:
     """Check if a hardware device has any active WebSocket connections."""
     return device_id in _hardware_clients and len(_hardware_clients[device_id]) > 0
 
 
-async def send_to_device(device_id: str, message: str) -> bool:
+def _pool(client_type: str) -> Dict[str, Set[DeviceConnection]]:
+    return _hardware_clients if client_type == "hardware" else _browser_clients
+
+
+def _register(connection: DeviceConnection) -> None:
+    connections = _pool(connection.client_type).setdefault(connection.device_id, set())
+    connections.add(connection)
+    if connection.client_type != "hardware":
+        return
+    health = device_health(connection.device_id)
+    health.connects += 1
+    health.touch()
+    if len(connections) == 1:
+        _notify_presence(connection.device_id, True)
+
+
+def _unregister(connection: DeviceConnection) -> None:
+    clients = _pool(connection.client_type)
+    connections = clients.get(connection.device_id)
+    if connections is None:
+        return
+    connections.discard(connection)
+    if not connections:
+        del clients[connection.device_id]
+        if connection.client_type == "hardware":
+            _notify_presence(connection.device_id, False)
+
+
+def notify_browsers(device_id: str, message: str) -> None:
+    """Queue a message on the browser connections of a device"""
+    _enqueue_all(_browser_clients.get(device_id, set()), message)
+
+
+def _enqueue_all(connections: Set[DeviceConnection], message: str) -> None:
+    for connection in list(connections):
+        connection.enqueue(message)
+
+
+class TriggerResult(NamedTuple):
     """
-    Send a message to all WebSocket connections for a device (hardware + browser).
-    Returns True if message was sent to at least one client.
+    Outcome of a trigger: "acked" (protocol 2 device confirmed), "sent"
+    (written to a protocol 1 device), "unacked" (written to a protocol 2
+    device that never confirmed it, so the relay may or may not have fired)
+    or "failed" (never written to any device). Only failed triggers may be
+    sent again later.
     """
-    sent = False
 
-    # Send to hardware clients
-    if device_id in _hardware_clients:
-        dead_connections: Set[WebSocket] = set()
-        for websocket in _hardware_clients[device_id]:
-            try:
-                await websocket.send_text(message)
-                sent = True
-            except Exception as e:
-                logger.debug(f"Failed to send to hardware: {e}")
-                dead_connections.add(websocket)
-        for ws in dead_connections:
-            _hardware_clients[device_id].discard(ws)
-        if not _hardware_clients[device_id]:
-            del _hardware_clients[device_id]
-
-    # Send to browser clients (so UI shows payment received)
-    if device_id in _browser_clients:
-        dead_connections = set()
-        for websocket in _browser_clients[device_id]:
+    delivery: str
+    latency_ms: Optional[int] = None
+    attempts: int = 0
+
+
+def trigger_message(message_id: str, pin: int, duration: int) -> str:
+    return json.dumps(
+        {
+            "v": 2,
+            "type": "trigger",
+            "id": message_id,
+            "pin": pin,
+            "duration": duration,
+        }
+    )
+
+
+def ping_message(ping_id: str) -> str:
+    return json.dumps({"v": 2, "type": "ping", "id": ping_id})
+
+
+def _handle_message(connection: DeviceConnection, data: str) -> None:
+    """Note the peer is alive and resolve protocol 2 ACKs and pongs"""
+    connection.last_seen = monotonic()
+    if connection.client_type == "hardware":
+        device_health(connection.device_id).touch()
+    if connection.protocol < 2:
+        return
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return
+    if not isinstance(message, dict):
+        return
+    if message.get("type") == "ack":
+        pending = _pending_acks.get((connection.device_id, str(message.get("id"))))
+        # only a connection the trigger was written to can confirm it
+        if pending and connection in pending[1] and not pending[0].done():
+            pending[0].set_result(True)
+    elif message.get("type") == "pong" and connection.pong:
+        ping_id, pong = connection.pong
+        if str(message.get("id")) == ping_id and not pong.done():
+            pong.set_result(True)
+
+
+async def _heartbeat(connection: DeviceConnection) -> bool:
+    """
+    Ping a protocol 2 peer until it fails to answer in time, returning True,
+    or the connection closes, returning False
+    """
+    loop = asyncio.get_running_loop()
+    seq = 0
+    while not connection.closed:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        seq += 1
+        pong = loop.create_future()
+        connection.pong = (str(seq), pong)
+        sent = monotonic()
+        try:
+            if not connection.enqueue(ping_message(str(seq))):
+                return False
+            await asyncio.wait_for(pong, HEARTBEAT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return not connection.closed
+        finally:
+            connection.pong = None
+        connection.rtt_ms = (monotonic() - sent) * 1000
+        device_health(connection.device_id).record_rtt(connection.rtt_ms)
+    return False
+
+
+async def _idle_watch(connection: DeviceConnection) -> bool:
+    """
+    Return True once a protocol 1 peer sent nothing for
+    HEARTBEAT_IDLE_TIMEOUT, False if the connection closed before
+    """
+    while not connection.closed:
+        idle = monotonic() - connection.last_seen
+        if idle >= HEARTBEAT_IDLE_TIMEOUT:
+            return True
+        await asyncio.sleep(HEARTBEAT_IDLE_TIMEOUT - idle)
+    return False
+
+
+def _watchdog(connection: DeviceConnection) -> Optional[asyncio.Task]:
+    if connection.client_type != "hardware":
+        return None
+    if connection.protocol >= 2 and HEARTBEAT_INTERVAL > 0:
+        return asyncio.create_task(_heartbeat(connection))
+    if connection.protocol < 2 and HEARTBEAT_IDLE_TIMEOUT > 0:
+        return asyncio.create_task(_idle_watch(connection))
+    return None
+
+
+async def _receive_loop(connection: DeviceConnection) -> None:
+    device_id, client_type = connection.device_id, connection.client_type
+    try:
+        while True:
+            data = await connection.websocket.receive_text()
+            logger.debug(f"Received from {device_id} ({client_type}): {data}")
+            _handle_message(connection, data)
+    except WebSocketDisconnect:
+        logger.info(f"{client_type.capitalize()} disconnected for device {device_id}")
+    except Exception as e:
+        logger.debug(f"WebSocket error for {device_id}: {e}")
+
+
+async def _write_legacy(connections: list[DeviceConnection], message: str) -> bool:
+    """
+    Queue a protocol 1 trigger and wait until one connection wrote it. A
+    write still queued after the wait counts as sent, it may yet reach the
+    device and must not be replayed from the outbox.
+    """
+    loop = asyncio.get_running_loop()
+    writes = []
+    for connection in connections:
+        written = loop.create_future()
+        if connection.enqueue(message, written):
+            writes.append(written)
+    if not writes:
+        return False
+    await asyncio.wait(writes, timeout=2 * WS_SEND_TIMEOUT)
+    return any(not w.done() or w.result() for w in writes)
+
+
+async def send_trigger(
+    device_id: str, message_id: str, pin: int, duration: int, paid_at: float
+) -> TriggerResult:
+    """
+    Fire a relay on a device and report whether it actuated.
+
+    Protocol 2 connections get the trigger resent with exponential backoff
+    until one of them ACKs it or TRIGGER_ACK_DEADLINE passes. The latency is
+    measured from `paid_at` (unix time) to the ACK. Browsers watching the
+    device are notified after the hardware.
+    """
+    legacy_message = f"{pin}-{duration}"
+    connections = list(_hardware_clients.get(device_id, set()))
+    legacy = [c for c in connections if c.protocol < 2]
+    acking = [c for c in connections if c.protocol >= 2]
+
+    if not acking:
+        sent = await _write_legacy(legacy, legacy_message) if legacy else False
+        _enqueue_all(_browser_clients.get(device_id, set()), legacy_message)
+        return TriggerResult("sent" if sent else "failed", attempts=len(legacy))
+
+    for connection in legacy:
+        connection.enqueue(legacy_message)
+
+    loop = asyncio.get_running_loop()
+    ack = loop.create_future()
+    written_to: Set[DeviceConnection] = set()
+    writes: list[asyncio.Future] = []
+    _pending_acks[(device_id, message_id)] = (ack, written_to)
+    message = trigger_message(message_id, pin, duration)
+    deadline = time() + TRIGGER_ACK_DEADLINE
+    delay = TRIGGER_RETRY_DELAY
+    attempts = 0
+    browsers_notified = False
+    try:
+        while True:
+            # the device may have reconnected since the last attempt
+            for connection in list(_hardware_clients.get(device_id, set())):
+                if connection.protocol < 2:
+                    continue
+                written = loop.create_future()
+                if connection.enqueue(message, written):
+                    # registered before the write, so an ACK read in the same
+                    # loop turn as the write completing is not dropped
+                    written_to.add(connection)
+                    writes.append(written)
+                    attempts += 1
+            if not browsers_notified:
+                _enqueue_all(_browser_clients.get(device_id, set()), legacy_message)
+                browsers_notified = True
+            remaining = deadline - time()
+            if remaining <= 0:
+                # a write still in flight may yet reach the device
+                if any(not w.done() or w.result() for w in writes):
+                    return TriggerResult("unacked", attempts=attempts)
+                return TriggerResult("failed", attempts=attempts)
             try:
-                await websocket.send_text(message)
-                sent = True
-            except Exception as e:
-                logger.debug(f"Failed to send to browser: {e}")
-                dead_connections.add(websocket)
-        for ws in dead_connections:
-            _browser_clients[device_id].discard(ws)
-        if not _browser_clients[device_id]:
-            del _browser_clients[device_id]
+                await asyncio.wait_for(asyncio.shield(ack), min(delay, remaining))
+                latency_ms = int((time() - paid_at) * 1000)
+                return TriggerResult("acked", latency_ms, attempts)
+            except asyncio.TimeoutError:
+                delay *= 2
+    finally:
+        _pending_acks.pop((device_id, message_id), None)
+
+
+def device_lock(device_id: str) -> asyncio.Lock:
+    """The lock serialising trigger delivery to a device on this worker"""
+    lock = _device_locks.get(device_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _device_locks[device_id] = lock
+    return lock
+
 
-    if not sent:
-        logger.warning(f"No WebSocket connections for device {device_id}")
+async def replay_outbox(device_id: str) -> bool:
+    """
+    Replay the queued triggers of a device, oldest first, and drop those
+    that expired while it was offline. The caller holds device_lock.
+    Returns False if the device went away before the outbox was empty.
+    """
+    try:
+        triggers = await get_outbox_triggers(device_id)
+    except Exception as e:
+        logger.warning(f"Could not read outbox of device {device_id}: {e}")
+        return True
+    if not triggers:
+        return True
+    now = int(time())
+    finished: list[str] = []
+    drained = True
+    try:
+        for trigger in triggers:
+            if trigger.expires <= now:
+                await update_payment(payment_id=trigger.id, delivery="failed")
+                finished.append(trigger.id)
+                continue
+            result = await send_trigger(
+                device_id, trigger.id, trigger.pin, trigger.duration, trigger.epoch
+            )
+            if result.delivery == "failed":
+                # gone again, keep this and later triggers in order
+                drained = False
+                break
+            await update_payment(
+                payment_id=trigger.id,
+                delivery=result.delivery,
+                latency_ms=result.latency_ms,
+            )
+            finished.append(trigger.id)
+    finally:
+        await delete_outbox_triggers(finished)
+    if finished:
+        logger.info(f"Replayed {len(finished)} queued triggers for {device_id}")
+    return drained
 
-    return sent
+
+async def drain_outbox(device_id: str) -> None:
+    """Replay the outbox of a device that just connected or got a trigger queued"""
+    async with device_lock(device_id):
+        try:
+            await replay_outbox(device_id)
+        except Exception as e:
+            logger.warning(f"Could not replay outbox of device {device_id}: {e}")
 
 
 @devicetimer_websocket_router.websocket("/api/v1/ws/{device_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     device_id: str,
-    type: Optional[str] = Query(default="hardware")
+    type: Optional[str] = Query(default="hardware"),
+    protocol: int = Query(default=1),
 ):
     """
     WebSocket endpoint for device connections.
 
     Query params:
         type: "hardware" (default) for ESP32 devices, "browser" for UI connections
+        protocol: hardware protocol version, 1 (default) or 2 for ACKed triggers
     """
     await websocket.accept()
 
-    # Select the appropriate client pool
+    # Browsers only need the latest notifications, hardware triggers must
+    # never be dropped
     is_browser = type == "browser"
-    clients = _browser_clients if is_browser else _hardware_clients
     client_type = "browser" if is_browser else "hardware"
-
-    # Add to tracking
-    if device_id not in clients:
-        clients[device_id] = set()
-    clients[device_id].add(websocket)
+    connection = DeviceConnection(
+        websocket,
+        device_id,
+        client_type,
+        OverflowPolicy.DROP_OLDEST if is_browser else OverflowPolicy.NEVER_DROP,
+        WS_QUEUE_SIZE_BROWSER if is_browser else WS_QUEUE_SIZE_HARDWARE,
+        on_close=_unregister,
+        protocol=1 if is_browser else protocol,
+    )
+    _register(connection)
+    connection.start()
+    if not is_browser:
+        # runs beside the receive loop below, which collects the ACKs
+        _spawn(drain_outbox(device_id))
 
     logger.info(f"{client_type.capitalize()} connected for device {device_id}")
 
+    # a half-open TCP connection never ends the receive loop, the watchdog
+    # notices the silent peer instead
+    receiver = asyncio.create_task(_receive_loop(connection))
+    watchdog = _watchdog(connection)
+    tasks = {receiver, watchdog} if watchdog else {receiver}
     try:
-        while True:
-            data = await websocket.receive_text()
-            logger.debug(f"Received from {device_id} ({client_type}): {data}")
-    except WebSocketDisconnect:
-        logger.info(f"{client_type.capitalize()} disconnected for device {device_id}")
-    except Exception as e:
-        logger.debug(f"WebSocket error for {device_id}: {e}")
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        # the watchdog also ends when the connection closed on its own
+        timed_out = (
+            watchdog is not None
+            and watchdog.done()
+            and not watchdog.cancelled()
+            and watchdog.result()
+        )
+        if timed_out and connection.protocol >= 2:
+            device_health(device_id).evictions += 1
+            logger.warning(
+                f"Evicting unresponsive hardware {connection.peer} "
+                f"of device {device_id}"
+            )
+        elif timed_out:
+            # quiet protocol 1 firmware is healthy, it just reconnects
+            logger.debug(
+                f"Closing idle hardware {connection.peer} of device {device_id}"
+            )
     finally:
-        if device_id in clients:
-            clients[device_id].discard(websocket)
-            if not clients[device_id]:
-                del clients[device_id]
+        for task in tasks:
+            task.cancel()
+        connection.close()
         logger.debug(f"Connected hardware devices: {list(_hardware_clients.keys())}")
 
-
-@devicetimer_websocket_router.get("/api/v1/ws/status")
-async def get_websocket_status():
-    """
-    Return list of connected device IDs.
-    Used by frontend to show real-time connection status.
-    """
-    return {"connected": get_connected_device_ids()}